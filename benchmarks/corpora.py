@@ -0,0 +1,104 @@
+"""Synthetic Airbyte-like JSON documents for the benchmarks
+
+Documents are generated deterministically from a seed, so that runs on the
+same machine are comparable with each other and with a stored baseline.
+"""
+
+import json
+import random
+
+# Key name patterns seen in real sources: camelCase, PascalCase, spaces,
+# punctuation and non-ASCII characters all go through `clean_name`.
+_KEY_PATTERNS = [
+    "field{i}",
+    "someField{i}",
+    "Some Field {i}",
+    "custom_field_{i}",
+    "Kenttä ({i})",
+    "x-field.{i}",
+]
+
+
+def make_keys(width):
+    return [_KEY_PATTERNS[i % len(_KEY_PATTERNS)].format(i=i) for i in range(width)]
+
+
+def make_value(rng, value_type, depth, array_size):
+    if value_type == "int":
+        return rng.randint(-(10**9), 10**9)
+    if value_type == "float":
+        return rng.random() * 1000
+    if value_type == "bool":
+        return rng.random() < 0.5
+    if value_type == "string":
+        return f"value {rng.randint(0, 10**6)}"
+    if value_type == "null":
+        return None
+    if value_type == "object":
+        if depth <= 0:
+            return {"id": rng.randint(0, 1000)}
+        return {
+            f"nested{i}": make_value(rng, rng.choice(["int", "string"]), depth - 1, 0)
+            for i in range(3)
+        }
+    if value_type == "string_array":
+        return [f"tag {rng.randint(0, 100)}" for _ in range(array_size)]
+    if value_type == "object_array":
+        return [
+            {"id": rng.randint(0, 1000), "name": f"item {i}", "amount": rng.random()}
+            for i in range(array_size)
+        ]
+    raise ValueError(f"Unknown value type: {value_type}")
+
+
+# Type mixtures: weights of the value types of the keys of a document.
+TYPE_MIXTURES = {
+    "scalars": {"int": 3, "float": 2, "bool": 1, "string": 4, "null": 1},
+    "mixed": {
+        "int": 3,
+        "float": 2,
+        "bool": 1,
+        "string": 4,
+        "null": 1,
+        "object": 1,
+        "string_array": 1,
+        "object_array": 1,
+    },
+}
+
+
+def make_object_documents(
+    count, width, depth=1, array_size=3, type_mixture="mixed", seed=0
+):
+    """Return `count` JSON objects with `width` keys each, as decoded values
+
+    Every key keeps its value type across documents, except that about one
+    value in twenty is null, like in real sources.
+    """
+    rng = random.Random(seed)
+    weights = TYPE_MIXTURES[type_mixture]
+    keys = make_keys(width)
+    key_types = rng.choices(list(weights), list(weights.values()), k=width)
+    return [
+        {
+            key: (
+                None
+                if rng.random() < 0.05
+                else make_value(rng, value_type, depth, array_size)
+            )
+            for key, value_type in zip(keys, key_types)
+        }
+        for _ in range(count)
+    ]
+
+
+def make_array_documents(count, width, array_size=10, seed=0):
+    """Return `count` JSON arrays of `array_size` objects with `width` keys"""
+    return [
+        make_object_documents(array_size, width, 0, 0, "scalars", seed + i)
+        for i in range(count)
+    ]
+
+
+def to_json(documents):
+    return [json.dumps(document) for document in documents]
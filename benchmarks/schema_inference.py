@@ -0,0 +1,327 @@
+"""Offline microbenchmarks of schema inference and schema transformation
+
+Measures throughput, peak memory and how both scale with the width of the
+JSON documents. Nothing is sent over the network: BigQuery is replaced with
+a client returning synthetic documents.
+
+Examples:
+    python -m benchmarks.schema_inference
+    python -m benchmarks.schema_inference --widths 10 100 --save benchmarks/baseline.json
+    python -m benchmarks.schema_inference --baseline benchmarks/baseline.json
+
+With `--baseline`, the exit code is 1 if any case is slower than the baseline
+by more than `--tolerance` (a fraction, 0.2 by default). Throughput depends on
+the machine, so compare against a baseline saved on the same machine.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from google.cloud import bigquery
+
+from benchmarks.corpora import (
+    make_array_documents,
+    make_keys,
+    make_object_documents,
+    to_json,
+)
+from prefect_qbi import clean
+from prefect_qbi.clean import bigquery_schema, json_columns, schema_sketch
+
+DEFAULT_WIDTHS = [10, 100, 1000, 10000]
+
+# Roughly the same number of keys is processed at every width, so that wide
+# cases don't take much longer than narrow ones.
+KEYS_PER_CASE = 200_000
+
+
+def _get_document_count(width):
+    return max(5, KEYS_PER_CASE // width)
+
+
+class _OfflineJob(list):
+    total_bytes_billed = 0
+
+
+class _OfflineClient:
+    """Client whose queries return the same sampled JSON values every time"""
+
+    def __init__(self, values, schema=None):
+        self.rows = [{"column_index": 0, "value": value} for value in values]
+        self.schema = schema or []
+
+    def query(self, query, job_config=None):
+        return _OfflineJob(self.rows)
+
+    def get_table(self, table_ref):
+        return bigquery.Table(table_ref, schema=self.schema)
+
+
+def setup_analyze_json_value(width):
+    values = to_json(make_object_documents(_get_document_count(width), width))
+
+    def run():
+        schema = {}
+        for value in values:
+            schema = json_columns.analyze_json_value("data", value, schema, True)
+
+    return run, len(values)
+
+
+def setup_sketch_in_processes(width):
+    values = to_json(make_object_documents(_get_document_count(width), width))
+    processes = os.cpu_count()
+    chunk_size = max(1, len(values) // (processes * 4))
+
+    def run():
+        schema_sketch.sketch_json_values_in_processes(
+            (("data", value) for value in values), True, processes, None, chunk_size
+        )
+
+    # Start the worker processes before measuring.
+    run()
+    return run, len(values)
+
+
+def setup_analyze_dict(width):
+    documents = make_object_documents(_get_document_count(width), width)
+
+    def run():
+        schema = {}
+        for document in documents:
+            schema = json_columns.analyze_dict(document, schema)
+
+    return run, len(documents)
+
+
+def setup_analyze_list(width):
+    documents = make_array_documents(max(5, _get_document_count(width) // 10), width)
+
+    def run():
+        schema = {}
+        for document in documents:
+            schema = json_columns.analyze_list(document, schema)
+
+    return run, len(documents)
+
+
+def setup_map_to_new_fields(width):
+    schema = {}
+    for document in make_object_documents(20, width):
+        schema = json_columns.analyze_dict(document, schema)
+    field = bigquery.SchemaField("data", "JSON")
+    json_column_schemas = {"data": schema}
+
+    def run():
+        bigquery_schema.map_to_new_fields(field, json_column_schemas)
+
+    return run, 1
+
+
+def setup_clean_name(width):
+    names = make_keys(width)
+
+    def run():
+        for name in names:
+            bigquery_schema.clean_name(name)
+
+    return run, len(names)
+
+
+def setup_transform_table_schema(width):
+    client = _OfflineClient(
+        to_json(make_object_documents(_get_document_count(width), width))
+    )
+    source_schema = [
+        bigquery.SchemaField("id", "INT64"),
+        bigquery.SchemaField("data", "JSON"),
+        bigquery.SchemaField("_airbyte_extracted_at", "TIMESTAMP"),
+    ]
+
+    def run():
+        # Sampling prints the bytes billed, which isn't interesting here.
+        with contextlib.redirect_stdout(io.StringIO()):
+            bigquery_schema.transform_table_schema(
+                source_schema, client, "project", "dataset", "table", True
+            )
+
+    return run, 1
+
+
+def setup_wide_table_queries(width):
+    source_schema = [
+        bigquery.SchemaField("_airbyte_raw_id", "STRING"),
+        bigquery.SchemaField("data", "JSON"),
+        bigquery.SchemaField("_airbyte_extracted_at", "TIMESTAMP"),
+    ]
+    client = _OfflineClient(
+        to_json(make_object_documents(_get_document_count(width), width)),
+        source_schema,
+    )
+    # Wide-table mode: shards of at most 1,000 columns and compact SQL.
+    config = clean.CleanConfig(max_columns_per_table=1000)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for spec in clean._iter_destination_table_specs(
+                client, "project", "dataset", "table", "destination", config
+            ):
+                clean._get_destination_table_query(spec)
+
+    return run, 1
+
+
+# Case name -> (setup function, unit of throughput).
+CASES = {
+    "analyze_json_value": (setup_analyze_json_value, "docs"),
+    "sketch_in_processes": (setup_sketch_in_processes, "docs"),
+    "analyze_dict": (setup_analyze_dict, "docs"),
+    "analyze_list": (setup_analyze_list, "docs"),
+    "map_to_new_fields": (setup_map_to_new_fields, "schemas"),
+    "clean_name": (setup_clean_name, "names"),
+    "transform_table_schema": (setup_transform_table_schema, "tables"),
+    "wide_table_queries": (setup_wide_table_queries, "tables"),
+}
+
+
+def measure(run, units, min_time):
+    """Return the best throughput (units per second) and peak memory of `run`"""
+    best_seconds = math.inf
+    total_seconds = 0
+    repeats = 0
+    while repeats < 5 or total_seconds < min_time:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        best_seconds = min(best_seconds, seconds)
+        total_seconds += seconds
+        repeats += 1
+
+    # Measured separately, because tracing allocations slows the run down.
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return units / best_seconds, peak_memory
+
+
+def run_benchmarks(case_names, widths, min_time=0.5):
+    """Return mapping from case names to results by width"""
+    results = {}
+    for case_name in case_names:
+        setup, unit = CASES[case_name]
+        results[case_name] = {}
+        for width in widths:
+            throughput, peak_memory = measure(*setup(width), min_time)
+            results[case_name][str(width)] = {
+                "unit": unit,
+                "throughput": throughput,
+                "keys_per_second": throughput * _get_keys_per_unit(case_name, width),
+                "peak_memory": peak_memory,
+            }
+    return results
+
+
+def _get_keys_per_unit(case_name, width):
+    if case_name == "clean_name":
+        return 1
+    if case_name == "analyze_list":
+        return width * 10
+    if case_name == "transform_table_schema":
+        return width * _get_document_count(width)
+    return width
+
+
+def get_scaling_exponents(case_results):
+    """Return how time per unit grows with width between consecutive widths
+
+    1 means linear growth and 2 quadratic growth.
+    """
+    widths = sorted(case_results, key=int)
+    return {
+        f"{width1}-{width2}": math.log(
+            case_results[width1]["throughput"] / case_results[width2]["throughput"]
+        )
+        / math.log(int(width2) / int(width1))
+        for width1, width2 in zip(widths, widths[1:])
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Return descriptions of cases that are slower than the baseline"""
+    regressions = []
+    for case_name, case_results in results.items():
+        for width, result in case_results.items():
+            baseline_result = baseline.get(case_name, {}).get(width)
+            if baseline_result is None:
+                continue
+            ratio = result["throughput"] / baseline_result["throughput"]
+            if ratio < 1 - tolerance:
+                regressions.append(
+                    f"{case_name} at width {width}: {ratio:.0%} of baseline throughput"
+                )
+    return regressions
+
+
+def print_results(results, baseline=None):
+    for case_name, case_results in results.items():
+        print(case_name)
+        for width, result in case_results.items():
+            line = (
+                f"  width {width:>6}: {result['throughput']:>12.1f} "
+                f"{result['unit']}/s, {result['keys_per_second']:>12.0f} keys/s, "
+                f"peak {result['peak_memory'] / 1024**2:>8.2f} MiB"
+            )
+            baseline_result = (baseline or {}).get(case_name, {}).get(width)
+            if baseline_result is not None:
+                ratio = result["throughput"] / baseline_result["throughput"]
+                line += f", {ratio:.0%} of baseline"
+            print(line)
+        if len(case_results) > 1:
+            exponents = ", ".join(
+                f"{widths}: {exponent:.2f}"
+                for widths, exponent in get_scaling_exponents(case_results).items()
+            )
+            print(f"  scaling exponents: {exponents}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--widths", nargs="+", type=int, default=DEFAULT_WIDTHS)
+    parser.add_argument("--min-time", type=float, default=0.5)
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save")
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(args.cases, args.widths, args.min_time)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
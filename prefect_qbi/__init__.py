@@ -2,7 +2,7 @@ from google.cloud import dataform_v1beta1
 from prefect import task
 from prefect_gcp import GcpCredentials
 
-from . import backup, clean, dataform
+from . import backup, clean, dataform, telemetry
 
 
 @task
@@ -12,7 +12,8 @@ def backup_dataset(gcp_credentials_block_name, dataset_id, location, bucket_name
     project_id = gcp_credentials_block.project
     assert project_id, "No project found"
 
-    backup.dataset(client, project_id, dataset_id, location, bucket_name)
+    with telemetry.job_labels(customer=telemetry.get_customer_from_run_tags()):
+        backup.dataset(client, project_id, dataset_id, location, bucket_name)
 
 
 @task
@@ -24,7 +25,8 @@ def backup_table(
     project_id = gcp_credentials_block.project
     assert project_id, "No project found"
 
-    backup.table(client, project_id, dataset_id, table_id, location, bucket_name)
+    with telemetry.job_labels(customer=telemetry.get_customer_from_run_tags()):
+        backup.table(client, project_id, dataset_id, table_id, location, bucket_name)
 
 
 @task
@@ -33,18 +35,68 @@ def clean_dataset(
     source_dataset,
     destination_dataset,
     table_prefix,
+    max_concurrent_tables=1,
+    incremental=False,
+    state_table=None,
+    cache_json_schemas=False,
+    force=False,
+    config_options=None,
 ):
+    """Clean a dataset
+
+    If `state_table` is given, state between runs is kept in that table of the
+    destination dataset. `config_options` are passed to `clean.CleanConfig`
+    together with the other options, for options without their own argument.
+    """
+    gcp_credentials_block = GcpCredentials.load(gcp_credentials_block_name)
+    client = gcp_credentials_block.get_bigquery_client()
+    project_id = gcp_credentials_block.project
+    assert project_id, "No project found"
+
+    state_store = (
+        clean.BigQueryStateStore(client, project_id, destination_dataset, state_table)
+        if state_table
+        else None
+    )
+    with telemetry.job_labels(customer=telemetry.get_customer_from_run_tags()):
+        clean.transform_dataset(
+            client,
+            project_id,
+            source_dataset,
+            destination_dataset,
+            table_prefix,
+            clean.CleanConfig(
+                max_concurrent_tables=max_concurrent_tables,
+                incremental=incremental,
+                state_store=state_store,
+                cache_json_schemas=cache_json_schemas,
+                force=force,
+                **(config_options or {}),
+            ),
+        )
+
+
+@task
+def plan_clean_dataset(
+    gcp_credentials_block_name,
+    source_dataset,
+    destination_dataset,
+    table_prefix,
+    config_options=None,
+):
+    """Return what `clean_dataset` would do, estimated with dry-run jobs"""
     gcp_credentials_block = GcpCredentials.load(gcp_credentials_block_name)
     client = gcp_credentials_block.get_bigquery_client()
     project_id = gcp_credentials_block.project
     assert project_id, "No project found"
 
-    clean.transform_dataset(
+    return clean.plan_dataset(
         client,
         project_id,
         source_dataset,
         destination_dataset,
         table_prefix,
+        clean.CleanConfig(**(config_options or {})),
     )
 
 
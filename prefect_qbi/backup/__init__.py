@@ -1,5 +1,7 @@
 from google.cloud import bigquery
 
+from ..telemetry import job_labels, label_job_config, record_jobs, track_job
+
 
 def _extract_table(client, project_id, dataset_id, table_id, location, bucket_name):
     destination_uri = "gs://{}/{}".format(
@@ -9,7 +11,14 @@ def _extract_table(client, project_id, dataset_id, table_id, location, bucket_na
     dataset_ref = bigquery.DatasetReference(project_id, dataset_id)
     table_ref = dataset_ref.table(table_id)
 
-    extract_job = client.extract_table(table_ref, destination_uri, location=location)
+    with job_labels(source_table=table_id):
+        extract_job = client.extract_table(
+            table_ref,
+            destination_uri,
+            location=location,
+            job_config=label_job_config(bigquery.ExtractJobConfig(), "extract"),
+        )
+    track_job(extract_job)
     extract_job.result()
     print(
         "Exported {}:{}.{} to {}".format(
@@ -21,11 +30,13 @@ def _extract_table(client, project_id, dataset_id, table_id, location, bucket_na
 def dataset(client, project_id, dataset_id, location, bucket_name):
     tables = client.list_tables(dataset_id)
 
-    for table in tables:
-        _extract_table(
-            client, project_id, dataset_id, table.table_id, location, bucket_name
-        )
+    with record_jobs(f"backup {dataset_id}"), job_labels(dataset=dataset_id):
+        for table in tables:
+            _extract_table(
+                client, project_id, dataset_id, table.table_id, location, bucket_name
+            )
 
 
 def table(client, project_id, dataset_id, table_id, location, bucket_name):
-    _extract_table(client, project_id, dataset_id, table_id, location, bucket_name)
+    with record_jobs(f"backup {dataset_id}.{table_id}"), job_labels(dataset=dataset_id):
+        _extract_table(client, project_id, dataset_id, table_id, location, bucket_name)
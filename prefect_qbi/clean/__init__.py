@@ -1,19 +1,71 @@
+import contextvars
+import dataclasses
+import hashlib
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
 from google.cloud import bigquery
 
-from .bigquery_schema import transform_table_schema
+from ..telemetry import job_labels, record_jobs
+from .bigquery_schema import clean_name, get_join_key_name, transform_table_schema
 from .bigquery_utils import (
+    are_schemas_equal,
+    count_rows_up_to,
     create_dataset_with_location,
     create_table_with_schema,
     delete_table,
+    dry_run_query,
     get_dataset_location,
+    get_dataset_table_layouts,
     get_dataset_table_names,
-    get_table_schema,
+    get_dataset_tables,
+    get_max_column_values,
+    get_table,
+    get_table_fingerprint,
+    get_table_layout,
+    get_table_or_none,
     insert_query_result_to_table,
     rename_table,
+    replace_tables,
+    start_create_or_replace_table_as_query,
+    start_insert_query_result_to_table,
+    start_load_rows_to_table,
+    start_merge_query_result_to_table,
+    wait_for_jobs,
+)
+from .budget import BytesBudget, BytesBudgetExceeded
+from .config import CleanConfig
+from .m_files_transform import (
+    record_file_fingerprints,
+    transform_json_column_to_tables,
 )
-from .m_files_transform import transform_json_column_to_tables
+from .state import BigQueryStateStore, LocalFileStateStore, StateStore
 from .utils import convert_to_snake_case, get_unique_temp_table_name
 
+# The column of subtable shards with the offset of the item in its array.
+ARRAY_OFFSET_COLUMN_NAME = "_quickbi_array_offset"
+
+# Increase when a change of this package changes the tables produced from the
+# same source table, so that tables skipped as unchanged are rebuilt.
+OUTPUT_VERSION = 1
+
+# Options that don't change the produced tables, only how or whether they're
+# produced. Changing any other option rebuilds tables skipped as unchanged.
+_NON_OUTPUT_OPTION_NAMES = {
+    "max_concurrent_tables",
+    "incremental",
+    "state_store",
+    "cache_json_schemas",
+    "force",
+    "batch_json_sampling",
+    "analysis_processes",
+    "json_decoder",
+    "transport",
+    "maximum_bytes_billed_per_table",
+    "maximum_bytes_billed_per_dataset",
+}
+
 
 # TODO: instead of looking at dataset name this should be able to get source system name.
 def are_subtables_enabled(source_dataset_id):
@@ -33,26 +85,84 @@ def transform_dataset(
     source_dataset_id: str,
     destination_dataset_id: str,
     table_prefix: str,
+    config: CleanConfig | None = None,
 ):
-    # Create destination dataset with source dataset's location.
-    source_location = get_dataset_location(client, project_id, source_dataset_id)
-    create_dataset_with_location(
-        client, project_id, destination_dataset_id, source_location
-    )
-
-    for source_table_name in get_dataset_table_names(
-        client, project_id, source_dataset_id
+    with record_jobs(f"clean {source_dataset_id}"), job_labels(
+        dataset=source_dataset_id
     ):
-        transform_table(
+        _transform_dataset(
             client,
             project_id,
             source_dataset_id,
             destination_dataset_id,
-            source_table_name,
             table_prefix,
+            config,
         )
 
 
+def _transform_dataset(
+    client,
+    project_id,
+    source_dataset_id,
+    destination_dataset_id,
+    table_prefix,
+    config,
+):
+    config = config or CleanConfig()
+
+    # Create destination dataset with source dataset's location.
+    source_location = get_dataset_location(client, project_id, source_dataset_id)
+    create_dataset_with_location(
+        client, project_id, destination_dataset_id, source_location
+    )
+
+    # Start the largest tables first, so that the slowest table doesn't
+    # end up being started last when tables are transformed concurrently.
+    source_tables = sorted(
+        get_dataset_tables(
+            client, project_id, source_dataset_id, config.max_concurrent_tables
+        ),
+        key=lambda table: table.num_bytes or 0,
+        reverse=True,
+    )
+
+    dataset_budget = BytesBudget(config.maximum_bytes_billed_per_dataset)
+
+    # A failing table doesn't stop the others. `transform_table` has already
+    # removed its temp tables, so the errors are only collected and re-raised
+    # once every table has been processed. Every table runs in a copy of the
+    # current context, so that job labels and recording reach the threads.
+    with ThreadPoolExecutor(max_workers=config.max_concurrent_tables) as executor:
+        futures = {
+            source_table.table_id: executor.submit(
+                contextvars.copy_context().run,
+                transform_table,
+                client,
+                project_id,
+                source_dataset_id,
+                destination_dataset_id,
+                source_table.table_id,
+                table_prefix,
+                config,
+                dataset_budget,
+                flush_state=False,
+            )
+            for source_table in source_tables
+        }
+    # Write the state of every transformed table with one job.
+    if config.state_store is not None:
+        config.state_store.flush()
+    errors = {
+        source_table_name: future.exception()
+        for source_table_name, future in futures.items()
+        if future.exception() is not None
+    }
+    if errors:
+        raise RuntimeError(
+            f"Failed to transform {len(errors)} table(s): {', '.join(errors)}"
+        ) from next(iter(errors.values()))
+
+
 def transform_table(
     client: bigquery.Client,
     project_id: str,
@@ -60,62 +170,235 @@ def transform_table(
     destination_dataset_id: str,
     source_table_name: str,
     table_prefix: str,
+    config: CleanConfig | None = None,
+    dataset_budget: BytesBudget | None = None,
+    flush_state: bool = True,
+):
+    """Transform a source table into destination tables
+
+    With `flush_state=False`, state store writes are left buffered for the
+    caller to flush, e.g. once for the whole dataset.
+    """
+    with record_jobs(f"clean {source_dataset_id}.{source_table_name}"), job_labels(
+        dataset=source_dataset_id, source_table=source_table_name
+    ):
+        try:
+            _transform_table(
+                client,
+                project_id,
+                source_dataset_id,
+                destination_dataset_id,
+                source_table_name,
+                table_prefix,
+                config,
+                dataset_budget,
+            )
+        finally:
+            if flush_state and config is not None and config.state_store is not None:
+                config.state_store.flush()
+
+
+def _transform_table(
+    client,
+    project_id,
+    source_dataset_id,
+    destination_dataset_id,
+    source_table_name,
+    table_prefix,
+    config,
+    dataset_budget,
 ):
+    config = config or CleanConfig()
     table_mappings = []
+    jobs = []
 
-    try:
-        # Create and populate temp tables.
-        for destination_table_spec in _iter_destination_table_specs(
+    source_fingerprint_key = (
+        f"source_fingerprint/{project_id}.{source_dataset_id}.{source_table_name}"
+        f"/{destination_dataset_id}/{table_prefix}"
+    )
+    source_fingerprint = None
+    if config.state_store is not None:
+        source_fingerprint = get_table_fingerprint(
+            client, project_id, source_dataset_id, source_table_name
+        )
+        if not config.force and _is_source_unchanged(
             client,
             project_id,
-            source_dataset_id,
-            source_table_name,
             destination_dataset_id,
+            config.state_store.get(source_fingerprint_key),
+            source_fingerprint,
+            _get_output_options_hash(config),
         ):
-            destination_table_name = f"{table_prefix}__{destination_table_spec['name']}"
-            temp_destination_table_name = get_unique_temp_table_name(
-                destination_table_name
-            )
-            table_mappings.append((temp_destination_table_name, destination_table_name))
-            _make_temp_destination_table(
+            print(f"Table '{source_table_name}' unchanged, skipped.")
+            return
+
+    try:
+        destination_table_specs = list(
+            _iter_destination_table_specs(
                 client,
                 project_id,
+                source_dataset_id,
+                source_table_name,
                 destination_dataset_id,
-                temp_destination_table_name,
-                destination_table_spec,
+                config,
+                table_prefix,
             )
+        )
+        destination_table_names = [
+            f"{table_prefix}__{destination_table_spec['name']}"
+            for destination_table_spec in destination_table_specs
+            if destination_table_spec.get("action") != "drop"
+        ]
 
-        _add_demo_tables(
+        # M-Files tables of unchanged files are kept as they are, and tables
+        # of removed files are dropped once the other tables are replaced.
+        all_destination_table_specs = destination_table_specs
+        dropped_table_names = [
+            f"{table_prefix}__{destination_table_spec['name']}"
+            for destination_table_spec in destination_table_specs
+            if destination_table_spec.get("action") == "drop"
+        ] + _get_stale_shard_table_names(
+            client, project_id, destination_dataset_id, destination_table_names
+        )
+        destination_table_specs = [
+            destination_table_spec
+            for destination_table_spec in destination_table_specs
+            if "action" not in destination_table_spec
+        ]
+
+        if config.incremental and _merge_new_rows(
+            client,
             project_id,
+            destination_dataset_id,
             source_table_name,
             table_prefix,
-            destination_dataset_id,
+            destination_table_specs,
+            config,
+            dataset_budget,
+        ):
+            _finish_table(
+                client,
+                project_id,
+                source_dataset_id,
+                destination_dataset_id,
+                source_table_name,
+                table_prefix,
+                config,
+                [],
+                destination_table_names,
+                dropped_table_names,
+                all_destination_table_specs,
+                source_fingerprint_key,
+                source_fingerprint,
+            )
+            print(f"Table '{source_table_name}' merged incrementally.")
+            return
+
+        _check_bytes_budget(
             client,
-            source_dataset_id,
             source_table_name,
+            [
+                (
+                    _get_destination_table_query(destination_table_spec),
+                    destination_table_spec.get("query_parameters"),
+                )
+                for destination_table_spec in destination_table_specs
+                if "rows" not in destination_table_spec
+            ],
+            config,
+            dataset_budget,
         )
 
-        # Remove previous versions of the final tables.
-        for _, destination_table_name in table_mappings:
-            delete_table(
+        # CREATE OR REPLACE TABLE can't change the partitioning of a table,
+        # so tables whose layout changes are swapped even in "replace" mode.
+        swapped_table_names = set()
+        if config.materialization == "replace":
+            swapped_table_names = _get_changed_layout_table_names(
                 client,
                 project_id,
                 destination_dataset_id,
-                destination_table_name,
+                table_prefix,
+                destination_table_specs,
             )
 
-        # Rename temp tables to be the latest final tables.
-        # Note: This is done only after all tables have been removed (previous step),
-        # to prevent a state, in which both old and new tables exist simultaneously.
-        for temp_destination_table_name, destination_table_name in table_mappings:
-            rename_table(
-                client,
-                project_id,
-                destination_dataset_id,
-                temp_destination_table_name,
-                destination_table_name,
+        # Submit the jobs producing every table before waiting for any of them,
+        # so that the jobs run concurrently in BigQuery.
+        for destination_table_spec in destination_table_specs:
+            destination_table_name = f"{table_prefix}__{destination_table_spec['name']}"
+
+            # Rows parsed already (M-Files) are written with load jobs.
+            if "rows" in destination_table_spec:
+                if config.materialization == "replace":
+                    load_table_name = destination_table_name
+                    write_disposition = "WRITE_TRUNCATE"
+                else:
+                    load_table_name = get_unique_temp_table_name(destination_table_name)
+                    table_mappings.append((load_table_name, destination_table_name))
+                    write_disposition = "WRITE_EMPTY"
+                jobs.append(
+                    start_load_rows_to_table(
+                        client,
+                        project_id,
+                        destination_dataset_id,
+                        load_table_name,
+                        destination_table_spec["schema_list"],
+                        destination_table_spec["rows"],
+                        write_disposition,
+                    )
+                )
+                continue
+
+            # Query parameters can't be used in DDL, so parametrized specs
+            # (M-Files) always go through temp tables.
+            if (
+                config.materialization == "replace"
+                and not destination_table_spec.get("query_parameters")
+                and destination_table_name not in swapped_table_names
+            ):
+                jobs.append(
+                    start_create_or_replace_table_as_query(
+                        client,
+                        project_id,
+                        destination_dataset_id,
+                        destination_table_name,
+                        destination_table_spec["schema_list"],
+                        _get_destination_table_query(destination_table_spec),
+                        destination_table_spec.get("partition_field"),
+                        destination_table_spec.get("cluster_fields"),
+                    )
+                )
+                continue
+
+            temp_destination_table_name = get_unique_temp_table_name(
+                destination_table_name
             )
+            table_mappings.append((temp_destination_table_name, destination_table_name))
+            jobs.append(
+                _start_temp_destination_table(
+                    client,
+                    project_id,
+                    destination_dataset_id,
+                    temp_destination_table_name,
+                    destination_table_spec,
+                )
+            )
+        wait_for_jobs(jobs)
 
+        _finish_table(
+            client,
+            project_id,
+            source_dataset_id,
+            destination_dataset_id,
+            source_table_name,
+            table_prefix,
+            config,
+            table_mappings,
+            destination_table_names,
+            dropped_table_names,
+            all_destination_table_specs,
+            source_fingerprint_key,
+            source_fingerprint,
+        )
         print(f"Table '{source_table_name}' transformed.")
 
     except Exception as e:
@@ -132,16 +415,389 @@ def transform_table(
         raise e
 
 
-def _iter_destination_table_specs(
+def _finish_table(
     client,
     project_id,
     source_dataset_id,
+    destination_dataset_id,
     source_table_name,
+    table_prefix,
+    config,
+    table_mappings,
+    destination_table_names,
+    dropped_table_names,
+    all_destination_table_specs,
+    source_fingerprint_key,
+    source_fingerprint,
+):
+    """Publish the tables of a source table once they've been produced"""
+    _add_demo_tables(
+        project_id,
+        source_table_name,
+        table_prefix,
+        destination_dataset_id,
+        client,
+        source_dataset_id,
+        source_table_name,
+    )
+
+    # Replace previous versions of the final tables with the temp tables.
+    replace_tables(client, project_id, destination_dataset_id, table_mappings)
+    for dropped_table_name in dropped_table_names:
+        delete_table(client, project_id, destination_dataset_id, dropped_table_name)
+
+    if config.state_store is not None:
+        record_file_fingerprints(config.state_store, all_destination_table_specs)
+    _record_source_fingerprint(
+        config.state_store,
+        source_fingerprint_key,
+        source_fingerprint,
+        _get_output_options_hash(config),
+        destination_table_names,
+    )
+
+
+def _is_source_unchanged(
+    client,
+    project_id,
+    destination_dataset_id,
+    previous_state,
+    source_fingerprint,
+    options_hash,
+):
+    if previous_state is None or source_fingerprint is None:
+        return False
+    if previous_state["fingerprint"] != source_fingerprint:
+        return False
+    if previous_state.get("options_hash") != options_hash:
+        return False
+    existing_table_names = set(
+        get_dataset_table_names(client, project_id, destination_dataset_id)
+    )
+    return all(
+        table_name in existing_table_names
+        for table_name in previous_state["destination_tables"]
+    )
+
+
+def _record_source_fingerprint(
+    state_store,
+    source_fingerprint_key,
+    source_fingerprint,
+    options_hash,
+    destination_table_names,
+):
+    if state_store is None or source_fingerprint is None:
+        return
+    state_store.set(
+        source_fingerprint_key,
+        {
+            "fingerprint": source_fingerprint,
+            "options_hash": options_hash,
+            "destination_tables": destination_table_names,
+        },
+    )
+
+
+def _get_output_options_hash(config):
+    """Return a hash of the options that change the produced tables
+
+    The hash also covers `OUTPUT_VERSION`, so that upgrades changing the
+    produced tables rebuild tables whose source hasn't changed.
+    """
+    options = {
+        option.name: getattr(config, option.name)
+        for option in dataclasses.fields(config)
+        if option.name not in _NON_OUTPUT_OPTION_NAMES
+    }
+    options["output_version"] = OUTPUT_VERSION
+    return hashlib.sha256(
+        json.dumps(options, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def plan_dataset(
+    client: bigquery.Client,
+    project_id: str,
+    source_dataset_id: str,
+    destination_dataset_id: str,
+    table_prefix: str,
+    config: CleanConfig | None = None,
+) -> dict:
+    """Return what `transform_dataset` would do, without changing anything
+
+    See `plan_table` for the details.
+    """
+    config = config or CleanConfig()
+    source_tables = sorted(
+        get_dataset_tables(
+            client, project_id, source_dataset_id, config.max_concurrent_tables
+        ),
+        key=lambda table: table.num_bytes or 0,
+        reverse=True,
+    )
+    with ThreadPoolExecutor(max_workers=config.max_concurrent_tables) as executor:
+        table_plans = list(
+            executor.map(
+                lambda source_table: plan_table(
+                    client,
+                    project_id,
+                    source_dataset_id,
+                    destination_dataset_id,
+                    source_table.table_id,
+                    table_prefix,
+                    config,
+                ),
+                source_tables,
+            )
+        )
+
+    return {
+        "source_dataset": source_dataset_id,
+        "destination_dataset": destination_dataset_id,
+        "tables": table_plans,
+        "bytes_processed": sum(plan["bytes_processed"] for plan in table_plans),
+    }
+
+
+def plan_table(
+    client: bigquery.Client,
+    project_id: str,
+    source_dataset_id: str,
+    destination_dataset_id: str,
+    source_table_name: str,
+    table_prefix: str,
+    config: CleanConfig | None = None,
+) -> dict:
+    """Return the destination tables `transform_table` would create
+
+    For each destination table, the plan contains its column count and the
+    bytes its query would process, estimated with a dry-run job. Destination
+    tables depend on the inferred JSON schemas, so schema inference still
+    runs its (sampling) queries.
+    """
+    destination_tables = [
+        {
+            "name": f"{table_prefix}__{destination_table_spec['name']}",
+            "column_count": len(destination_table_spec["schema_list"]),
+            "bytes_processed": (
+                # Load jobs don't process bytes.
+                0
+                if "rows" in destination_table_spec
+                else dry_run_query(
+                    client,
+                    _get_destination_table_query(destination_table_spec),
+                    destination_table_spec.get("query_parameters"),
+                )
+            ),
+        }
+        for destination_table_spec in _iter_destination_table_specs(
+            client,
+            project_id,
+            source_dataset_id,
+            source_table_name,
+            destination_dataset_id,
+            config,
+            table_prefix,
+        )
+        if "action" not in destination_table_spec
+    ]
+    return {
+        "source_table": source_table_name,
+        "destination_tables": destination_tables,
+        "bytes_processed": sum(
+            table["bytes_processed"] for table in destination_tables
+        ),
+    }
+
+
+def _check_bytes_budget(client, source_table_name, queries, config, dataset_budget):
+    """Raise BytesBudgetExceeded if the queries would process too many bytes
+
+    `queries` is a list of (query, query_parameters) pairs, which are
+    estimated with dry-run jobs only when a budget is configured.
+    """
+    maximum_bytes_per_table = config.maximum_bytes_billed_per_table
+    if maximum_bytes_per_table is None and (
+        dataset_budget is None or dataset_budget.maximum_bytes is None
+    ):
+        return
+
+    num_bytes = sum(
+        dry_run_query(client, query, query_parameters)
+        for query, query_parameters in queries
+    )
+    if maximum_bytes_per_table is not None and num_bytes > maximum_bytes_per_table:
+        raise BytesBudgetExceeded(
+            f"Table '{source_table_name}' would process {num_bytes} bytes, "
+            f"exceeding the table budget of {maximum_bytes_per_table} bytes."
+        )
+    if dataset_budget is not None:
+        dataset_budget.reserve(num_bytes, f"Table '{source_table_name}'")
+
+
+def _merge_new_rows(
+    client,
+    project_id,
     destination_dataset_id,
+    source_table_name,
+    table_prefix,
+    destination_table_specs,
+    config,
+    dataset_budget,
 ):
-    source_schema = get_table_schema(
-        client, project_id, source_dataset_id, source_table_name
+    """Merge rows extracted after the previous run into the existing tables
+
+    The watermark is the latest `_row_extracted_at` of each destination table,
+    so no separate state needs to be stored. Return False, without changing
+    anything, if the tables have to be rebuilt instead: a table is missing,
+    the main table is empty, the columns of a table differ from the newly
+    inferred ones (in any order), the spec can't be filtered by extraction
+    time (e.g. M-Files tables), or the source isn't append only.
+    """
+    if not destination_table_specs:
+        return False
+
+    destination_table_names = []
+    destination_tables = []
+    for destination_table_spec in destination_table_specs:
+        incremental_column = destination_table_spec.get("incremental_column")
+        if incremental_column is None:
+            return False
+
+        destination_table_name = f"{table_prefix}__{destination_table_spec['name']}"
+        destination_table = get_table_or_none(
+            client, project_id, destination_dataset_id, destination_table_name
+        )
+        # The order of JSON keys depends on the sample, so columns are
+        # compared, and merged, by name.
+        if destination_table is None or not are_schemas_equal(
+            destination_table.schema,
+            destination_table_spec["schema_list"],
+            ignore_column_order=True,
+        ):
+            return False
+        if get_table_layout(destination_table) != (
+            destination_table_spec.get("partition_field"),
+            destination_table_spec.get("cluster_fields") or None,
+        ):
+            return False
+
+        destination_table_names.append(destination_table_name)
+        destination_tables.append(destination_table)
+
+    watermarks = get_max_column_values(
+        client,
+        project_id,
+        destination_dataset_id,
+        destination_table_names,
+        clean_name(incremental_column),
+    )
+    # A subtable is empty if no source row up to the main table's watermark
+    # had array items, so the main table's watermark is used for it.
+    main_watermark = next(
+        (
+            watermarks[destination_table_name]
+            for destination_table_name, destination_table_spec in zip(
+                destination_table_names, destination_table_specs
+            )
+            if destination_table_spec.get("array_column") is None
+        ),
+        None,
     )
+    for destination_table_name, destination_table_spec in zip(
+        destination_table_names, destination_table_specs
+    ):
+        if (
+            watermarks[destination_table_name] is None
+            and destination_table_spec.get("array_column") is not None
+        ):
+            watermarks[destination_table_name] = main_watermark
+    if any(watermark is None for watermark in watermarks.values()):
+        return False
+
+    # Merging only adds rows, which is correct only if the source is append
+    # only. Sources that are overwritten or deduplicated (e.g. Airbyte's full
+    # refresh and deduped sync modes) replace or remove rows that have already
+    # been merged, which shows as a main table row count that differs from the
+    # number of source rows up to the watermark.
+    source_row_counts = {}
+    for destination_table_name, destination_table_spec, destination_table in zip(
+        destination_table_names, destination_table_specs, destination_tables
+    ):
+        if destination_table_spec.get("array_column") is not None:
+            continue
+        source_table_ref = destination_table_spec.get("source_table_ref")
+        if source_table_ref is None:
+            continue
+        watermark = watermarks[destination_table_name]
+        if watermark not in source_row_counts:
+            source_row_counts[watermark] = count_rows_up_to(
+                client,
+                source_table_ref,
+                destination_table_spec["incremental_column"],
+                watermark,
+            )
+        if source_row_counts[watermark] != destination_table.num_rows:
+            print(
+                f"Rows of '{source_table_name}' have been replaced or removed "
+                "since the previous run, so its tables are rebuilt."
+            )
+            return False
+
+    queries = [
+        (
+            _get_destination_table_query(
+                destination_table_spec,
+                f"`{destination_table_spec['incremental_column']}` > @watermark",
+            ),
+            [
+                bigquery.ScalarQueryParameter(
+                    "watermark", "TIMESTAMP", watermarks[destination_table_name]
+                )
+            ],
+        )
+        for destination_table_name, destination_table_spec in zip(
+            destination_table_names, destination_table_specs
+        )
+    ]
+    _check_bytes_budget(client, source_table_name, queries, config, dataset_budget)
+
+    jobs = [
+        start_merge_query_result_to_table(
+            client,
+            project_id,
+            destination_dataset_id,
+            destination_table_name,
+            query,
+            [
+                schema_field.name
+                for schema_field in destination_table_spec["schema_list"]
+            ],
+            destination_table_spec.get("merge_key"),
+            query_parameters,
+        )
+        for destination_table_name, destination_table_spec, (
+            query,
+            query_parameters,
+        ) in zip(destination_table_names, destination_table_specs, queries)
+    ]
+    wait_for_jobs(jobs)
+    return True
+
+
+def _iter_destination_table_specs(
+    client,
+    project_id,
+    source_dataset_id,
+    source_table_name,
+    destination_dataset_id,
+    config=None,
+    table_prefix=None,
+):
+    config = config or CleanConfig()
+    source_table = get_table(client, project_id, source_dataset_id, source_table_name)
+    source_schema = source_table.schema
     should_unnest_objects = _should_unnest_objects(source_dataset_id)
     transformed_schema = transform_table_schema(
         source_schema,
@@ -150,33 +806,73 @@ def _iter_destination_table_specs(
         source_dataset_id,
         source_table_name,
         should_unnest_objects,
+        config,
     )
 
     source_table_ref = f"{project_id}.{source_dataset_id}.{source_table_name}"
+    join_key_name = get_join_key_name(source_table_name)
+    incremental_column = (
+        "_airbyte_extracted_at"
+        if any(field.name == "_airbyte_extracted_at" for field in source_schema)
+        else None
+    )
 
     # Main table.
-    yield {
-        "name": convert_to_snake_case(transformed_schema["table_name"]),
+    main_table_name = convert_to_snake_case(transformed_schema["table_name"])
+    main_table_spec = {
+        "name": main_table_name,
         "schema_list": transformed_schema["fields"],
         "query_select_list": transformed_schema["select_list"],
-        "query_from": f"""
-            `{source_table_ref}`
-        """,
+        "query_from": _get_query_from(f"`{source_table_ref}`"),
+        "source_table_ref": source_table_ref,
+        "array_column": None,
+        "incremental_column": incremental_column,
+        "merge_key": (
+            join_key_name
+            if any(
+                field.name == join_key_name for field in transformed_schema["fields"]
+            )
+            else None
+        ),
+        **_get_destination_table_layout(
+            main_table_name,
+            transformed_schema["fields"],
+            [],
+            source_table.num_bytes,
+            config,
+        ),
     }
+    yield from _shard_destination_table_spec(
+        main_table_spec, config.max_columns_per_table, join_key_name
+    )
 
     # Subtables.
     if are_subtables_enabled(source_dataset_id):
         for subtable_schema in transformed_schema["subtables"]:
             json_column_name = subtable_schema["json_column_name"]
-            yield {
-                "name": convert_to_snake_case(subtable_schema["table_name"]),
+            subtable_name = convert_to_snake_case(subtable_schema["table_name"])
+            subtable_spec = {
+                "name": subtable_name,
                 "schema_list": subtable_schema["fields"],
                 "query_select_list": subtable_schema["select_list"],
-                "query_from": f"""
-                    `{source_table_ref}`
-                    CROSS JOIN UNNEST(JSON_EXTRACT_ARRAY(`{json_column_name}`)) AS array_item
-                """,
+                "query_from": _get_query_from(
+                    f"`{source_table_ref}`", json_column_name
+                ),
+                "source_table_ref": source_table_ref,
+                "array_column": json_column_name,
+                "incremental_column": incremental_column,
+                "merge_key": join_key_name,
+                **_get_destination_table_layout(
+                    subtable_name,
+                    subtable_schema["fields"],
+                    [join_key_name] if config.cluster_subtables else [],
+                    source_table.num_bytes,
+                    config,
+                ),
             }
+            yield from _shard_destination_table_spec(
+                subtable_spec, config.max_columns_per_table, join_key_name
+            )
 
     # M-Files file content tables.
     if "m_files" in source_dataset_id and source_table_name == "objects_files_contents":
@@ -189,23 +885,193 @@ def _iter_destination_table_specs(
             ["ObjectType", "ObjectID", "FileID"],
             "FileName",
             "ContentJson",
+            config,
+            table_prefix,
+        )
+
+
+def _shard_destination_table_spec(destination_table_spec, max_columns, join_key_name):
+    """Yield the spec, split into vertical shards if it has too many columns
+
+    Every shard gets the join key, which is unique per row of a main table,
+    and `_row_extracted_at` if the table has it, so that shards can be joined
+    back together and merged incrementally. Shards of a subtable also get the
+    offset of the item in its array, as the join key is only unique per
+    array. The other columns are assigned to shards in schema order.
+    """
+    columns = list(
+        zip(
+            destination_table_spec["schema_list"],
+            destination_table_spec["query_select_list"],
+        )
+    )
+    if max_columns is None or len(columns) <= max_columns:
+        yield destination_table_spec
+        return
+
+    key_columns = [
+        next(
+            (column for column in columns if column[0].name == join_key_name),
+            (
+                bigquery.SchemaField(join_key_name, "STRING", mode="REQUIRED"),
+                "_airbyte_raw_id",
+            ),
+        )
+    ]
+    if destination_table_spec.get("array_column") is not None:
+        key_columns.append(
+            (
+                bigquery.SchemaField(
+                    ARRAY_OFFSET_COLUMN_NAME, "INT64", mode="REQUIRED"
+                ),
+                "array_offset",
+            )
         )
+    key_columns += [
+        column for column in columns if column[0].name == "_row_extracted_at"
+    ]
+    key_column_names = {field.name for field, _ in key_columns}
+    other_columns = [
+        column for column in columns if column[0].name not in key_column_names
+    ]
+    shard_size = max_columns - len(key_columns)
+    if shard_size < 1:
+        raise ValueError(f"Column budget {max_columns} is too small for shards.")
+
+    for shard_index, start in enumerate(range(0, len(other_columns), shard_size)):
+        shard_columns = key_columns + other_columns[start : start + shard_size]
+        yield {
+            **destination_table_spec,
+            "name": (
+                destination_table_spec["name"]
+                if shard_index == 0
+                else f"{destination_table_spec['name']}__part_{shard_index + 1}"
+            ),
+            "schema_list": [field for field, _ in shard_columns],
+            "query_select_list": [select_str for _, select_str in shard_columns],
+            "merge_key": join_key_name,
+        }
+
+
+def _get_stale_shard_table_names(
+    client, project_id, destination_dataset_id, destination_table_names
+):
+    """Return the shards of the tables that are no longer produced
+
+    For example, a table has fewer shards after its columns were removed or
+    the column budget was raised.
+    """
+    produced_table_names = set(destination_table_names)
+    stale_table_names = []
+    for table_name in get_dataset_table_names(
+        client, project_id, destination_dataset_id
+    ):
+        shard = re.fullmatch(r"(.+)__part_\d+", table_name)
+        if (
+            shard is not None
+            and shard.group(1) in produced_table_names
+            and table_name not in produced_table_names
+        ):
+            stale_table_names.append(table_name)
+    return stale_table_names
+
 
+def _get_query_from(source, array_column=None):
+    """Return the FROM clause of a main table, or of a subtable of `array_column`"""
+    if array_column is None:
+        return source
+    return f"""
+        {source}
+        CROSS JOIN UNNEST(JSON_EXTRACT_ARRAY(`{array_column}`)) AS array_item
+        WITH OFFSET AS array_offset
+    """
+
+
+def _get_changed_layout_table_names(
+    client,
+    project_id,
+    destination_dataset_id,
+    table_prefix,
+    destination_table_specs,
+):
+    """Return names of existing tables whose partitioning or clustering changes"""
+    existing_layouts = get_dataset_table_layouts(
+        client, project_id, destination_dataset_id
+    )
+    changed_table_names = set()
+    for destination_table_spec in destination_table_specs:
+        destination_table_name = f"{table_prefix}__{destination_table_spec['name']}"
+        existing_layout = existing_layouts.get(destination_table_name)
+        if existing_layout is not None and existing_layout != (
+            destination_table_spec.get("partition_field"),
+            destination_table_spec.get("cluster_fields") or None,
+        ):
+            changed_table_names.add(destination_table_name)
+    return changed_table_names
+
+
+def _get_destination_table_layout(
+    table_name,
+    schema_list,
+    default_cluster_fields,
+    source_num_bytes,
+    config,
+):
+    """Return partitioning and clustering for a destination table spec
+
+    Tables are partitioned by day on `_row_extracted_at` when the source table
+    is at least `config.partition_min_bytes` big, so that small tables don't
+    end up with lots of tiny partitions. `config.table_layouts` overrides this
+    per destination table.
+    """
+    if table_name in config.table_layouts:
+        table_layout = config.table_layouts[table_name]
+        return {
+            "partition_field": table_layout.get("partition_field"),
+            "cluster_fields": table_layout.get("cluster_fields") or [],
+        }
+
+    should_partition = (
+        config.partition_min_bytes is not None
+        and (source_num_bytes or 0) >= config.partition_min_bytes
+        and any(field.name == "_row_extracted_at" for field in schema_list)
+    )
+    return {
+        "partition_field": "_row_extracted_at" if should_partition else None,
+        "cluster_fields": default_cluster_fields,
+    }
 
-def _make_temp_destination_table(
+
+def _start_temp_destination_table(
     client,
     project_id,
     destination_dataset_id,
     temp_destination_table_name,
     destination_table_spec,
 ):
+    """Create the temp table and return its (still running) insert job"""
     create_table_with_schema(
         client,
         project_id,
         destination_dataset_id,
         temp_destination_table_name,
         schema=destination_table_spec["schema_list"],
+        partition_field=destination_table_spec.get("partition_field"),
+        cluster_fields=destination_table_spec.get("cluster_fields"),
+    )
+    destination_table_query = _get_destination_table_query(destination_table_spec)
+    query_parameters = destination_table_spec.get("query_parameters", [])
+    return start_insert_query_result_to_table(
+        client,
+        project_id,
+        destination_dataset_id,
+        temp_destination_table_name,
+        destination_table_query,
+        query_parameters,
     )
+
+
+def _get_destination_table_query(destination_table_spec, query_where=None):
     query_select = ", \n".join(
         f"{query_select_expr} AS `{schema_field.name}`"
         for query_select_expr, schema_field in zip(
@@ -214,19 +1080,11 @@ def _make_temp_destination_table(
         )
     )
     query_from = destination_table_spec["query_from"]
-    destination_table_query = f"""
+    return f"""
         SELECT {query_select}
         FROM {query_from}
+        {f"WHERE {query_where}" if query_where else ""}
     """
-    query_parameters = destination_table_spec.get("query_parameters", [])
-    insert_query_result_to_table(
-        client,
-        project_id,
-        destination_dataset_id,
-        temp_destination_table_name,
-        destination_table_query,
-        query_parameters,
-    )
 
 
 def _add_demo_tables(
@@ -18,6 +18,7 @@ def transform_table_schema(
     source_dataset_id,
     table_name,
     should_unnest_objects,
+    config=None,
 ):
     """Return transformed schema metadata for given table
 
@@ -35,6 +36,7 @@ def transform_table_schema(
         source_dataset_id,
         table_name,
         should_unnest_objects,
+        config,
     )
 
     sub = []
@@ -68,6 +70,7 @@ def get_new_schema(
     source_dataset_id,
     table_name,
     should_unnest_objects,
+    config=None,
 ):
     """Return list of dicts containing new fields and some metadata"""
     table_ref = f"{project_id}.{source_dataset_id}.{table_name}"
@@ -84,14 +87,29 @@ def get_new_schema(
     json_columns = [
         field.name for field in filtered_schema if field.field_type == "JSON"
     ]
+    incremental_column = (
+        "_airbyte_extracted_at"
+        if any(field.name == "_airbyte_extracted_at" for field in filtered_schema)
+        else None
+    )
     json_column_schemas = infer_columns_from_json_by_sampling(
-        client, json_columns, table_ref, should_unnest_objects
+        client,
+        json_columns,
+        table_ref,
+        should_unnest_objects,
+        config,
+        incremental_column,
     )
 
+    # Wide tables are selected with shorter expressions, see `get_select_str`.
+    compact_sql = config is not None and config.max_columns_per_table is not None
+
     new_schema = []
     subtables = {}
     for field in filtered_schema:
-        new_fields, field_subtables = map_to_new_fields(field, json_column_schemas)
+        new_fields, field_subtables = map_to_new_fields(
+            field, json_column_schemas, compact_sql
+        )
         new_schema.extend(new_fields)
         subtables.update(field_subtables)
 
@@ -118,7 +136,7 @@ def _get_field_sort_key(field):
     return 1
 
 
-def map_to_new_fields(original_field, json_column_schemas):
+def map_to_new_fields(original_field, json_column_schemas, compact_sql=False):
     new_fields = []
     subtables = {}
 
@@ -168,6 +186,7 @@ def map_to_new_fields(original_field, json_column_schemas):
                 data_type,
                 json_key,
                 special_data_type,
+                compact_sql,
             )
 
             mode = metadata["mode"]
@@ -196,7 +215,10 @@ def map_to_new_fields(original_field, json_column_schemas):
                             ),
                             "json_key": col_name,
                             "select_str": _get_json_extract_select_str(
-                                "array_item", col_name, col_metadata["data_type"]
+                                "array_item",
+                                col_name,
+                                col_metadata["data_type"],
+                                compact_sql,
                             ),
                         }
                         for col_name, col_metadata in metadata.get(
@@ -280,14 +302,21 @@ def clean_name(name):
     return slugified
 
 
+_SLUG_PATTERN = re.compile(r"[a-z0-9_]*")
+
+
 def _custom_slugify(text):
     """Slugify text without messing with underscores"""
-    parts = re.split(r"(_+)", text)
-    slugified_parts = [
-        slugify(part, separator="_") if not part.startswith("_") else part
-        for part in parts
-    ]
-    slugified_text = "".join(slugified_parts)
+    if _SLUG_PATTERN.fullmatch(text):
+        # Most names are already slugs, and slugifying them is slow.
+        slugified_text = text
+    else:
+        parts = re.split(r"(_+)", text)
+        slugified_parts = [
+            slugify(part, separator="_") if not part.startswith("_") else part
+            for part in parts
+        ]
+        slugified_text = "".join(slugified_parts)
 
     # Make sure there are no more than two subsequent underscores.
     extra_underscores_removed = re.sub(r"_{3,}", "__", slugified_text)
@@ -295,10 +324,16 @@ def _custom_slugify(text):
     return extra_underscores_removed
 
 
-def get_select_str(original_field_name, json_field_type, json_key, special_data_type):
+def get_select_str(
+    original_field_name,
+    json_field_type,
+    json_key,
+    special_data_type,
+    compact_sql=False,
+):
     if json_key:
         select_str = _get_json_extract_select_str(
-            original_field_name, json_key, json_field_type
+            original_field_name, json_key, json_field_type, compact_sql
         )
         if select_str:
             return select_str
@@ -308,8 +343,15 @@ def get_select_str(original_field_name, json_field_type, json_key, special_data_
     return f"`{original_field_name}`"
 
 
-def _get_json_extract_select_str(original_field_name, json_key, json_field_type):
-    selection = f"""JSON_EXTRACT(`{original_field_name}`, "$['{json_key}']")"""
+def _get_json_extract_select_str(
+    original_field_name, json_key, json_field_type, compact_sql=False
+):
+    if compact_sql:
+        # The JSON subscript operator is equivalent and about half as long,
+        # which matters when a query selects thousands of keys.
+        selection = f"`{original_field_name}`['{json_key}']"
+    else:
+        selection = f"""JSON_EXTRACT(`{original_field_name}`, "$['{json_key}']")"""
     type_conversion_func = (
         f"LAX_{json_field_type}"
         if json_field_type in ("INT64", "BOOL", "FLOAT64", "STRING")
@@ -338,11 +380,13 @@ def _add_extra_fields(schema, table_name, project_id):
     return schema
 
 
+def get_join_key_name(table_name):
+    return f"_quickbi_{table_name}_join_key"
+
+
 def _add_join_key(obj, table_name):
     obj["fields"] = [
-        bigquery.SchemaField(
-            f"_quickbi_{table_name}_join_key", "STRING", mode="REQUIRED"
-        )
+        bigquery.SchemaField(get_join_key_name(table_name), "STRING", mode="REQUIRED")
     ] + obj["fields"]
     obj["select_list"] = ["_airbyte_raw_id"] + obj["select_list"]
     return obj
@@ -1,7 +1,20 @@
-from typing import Generator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, Iterable, Mapping
 
+from google.api_core.exceptions import NotFound
 from google.cloud import bigquery
 
+from ..telemetry import label_job_config, start_query, track_job
+
+# The API returns legacy names for some types, while the inferred schemas use
+# the standard SQL names.
+LEGACY_TYPE_NAMES = {
+    "INTEGER": "INT64",
+    "FLOAT": "FLOAT64",
+    "BOOLEAN": "BOOL",
+    "RECORD": "STRUCT",
+}
+
 
 def insert_query_result_to_table(
     client: bigquery.Client,
@@ -13,18 +26,246 @@ def insert_query_result_to_table(
         bigquery.ArrayQueryParameter
         | bigquery.ScalarQueryParameter
         | bigquery.StructQueryParameter
-    ],
+    ]
+    | None = None,
 ):
+    start_insert_query_result_to_table(
+        client, project_id, dataset_id, table_name, query, query_parameters
+    ).result()
+
+
+def start_insert_query_result_to_table(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+    query: str,
+    query_parameters: list[
+        bigquery.ArrayQueryParameter
+        | bigquery.ScalarQueryParameter
+        | bigquery.StructQueryParameter
+    ]
+    | None = None,
+) -> bigquery.QueryJob:
+    """Submit the insert job without waiting for it to finish"""
     table_ref = f"{project_id}.{dataset_id}.{table_name}"
-    client.query(
+    return start_query(
+        client,
         query,
-        job_config=bigquery.QueryJobConfig(
+        bigquery.QueryJobConfig(
             destination=table_ref,
             create_disposition="CREATE_NEVER",
             write_disposition="WRITE_EMPTY",
-            query_parameters=query_parameters,
+            query_parameters=query_parameters or [],
         ),
-    ).result()
+        stage="materialize",
+    )
+
+
+def start_merge_query_result_to_table(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+    query: str,
+    column_names: list[str],
+    merge_key: str | None,
+    query_parameters: list[
+        bigquery.ArrayQueryParameter
+        | bigquery.ScalarQueryParameter
+        | bigquery.StructQueryParameter
+    ]
+    | None = None,
+) -> bigquery.QueryJob:
+    """Insert query result rows whose `merge_key` isn't yet in the table
+
+    Without a `merge_key` every row of the query result is inserted. The
+    query must select the `column_names` of the table, in any order.
+    """
+    table_ref = f"{project_id}.{dataset_id}.{table_name}"
+    merge_condition = (
+        f"target.`{merge_key}` = source.`{merge_key}`" if merge_key else "FALSE"
+    )
+    columns = ", ".join(f"`{column_name}`" for column_name in column_names)
+    merge_query = f"""
+        MERGE `{table_ref}` AS target
+        USING ({query}) AS source
+        ON {merge_condition}
+        WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({columns})
+    """
+    return start_query(
+        client,
+        merge_query,
+        bigquery.QueryJobConfig(query_parameters=query_parameters or []),
+        stage="merge",
+    )
+
+
+def query_rows(
+    client: bigquery.Client,
+    query: str,
+    job_config: bigquery.QueryJobConfig | None = None,
+    transport: str = "rest",
+    stage: str = "query",
+) -> tuple[bigquery.QueryJob, Iterable[Mapping]]:
+    """Start a query and return the job and an iterable over its result rows
+
+    With the "rest" transport rows are paged through the REST API. With
+    "storage" they're streamed as Arrow record batches through the BigQuery
+    Storage Read API, which is several times faster for large results.
+    "storage" requires the `google-cloud-bigquery-storage` and `pyarrow`
+    packages.
+    """
+    job = start_query(client, query, job_config, stage=stage)
+    if transport == "rest":
+        return job, job
+    elif transport == "storage":
+        bqstorage_client = client._ensure_bqstorage_client()
+        if bqstorage_client is None:
+            raise RuntimeError(
+                "The storage transport requires google-cloud-bigquery-storage "
+                "and pyarrow to be installed."
+            )
+        return job, _iter_arrow_rows(job, bqstorage_client)
+
+    raise ValueError(f"Unknown transport: {transport}")
+
+
+def _iter_arrow_rows(job, bqstorage_client):
+    for record_batch in job.result().to_arrow_iterable(
+        bqstorage_client=bqstorage_client
+    ):
+        yield from record_batch.to_pylist()
+
+
+def start_load_rows_to_table(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+    schema: list[bigquery.SchemaField],
+    rows: list[dict],
+    write_disposition: str = "WRITE_EMPTY",
+) -> bigquery.LoadJob:
+    """Start a load job writing the rows, as newline-delimited JSON, to a table
+
+    The table is created with `schema` if it doesn't exist. Load jobs aren't
+    billed for bytes processed like queries are.
+    """
+    table_ref = f"{project_id}.{dataset_id}.{table_name}"
+    job = client.load_table_from_json(
+        rows,
+        table_ref,
+        job_config=label_job_config(
+            bigquery.LoadJobConfig(
+                schema=schema,
+                create_disposition="CREATE_IF_NEEDED",
+                write_disposition=write_disposition,
+            ),
+            "load",
+        ),
+    )
+    track_job(job)
+    return job
+
+
+def dry_run_query(
+    client: bigquery.Client,
+    query: str,
+    query_parameters: list[
+        bigquery.ArrayQueryParameter
+        | bigquery.ScalarQueryParameter
+        | bigquery.StructQueryParameter
+    ]
+    | None = None,
+) -> int:
+    """Return the number of bytes the query would process, without running it"""
+    job = start_query(
+        client,
+        query,
+        bigquery.QueryJobConfig(
+            dry_run=True,
+            use_query_cache=False,
+            query_parameters=query_parameters or [],
+        ),
+        stage="dry_run",
+    )
+    return job.total_bytes_processed or 0
+
+
+def wait_for_jobs(jobs: list[bigquery.QueryJob]):
+    """Wait for every job to finish and then raise the first error, if any"""
+    errors = []
+    for job in jobs:
+        try:
+            job.result()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def start_create_or_replace_table_as_query(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+    schema: list[bigquery.SchemaField],
+    query: str,
+    partition_field: str | None = None,
+    cluster_fields: list[str] | None = None,
+) -> bigquery.QueryJob:
+    """Replace the table atomically with the query result, in a single job
+
+    The columns are declared explicitly, so the table gets exactly the given
+    schema regardless of the types the query would otherwise produce.
+    """
+    table_ref = f"{project_id}.{dataset_id}.{table_name}"
+    column_definitions = ",\n".join(
+        f"`{field.name}` {get_column_type_ddl(field)}" for field in schema
+    )
+    partition_by = ""
+    if partition_field:
+        partition_field_type = next(
+            LEGACY_TYPE_NAMES.get(field.field_type, field.field_type)
+            for field in schema
+            if field.name == partition_field
+        )
+        partition_by = {
+            "DATE": f"PARTITION BY `{partition_field}`",
+            "DATETIME": f"PARTITION BY DATETIME_TRUNC(`{partition_field}`, DAY)",
+            "TIMESTAMP": f"PARTITION BY TIMESTAMP_TRUNC(`{partition_field}`, DAY)",
+        }[partition_field_type]
+    cluster_by = (
+        f"CLUSTER BY {', '.join(f'`{field}`' for field in cluster_fields)}"
+        if cluster_fields
+        else ""
+    )
+    ddl = f"""
+        CREATE OR REPLACE TABLE `{table_ref}` (
+            {column_definitions}
+        )
+        {partition_by}
+        {cluster_by}
+        AS {query}
+    """
+    return start_query(client, ddl, stage="materialize")
+
+
+def get_column_type_ddl(field: bigquery.SchemaField) -> str:
+    field_type = LEGACY_TYPE_NAMES.get(field.field_type, field.field_type)
+    if field_type == "STRUCT":
+        subfield_definitions = ", ".join(
+            f"`{subfield.name}` {get_column_type_ddl(subfield)}"
+            for subfield in field.fields
+        )
+        field_type = f"STRUCT<{subfield_definitions}>"
+
+    if field.mode == "REPEATED":
+        return f"ARRAY<{field_type}>"
+    if field.mode == "REQUIRED":
+        return f"{field_type} NOT NULL"
+    return field_type
 
 
 def create_table_with_schema(
@@ -33,9 +274,17 @@ def create_table_with_schema(
     dataset_id: str,
     table_name: str,
     schema: list[bigquery.SchemaField] | None,
+    partition_field: str | None = None,
+    cluster_fields: list[str] | None = None,
 ):
     table_ref = f"{project_id}.{dataset_id}.{table_name}"
     table = bigquery.Table(table_ref, schema)
+    if partition_field:
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=partition_field
+        )
+    if cluster_fields:
+        table.clustering_fields = cluster_fields
     client.create_table(table)
 
 
@@ -60,18 +309,183 @@ def rename_table(
         ALTER TABLE `{project_id}.{dataset_id}.{old_table_name}`
         RENAME TO `{new_table_name}`
     """
-    client.query(query).result()
+    start_query(client, query, stage="swap").result()
 
 
-def get_table_schema(
+def replace_tables(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_mappings: list[tuple[str, str]],
+):
+    """Replace tables with other tables using one script job
+
+    `table_mappings` is a list of (new_table_name, table_name) pairs. All of
+    the old tables are dropped before any of the new tables is renamed, to
+    prevent a state in which both old and new tables exist simultaneously.
+    BigQuery transactions can't contain DDL, so the script isn't atomic, but
+    running it as one job makes the window between the first and the last
+    statement short.
+    """
+    if not table_mappings:
+        return
+
+    drop_statements = "\n".join(
+        f"DROP TABLE IF EXISTS `{project_id}.{dataset_id}.{table_name}`;"
+        for _, table_name in table_mappings
+    )
+    rename_statements = "\n".join(
+        f"ALTER TABLE `{project_id}.{dataset_id}.{new_table_name}` "
+        f"RENAME TO `{table_name}`;"
+        for new_table_name, table_name in table_mappings
+    )
+    start_query(
+        client, f"{drop_statements}\n{rename_statements}", stage="swap"
+    ).result()
+
+
+def get_table_or_none(
     client: bigquery.Client,
     project_id: str,
     dataset_id: str,
     table_name: str,
-) -> list[bigquery.SchemaField]:
+) -> bigquery.Table | None:
+    table_ref = f"{project_id}.{dataset_id}.{table_name}"
+    try:
+        return client.get_table(table_ref)
+    except NotFound:
+        return None
+
+
+def get_table_fingerprint(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+) -> dict | None:
+    """Return table metadata that changes whenever the table's data changes
+
+    Return None if the metadata can't be trusted for that: views don't track
+    changes to their underlying tables, and rows in the streaming buffer
+    aren't reflected in `num_rows`/`num_bytes`.
+    """
     table_ref = f"{project_id}.{dataset_id}.{table_name}"
     table = client.get_table(table_ref)
-    return table.schema
+    if table.table_type != "TABLE" or table.streaming_buffer is not None:
+        return None
+    return {
+        "modified": table.modified.isoformat(),
+        "num_rows": table.num_rows,
+        "num_bytes": table.num_bytes,
+    }
+
+
+def are_schemas_equal(
+    schema1: list[bigquery.SchemaField],
+    schema2: list[bigquery.SchemaField],
+    ignore_column_order: bool = False,
+) -> bool:
+    """Compare column names, types and modes (including nested fields)
+
+    With `ignore_column_order` the top level columns may be in any order, the
+    fields of records still have to be in the same order.
+    """
+
+    def get_signature(schema):
+        return [
+            (
+                field.name,
+                LEGACY_TYPE_NAMES.get(field.field_type, field.field_type),
+                field.mode or "NULLABLE",
+                get_signature(field.fields),
+            )
+            for field in schema
+        ]
+
+    if ignore_column_order:
+        return sorted(get_signature(schema1)) == sorted(get_signature(schema2))
+    return get_signature(schema1) == get_signature(schema2)
+
+
+def get_max_column_values(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_names: list[str],
+    column_name: str,
+) -> dict:
+    """Return mapping from table names to the max value of a column, in one job"""
+    query = "\nUNION ALL\n".join(
+        f"""
+            SELECT {index} AS table_index, MAX(`{column_name}`) AS max_value
+            FROM `{project_id}.{dataset_id}.{table_name}`
+        """
+        for index, table_name in enumerate(table_names)
+    )
+    return {
+        table_names[row["table_index"]]: row["max_value"]
+        for row in start_query(client, query, stage="watermark")
+    }
+
+
+def count_rows_up_to(
+    client: bigquery.Client,
+    table_ref: str,
+    column_name: str,
+    value,
+) -> int:
+    """Return the number of rows whose timestamp column is at most `value`"""
+    query = f"""
+        SELECT COUNTIF(`{column_name}` <= @value) AS row_count
+        FROM `{table_ref}`
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("value", "TIMESTAMP", value)]
+    )
+    for row in start_query(client, query, job_config, stage="reconcile"):
+        return row["row_count"]
+
+
+def get_table(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+) -> bigquery.Table:
+    table_ref = f"{project_id}.{dataset_id}.{table_name}"
+    return client.get_table(table_ref)
+
+
+def get_table_schema(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    table_name: str,
+) -> list[bigquery.SchemaField]:
+    return get_table(client, project_id, dataset_id, table_name).schema
+
+
+def get_table_layout(table: bigquery.Table) -> tuple[str | None, list[str] | None]:
+    """Return the time partitioning field and clustering fields of a table"""
+    partition_field = table.time_partitioning.field if table.time_partitioning else None
+    return partition_field, table.clustering_fields or None
+
+
+def get_dataset_table_layouts(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+) -> dict[str, tuple[str | None, list[str] | None]]:
+    """Return mapping from a dataset's table names to their layout
+
+    Listing tables returns their partitioning and clustering, so this costs a
+    single request rather than one per table.
+    """
+    dataset_ref = f"{project_id}.{dataset_id}"
+    return {
+        table.table_id: get_table_layout(table)
+        for table in client.list_tables(dataset_ref)
+    }
 
 
 def get_dataset_table_names(
@@ -84,6 +498,22 @@ def get_dataset_table_names(
         yield table.table_id
 
 
+def get_dataset_tables(
+    client: bigquery.Client,
+    project_id: str,
+    dataset_id: str,
+    max_workers: int = 1,
+) -> list[bigquery.Table]:
+    """Return full table metadata (including `num_bytes`) for a dataset's tables
+
+    Listing tables doesn't return their size, so each table is fetched, with
+    up to `max_workers` requests at a time.
+    """
+    dataset_ref = f"{project_id}.{dataset_id}"
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(client.get_table, client.list_tables(dataset_ref)))
+
+
 def get_dataset_location(
     client: bigquery.Client,
     project_id: str,
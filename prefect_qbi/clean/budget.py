@@ -0,0 +1,30 @@
+import threading
+
+
+class BytesBudgetExceeded(Exception):
+    pass
+
+
+class BytesBudget:
+    """Running total of bytes that queries are estimated to process
+
+    Shared by all tables of a dataset, possibly transformed concurrently.
+    """
+
+    def __init__(self, maximum_bytes: int | None):
+        self.maximum_bytes = maximum_bytes
+        self.used_bytes = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, num_bytes: int, description: str):
+        with self._lock:
+            if (
+                self.maximum_bytes is not None
+                and self.used_bytes + num_bytes > self.maximum_bytes
+            ):
+                raise BytesBudgetExceeded(
+                    f"{description} would process {num_bytes} bytes, "
+                    f"exceeding the dataset budget of {self.maximum_bytes} bytes "
+                    f"({self.used_bytes} bytes already used)."
+                )
+            self.used_bytes += num_bytes
@@ -0,0 +1,128 @@
+from dataclasses import dataclass, field
+
+from .state import StateStore
+
+
+@dataclass
+class CleanConfig:
+    """Options controlling how a dataset is cleaned
+
+    With the defaults, tables are transformed one after another and every
+    destination table is rebuilt from scratch. Unlike before these options
+    existed, a failing table doesn't stop the remaining tables: the failures
+    are raised together once every table has been processed.
+    """
+
+    # Number of source tables transformed concurrently. Tables are started
+    # largest first so that the slowest table does not start last.
+    max_concurrent_tables: int = 1
+
+    # Merge only rows extracted after the previous run into the existing
+    # destination tables instead of rebuilding them. Falls back to a full
+    # rebuild whenever the inferred schema has changed, and whenever rows
+    # have been replaced or removed in the source since the previous run
+    # (e.g. Airbyte streams synced in full refresh or deduped mode), which is
+    # detected by comparing row counts up to the previous run's watermark.
+    incremental: bool = False
+
+    # Where to keep state between runs. When set, a fingerprint of each source
+    # table's metadata is recorded, and tables whose source hasn't changed
+    # since the previous run (and whose destination tables still exist) are
+    # skipped, unless options that change the produced tables (e.g.
+    # `table_layouts` or `max_columns_per_table`) have changed since then.
+    state_store: StateStore | None = None
+
+    # Keep the schemas inferred for JSON columns in `state_store`, and on the
+    # next run sample only rows extracted since then, merging them into the
+    # cached schema.
+    cache_json_schemas: bool = False
+
+    # Ignore all state from previous runs: transform every table even if its
+    # source hasn't changed, and infer JSON schemas from scratch.
+    force: bool = False
+
+    # Sample all JSON columns of a table with one query job, instead of one
+    # job per column.
+    batch_json_sampling: bool = False
+
+    # How JSON column schemas are inferred: "python" downloads a sample of
+    # values and analyzes them locally, "sql" aggregates keys and value types
+    # of all rows inside BigQuery and downloads only the summary.
+    json_inference_engine: str = "python"
+
+    # Which rows the "python" engine samples. See
+    # `json_columns._get_sampling_clauses` for the strategies: "limit",
+    # "tablesample", "recent" and "byte_budget".
+    sampling_strategy: str = "limit"
+    sampling_percent: float = 1.0
+    sampling_window_days: int = 7
+    sampling_byte_budget: int = 1024**3
+
+    # Sample JSON values in growing pages and stop analyzing a column once
+    # `sampling_stable_pages` consecutive pages add no new keys and widen no
+    # types. The first page has `sampling_page_size` rows and every page is
+    # twice as big as the previous one, up to `sampling_max_rows` rows in
+    # total, so columns whose schema keeps changing are sampled for longer.
+    # The number of rows each column needed is printed.
+    adaptive_sampling: bool = False
+    sampling_page_size: int = 100
+    sampling_stable_pages: int = 3
+    sampling_max_rows: int = 100_000
+
+    # Number of worker processes analyzing sampled JSON values and M-Files
+    # contents. With more than one, sampled values are handed to the workers
+    # in chunks of raw JSON text and the resulting schema sketches (see
+    # `schema_sketch`) are merged, and M-Files contents are analyzed file by
+    # file. Adaptive sampling always analyzes in the calling process.
+    analysis_processes: int = 1
+
+    # Library used for decoding sampled JSON values: "auto" (orjson when
+    # installed), "orjson" or "json".
+    json_decoder: str = "auto"
+
+    # How sampled JSON values and M-Files contents are downloaded: "rest" or
+    # "storage" (BigQuery Storage Read API, requires
+    # google-cloud-bigquery-storage and pyarrow).
+    transport: str = "rest"
+
+    # How destination tables are rebuilt. "swap" creates and populates temp
+    # tables, and replaces the final tables with them only once every table of
+    # the source table has succeeded. "replace" produces each table with a
+    # single atomic CREATE OR REPLACE TABLE ... AS SELECT job, halving the job
+    # count and leaving no moment when the table doesn't exist, but a failure
+    # can leave some tables of a source table updated and others not.
+    materialization: str = "swap"
+
+    # How M-Files file content tables are written. "query" inserts each table
+    # with a query job that parses the content again in BigQuery. "load"
+    # writes the rows parsed during schema inference with load jobs, which
+    # aren't billed like queries.
+    m_files_materialization: str = "query"
+
+    # Wide-table mode: tables with more columns than this are split into
+    # vertical shards of at most this many columns. The first shard keeps the
+    # table's name and the others are named `<table>__part_<n>`. Every shard
+    # has the join key, and shards of subtables also `_quickbi_array_offset`,
+    # on which the shards can be joined back together. Shards that are no
+    # longer produced are dropped.
+    # Columns are selected with shorter SQL expressions in this mode.
+    # BigQuery tables can have at most 10,000 columns.
+    max_columns_per_table: int | None = None
+
+    # Destination tables whose source table is at least this big (e.g.
+    # 10 * 1024**3) are partitioned by day on `_row_extracted_at`. None
+    # disables partitioning.
+    partition_min_bytes: int | None = None
+
+    # Cluster subtables on their join key.
+    cluster_subtables: bool = False
+
+    # Per destination table (name without prefix) overrides for the above, for
+    # example: {"deals": {"partition_field": None, "cluster_fields": ["id"]}}
+    table_layouts: dict[str, dict] = field(default_factory=dict)
+
+    # Refuse to run the queries of a source table if, according to dry-run
+    # jobs, they would process more bytes than this in total, or if the whole
+    # dataset would process more than `maximum_bytes_billed_per_dataset`.
+    maximum_bytes_billed_per_table: int | None = None
+    maximum_bytes_billed_per_dataset: int | None = None
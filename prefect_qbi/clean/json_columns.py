@@ -1,11 +1,30 @@
 import json
 
+from google.cloud import bigquery
+
+from ..telemetry import start_query
+from .bigquery_utils import query_rows
+from .config import CleanConfig
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 SAMPLE_SIZE = 10000
 INITIAL_SAMPLE_SIZE = 100000
 
+# Number of sampled values handed to a worker process at a time.
+ANALYSIS_CHUNK_SIZE = 1000
+
 
 def infer_columns_from_json_by_sampling(
-    client, json_columns, table_ref, should_unnest_objects
+    client,
+    json_columns,
+    table_ref,
+    should_unnest_objects,
+    config=None,
+    incremental_column=None,
 ):
     """Return mapping from old column names to metadata dict describing new columns
 
@@ -39,67 +58,651 @@ def infer_columns_from_json_by_sampling(
     if not json_columns:
         return {}
 
+    config = config or CleanConfig()
+    if config.json_inference_engine == "sql":
+        return infer_schemas_in_sql(
+            client, json_columns, table_ref, should_unnest_objects
+        )
+    if config.batch_json_sampling:
+        return _infer_schemas_by_sampling(
+            client,
+            json_columns,
+            table_ref,
+            should_unnest_objects,
+            config,
+            incremental_column,
+        )
+
     schemas = {}
     for json_column in json_columns:
         col_schema = infer_schema_for_column(
-            client, json_column, table_ref, should_unnest_objects
+            client,
+            json_column,
+            table_ref,
+            should_unnest_objects,
+            config,
+            incremental_column,
         )
         schemas[json_column] = col_schema
 
     return schemas
 
 
-def infer_schema_for_column(client, json_column, table_ref, should_unnest_objects):
-    query = f"""
-        WITH initial_sample AS (
-          SELECT `{json_column}`
-          FROM `{table_ref}`
-          WHERE `{json_column}` is not null
-          LIMIT {INITIAL_SAMPLE_SIZE}
+def infer_schema_for_column(
+    client,
+    json_column,
+    table_ref,
+    should_unnest_objects,
+    config=None,
+    incremental_column=None,
+):
+    """Return the schema of a JSON column, inferred from a sample of its rows"""
+    return _infer_schemas_by_sampling(
+        client,
+        [json_column],
+        table_ref,
+        should_unnest_objects,
+        config or CleanConfig(),
+        incremental_column,
+    )[json_column]
+
+
+def _infer_schemas_by_sampling(
+    client,
+    json_columns,
+    table_ref,
+    should_unnest_objects,
+    config,
+    incremental_column,
+):
+    """Sample all given JSON columns with one query and infer their schemas
+
+    Each column is sampled separately (in its own UNION ALL branch), and the
+    rows are routed back to the column's schema by `column_index`.
+
+    If schema caching is enabled, the schema inferred on the previous run is
+    used as a starting point, and only rows extracted after that run (based on
+    `incremental_column`) are sampled and merged into it.
+
+    With adaptive sampling, up to `sampling_max_rows` rows are sampled per
+    column, but a column's rows are no longer analyzed once its schema has
+    converged, and no more rows are downloaded once every column's has.
+    """
+    use_cache = (
+        config.cache_json_schemas
+        and config.state_store is not None
+        and incremental_column is not None
+    )
+    cache_keys = [
+        f"json_schema/{table_ref}.{json_column}/{should_unnest_objects}"
+        for json_column in json_columns
+    ]
+    schemas = []
+    extracted_afters = []
+    for cache_key in cache_keys:
+        cached = config.state_store.get(cache_key) if use_cache else None
+        if config.force or cached is None:
+            schemas.append({})
+            extracted_afters.append(None)
+        else:
+            schemas.append(schema_from_json(cached["schema"]))
+            extracted_afters.append(cached["extracted_at"])
+
+    sample_from, sample_where = _get_sampling_clauses(
+        client, table_ref, config, incremental_column
+    )
+    sample_size = config.sampling_max_rows if config.adaptive_sampling else SAMPLE_SIZE
+    column_sample_queries = []
+    query_parameters = []
+    for column_index, json_column in enumerate(json_columns):
+        where = f"`{json_column}` is not null {sample_where}"
+        if use_cache:
+            # Sample only rows extracted after the previous inference.
+            where += f"""
+                AND `{incremental_column}` <= (SELECT extracted_at FROM bounds)
+                AND (
+                  @extracted_after_{column_index} IS NULL
+                  OR `{incremental_column}` > @extracted_after_{column_index}
+                )
+            """
+            query_parameters.append(
+                bigquery.ScalarQueryParameter(
+                    f"extracted_after_{column_index}",
+                    "TIMESTAMP",
+                    extracted_afters[column_index],
+                )
+            )
+        column_sample_queries.append(
+            f"""
+            (
+              SELECT {column_index} AS column_index, value
+              FROM (
+                SELECT `{json_column}` AS value
+                FROM {sample_from}
+                WHERE {where}
+                LIMIT {max(INITIAL_SAMPLE_SIZE, sample_size)}
+              )
+              ORDER BY RAND()
+              LIMIT {sample_size}
+            )
+            """
         )
+    samples = "UNION ALL".join(column_sample_queries)
+
+    if use_cache:
+        # Remember the latest extraction time seen by this inference.
+        query = f"""
+            WITH bounds AS (
+              SELECT MAX(`{incremental_column}`) AS extracted_at
+              FROM `{table_ref}`
+            )
 
-        SELECT *
-        FROM initial_sample
-        ORDER BY RAND()
-        LIMIT {SAMPLE_SIZE};
+            SELECT
+              *,
+              (SELECT extracted_at FROM bounds) AS `_sample_extracted_at`
+            FROM ({samples});
+        """
+    else:
+        query = f"""
+            SELECT *
+            FROM ({samples});
+        """
+    sample_job, rows = query_rows(
+        client,
+        query,
+        bigquery.QueryJobConfig(query_parameters=query_parameters),
+        config.transport,
+        stage="sample",
+    )
+
+    loads = get_json_loads(config.json_decoder)
+    extracted_ats = list(extracted_afters)
+    if config.analysis_processes > 1 and not config.adaptive_sampling:
+        schemas = _analyze_sample_in_processes(
+            rows,
+            json_columns,
+            schemas,
+            extracted_ats,
+            should_unnest_objects,
+            loads,
+            config.analysis_processes,
+        )
+    else:
+        progresses = [
+            _start_sampling_progress(schema, config.sampling_page_size)
+            for schema in schemas
+        ]
+        converged_count = 0
+        for row in rows:
+            column_index = row["column_index"]
+            json_column = json_columns[column_index]
+            extracted_ats[column_index] = row.get(
+                "_sample_extracted_at", extracted_ats[column_index]
+            )
+            progress = progresses[column_index]
+            if progress["converged"]:
+                continue
+            try:
+                schemas[column_index] = analyze_json_value(
+                    json_column,
+                    row.get("value"),
+                    schemas[column_index],
+                    should_unnest_objects,
+                    loads,
+                )
+            except SkipAnalyzing:
+                pass
+            if config.adaptive_sampling and _update_sampling_progress(
+                progress, schemas[column_index], config.sampling_stable_pages
+            ):
+                converged_count += 1
+                if converged_count == len(json_columns):
+                    # The remaining rows aren't needed, so stop downloading them.
+                    break
+
+    print(
+        f"Sampled {len(json_columns)} JSON column(s) of '{table_ref}' "
+        f"({config.sampling_strategy}): {sample_job.total_bytes_billed} bytes billed."
+    )
+    if config.adaptive_sampling:
+        for json_column, progress in zip(json_columns, progresses):
+            print(
+                f"  {json_column}: {progress['rows']} row(s) needed"
+                f"{'' if progress['converged'] else ' (did not converge)'}."
+            )
+
+    if use_cache:
+        for cache_key, schema, extracted_at, extracted_after in zip(
+            cache_keys, schemas, extracted_ats, extracted_afters
+        ):
+            if extracted_at == extracted_after:
+                continue
+            config.state_store.set(
+                cache_key,
+                {
+                    "schema": schema_to_json(schema),
+                    "extracted_at": extracted_at.isoformat(),
+                },
+            )
+
+    return dict(zip(json_columns, schemas))
+
+
+def _analyze_sample_in_processes(
+    rows,
+    json_columns,
+    schemas,
+    extracted_ats,
+    should_unnest_objects,
+    loads,
+    processes,
+):
+    """Return the schemas merged with sketches of the rows made in processes"""
+    # `schema_sketch` imports this module.
+    from .schema_sketch import (
+        merge_sketches,
+        new_sketch,
+        sketch_from_schema,
+        sketch_json_values_in_processes,
+        sketch_to_schema,
+    )
+
+    def iter_values():
+        for row in rows:
+            column_index = row["column_index"]
+            extracted_ats[column_index] = row.get(
+                "_sample_extracted_at", extracted_ats[column_index]
+            )
+            yield json_columns[column_index], row.get("value")
+
+    sketches = sketch_json_values_in_processes(
+        iter_values(), should_unnest_objects, processes, loads, ANALYSIS_CHUNK_SIZE
+    )
+    return [
+        sketch_to_schema(
+            merge_sketches(
+                sketch_from_schema(schema), sketches.get(json_column, new_sketch())
+            )
+        )
+        for json_column, schema in zip(json_columns, schemas)
+    ]
+
+
+def _start_sampling_progress(schema, page_size):
+    return {
+        "rows": 0,
+        "page_rows": 0,
+        "page_size": page_size,
+        "stable_pages": 0,
+        "signature": _get_schema_signature(schema),
+        "converged": False,
+    }
+
+
+def _update_sampling_progress(progress, schema, stable_pages):
+    """Count an analyzed row and return True if the schema just converged
+
+    At the end of each page the schema is compared with the one at the end
+    of the previous page. Pages double in size, so checking costs little
+    compared to analyzing the rows.
+    """
+    progress["rows"] += 1
+    progress["page_rows"] += 1
+    if progress["page_rows"] < progress["page_size"]:
+        return False
+
+    signature = _get_schema_signature(schema)
+    if signature == progress["signature"]:
+        progress["stable_pages"] += 1
+    else:
+        progress["stable_pages"] = 0
+        progress["signature"] = signature
+    progress["page_rows"] = 0
+    progress["page_size"] *= 2
+    progress["converged"] = progress["stable_pages"] >= stable_pages
+    return progress["converged"]
+
+
+def _get_schema_signature(schema):
+    """Return a value that changes when keys are added or types widened"""
+    return frozenset(
+        (
+            key,
+            metadata["data_type"],
+            metadata["special_data_type"],
+            _get_schema_signature(metadata.get("subcolumns", {})),
+        )
+        for key, metadata in schema.items()
+    )
+
+
+def schema_to_json(schema):
+    """Convert a schema dict to a JSON serializable list
+
+    Schema dicts use None as the key for array columns, which JSON objects
+    can't represent, so the dict is stored as a list of [key, metadata] pairs.
     """
-    rows = client.query(query)
+    return [
+        [
+            key,
+            {
+                **metadata,
+                **(
+                    {"subcolumns": schema_to_json(metadata["subcolumns"])}
+                    if "subcolumns" in metadata
+                    else {}
+                ),
+            },
+        ]
+        for key, metadata in schema.items()
+    ]
+
+
+def schema_from_json(schema_json):
+    """Inverse of `schema_to_json`"""
+    return {
+        key: {
+            **metadata,
+            **(
+                {"subcolumns": schema_from_json(metadata["subcolumns"])}
+                if "subcolumns" in metadata
+                else {}
+            ),
+        }
+        for key, metadata in schema_json
+    }
+
+
+def _get_sampling_clauses(client, table_ref, config, incremental_column):
+    """Return FROM clause and extra WHERE conditions for the sampling strategy
+
+    - "limit": read the first rows BigQuery happens to return. Cheap on
+      small tables, but bills a full scan of the column on large ones.
+    - "tablesample": read `sampling_percent` percent of the table's blocks.
+    - "recent": read only rows extracted within `sampling_window_days`, which
+      prunes partitions when the source table is partitioned by extraction
+      time.
+    - "byte_budget": like "tablesample", with the percentage chosen so that
+      roughly `sampling_byte_budget` bytes are read.
+    """
+    strategy = config.sampling_strategy
+    if strategy == "limit":
+        return f"`{table_ref}`", ""
+    elif strategy == "tablesample":
+        return (
+            f"`{table_ref}` TABLESAMPLE SYSTEM ({config.sampling_percent} PERCENT)",
+            "",
+        )
+    elif strategy == "recent":
+        if incremental_column is None:
+            return f"`{table_ref}`", ""
+        return (
+            f"`{table_ref}`",
+            f"""
+                AND `{incremental_column}` >= TIMESTAMP_SUB(
+                  CURRENT_TIMESTAMP(), INTERVAL {config.sampling_window_days} DAY
+                )
+            """,
+        )
+    elif strategy == "byte_budget":
+        num_bytes = client.get_table(table_ref).num_bytes or 0
+        if num_bytes <= config.sampling_byte_budget:
+            return f"`{table_ref}`", ""
+        percent = max(config.sampling_byte_budget / num_bytes * 100, 0.001)
+        return f"`{table_ref}` TABLESAMPLE SYSTEM ({percent:.3f} PERCENT)", ""
+
+    raise ValueError(f"Unknown sampling strategy: {strategy}")
+
+
+# Values standing for each type reported by `_get_json_type_sql`, used to feed
+# the server-side type summary through the same analyzers as sampled values.
+_REPRESENTATIVE_VALUES = {
+    "INT64": 0,
+    "FLOAT64": 0.5,
+    "BOOL": True,
+    "STRING": "",
+    "JSON": {},
+    "NULL": None,
+}
+
+
+def infer_schemas_in_sql(client, json_columns, table_ref, should_unnest_objects):
+    """Infer JSON column schemas from all rows, inside BigQuery
+
+    Alternative to sampling: BigQuery aggregates the keys of objects, the types
+    of their values and the element types of arrays, and only this small
+    summary is downloaded. The summary is then turned into a schema by feeding
+    representative values through the same analyzers that sampled values go
+    through, so the result has the same format and type precedence rules.
+    """
+    query = "UNION ALL".join(
+        _get_type_summary_query(column_index, json_column, table_ref)
+        for column_index, json_column in enumerate(json_columns)
+    )
+    summaries = {json_column: [] for json_column in json_columns}
+    summary_job = start_query(client, query, stage="summarize")
+    for row in summary_job:
+        summaries[json_columns[row["column_index"]]].append(row)
+    print(
+        f"Summarized {len(json_columns)} JSON column(s) of '{table_ref}': "
+        f"{summary_job.total_bytes_billed} bytes billed."
+    )
+
+    return {
+        json_column: schema_from_type_summary(
+            json_column, summary, should_unnest_objects
+        )
+        for json_column, summary in summaries.items()
+    }
+
+
+def _get_json_type_sql(json_expr):
+    """Return SQL for the BigQuery type `get_bigquery_type` would give a value"""
+    return f"""
+        CASE JSON_TYPE({json_expr})
+          WHEN 'number' THEN IF(
+            REGEXP_CONTAINS(TO_JSON_STRING({json_expr}), r'^-?[0-9]+$'),
+            'INT64',
+            'FLOAT64'
+          )
+          WHEN 'string' THEN 'STRING'
+          WHEN 'boolean' THEN 'BOOL'
+          WHEN 'null' THEN 'NULL'
+          ELSE 'JSON'
+        END
+    """
+
+
+def _get_type_summary_query(column_index, json_column, table_ref):
+    source = f"""
+        (
+          SELECT `{json_column}` AS value
+          FROM `{table_ref}`
+          WHERE `{json_column}` IS NOT NULL
+        )
+    """
+    return f"""
+        -- Types of the top-level values.
+        SELECT
+          {column_index} AS column_index,
+          'value' AS kind,
+          CAST(NULL AS STRING) AS key,
+          JSON_TYPE(value) AS value_type,
+          COUNT(*) AS row_count
+        FROM {source}
+        GROUP BY value_type
+
+        UNION ALL
+
+        -- Keys of objects and the types of their values.
+        SELECT
+          {column_index},
+          'object_key',
+          key,
+          {_get_json_type_sql("value[key]")} AS value_type,
+          COUNT(*)
+        FROM {source}, UNNEST(JSON_KEYS(value, 1)) AS key
+        WHERE JSON_TYPE(value) = 'object'
+        GROUP BY key, value_type
+
+        UNION ALL
+
+        -- Distinct element types of each array, e.g. "INT64,STRING".
+        SELECT
+          {column_index},
+          'array',
+          CAST(NULL AS STRING),
+          value_type,
+          COUNT(*)
+        FROM (
+          SELECT
+            ARRAY_TO_STRING(
+              ARRAY(
+                SELECT DISTINCT {_get_json_type_sql("item")} AS item_type
+                FROM UNNEST(JSON_QUERY_ARRAY(value)) AS item
+                WHERE JSON_TYPE(item) != 'null'
+                ORDER BY item_type
+              ),
+              ','
+            ) AS value_type
+          FROM {source}
+          WHERE JSON_TYPE(value) = 'array'
+        )
+        GROUP BY value_type
+
+        UNION ALL
+
+        -- Keys of objects in arrays and the types of their values.
+        SELECT
+          {column_index},
+          'array_object_key',
+          key,
+          {_get_json_type_sql("item[key]")} AS value_type,
+          COUNT(*)
+        FROM
+          {source},
+          UNNEST(JSON_QUERY_ARRAY(value)) AS item,
+          UNNEST(JSON_KEYS(item, 1)) AS key
+        WHERE JSON_TYPE(value) = 'array' AND JSON_TYPE(item) = 'object'
+        GROUP BY key, value_type
+    """
+
+
+def schema_from_type_summary(json_column, summary, should_unnest_objects):
+    """Build a schema from the rows returned by `_get_type_summary_query`"""
+    summary_by_kind = {}
+    for row in summary:
+        summary_by_kind.setdefault(row["kind"], []).append(row)
+
+    value_types = {row["value_type"] for row in summary_by_kind.get("value", [])}
+    if value_types & {"number", "boolean"}:
+        raise RuntimeError(f"Unexpected JSON value in {json_column}.")
 
     schema = {}
-    for row in rows:
-        value = row.get(json_column)
-        try:
-            schema = analyze_json_value(
-                json_column, value, schema, should_unnest_objects
+    if "object" in value_types and should_unnest_objects:
+        for row in summary_by_kind.get("object_key", []):
+            schema = analyze_dict(
+                {row["key"]: _REPRESENTATIVE_VALUES[row["value_type"]]}, schema
             )
-        except SkipAnalyzing:
-            continue
+
+    if "array" in value_types:
+        array_objects = [
+            {row["key"]: _REPRESENTATIVE_VALUES[row["value_type"]]}
+            for row in summary_by_kind.get("array_object_key", [])
+        ]
+        for row in sorted(
+            summary_by_kind.get("array", []), key=lambda row: row["value_type"]
+        ):
+            item_types = row["value_type"].split(",") if row["value_type"] else []
+            if item_types == ["JSON"]:
+                items = array_objects or [{}]
+            else:
+                items = [_REPRESENTATIVE_VALUES[t] for t in item_types]
+            schema = analyze_list(items, schema)
 
     return schema
 
 
-def infer_schema_from_json_values(json_column, values, should_unnest_objects):
+def compare_inference_engines(
+    client, json_column, table_ref, should_unnest_objects, config=None
+):
+    """Return differences between sampled and server-side inferred schemas
+
+    Returns a dict from keys (None for arrays) to a pair of metadata dicts
+    (sampled, server-side), with None when the key is missing from a schema.
+    Differences are expected for keys and types that are so rare that the
+    sample doesn't contain them.
+    """
+    sampled = infer_schema_for_column(
+        client, json_column, table_ref, should_unnest_objects, config
+    )
+    server_side = infer_schemas_in_sql(
+        client, [json_column], table_ref, should_unnest_objects
+    )[json_column]
+    return {
+        key: (sampled.get(key), server_side.get(key))
+        for key in sampled.keys() | server_side.keys()
+        if sampled.get(key) != server_side.get(key)
+    }
+
+
+def infer_schema_from_json_values(
+    json_column, values, should_unnest_objects, loads=None
+):
+    loads = loads or get_json_loads()
     schema = {}
     for value in values:
         try:
             schema = analyze_json_value(
-                json_column, value, schema, should_unnest_objects
+                json_column, value, schema, should_unnest_objects, loads
             )
         except SkipAnalyzing:
             continue
     return schema
 
 
+def get_json_loads(decoder="auto"):
+    """Return the function used for decoding sampled JSON values
+
+    "orjson" is considerably faster than the standard library "json", and
+    "auto" uses it when it's installed. Note that orjson decodes integers wider
+    than 64 bits as floats, so such keys are inferred as FLOAT64 (they
+    wouldn't fit INT64 anyway).
+    """
+    if decoder == "json" or (decoder == "auto" and orjson is None):
+        return json.loads
+    elif decoder in ("orjson", "auto"):
+        return _orjson_loads
+
+    raise ValueError(f"Unknown JSON decoder: {decoder}")
+
+
+def _orjson_loads(value):
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than the standard library, for example it
+        # rejects NaN and Infinity.
+        return json.loads(value)
+
+
 class SkipAnalyzing(Exception):
     pass
 
 
-def analyze_json_value(field_name, field_value, schema, should_unnest_objects):
+def analyze_json_value(
+    field_name, field_value, schema, should_unnest_objects, loads=json.loads
+):
     """Return mapping from keys to BigQuery data types and modes"""
     if field_value is None:
         return schema
 
-    obj = json.loads(field_value)
+    # Depending on the version, the BigQuery client returns JSON values either
+    # as JSON text or already decoded, in which case they're used as is.
+    if isinstance(field_value, (str, bytes)):
+        obj = loads(field_value)
+    else:
+        obj = field_value
 
     if isinstance(obj, dict):
         if not should_unnest_objects:
@@ -126,8 +729,18 @@ def analyze_dict(obj, schema):
 
     for key, val in obj.items():
         this_type = get_bigquery_type(val)
-        previous_type = schema.get(key, {}).get("data_type", "STRING")
-        new_type = get_better_type(this_type, previous_type)
+        previous_metadata = schema.get(key)
+        if previous_metadata is None:
+            new_type = get_better_type(this_type, "STRING")
+        else:
+            previous_type = previous_metadata["data_type"]
+            if this_type == previous_type:
+                # Most values have the same type as before, so skip creating
+                # identical metadata again.
+                continue
+            new_type = get_better_type(this_type, previous_type)
+            if new_type == previous_type:
+                continue
 
         schema[key] = {
             "data_type": new_type,
@@ -202,7 +815,23 @@ def _get_string_array_schema():
     }
 
 
+_BIGQUERY_TYPES_BY_PYTHON_TYPE = {
+    bool: "BOOL",
+    int: "INT64",
+    float: "FLOAT64",
+    str: "STRING",
+    type(None): "STRING",
+    dict: "JSON",
+    list: "JSON",
+}
+
+
 def get_bigquery_type(value):
+    # Fast path for values decoded from JSON, which are never subclasses.
+    bigquery_type = _BIGQUERY_TYPES_BY_PYTHON_TYPE.get(type(value))
+    if bigquery_type is not None:
+        return bigquery_type
+
     if isinstance(value, bool):
         return "BOOL"
     elif isinstance(value, int):
@@ -1,8 +1,14 @@
+import collections
+import math
+
 from google.cloud import bigquery
 
+from ..telemetry import start_query
 from .bigquery_schema import clean_name
-from .json_columns import infer_schema_from_json_values
-from .utils import get_unique_temp_table_name
+from .bigquery_utils import get_dataset_table_names, query_rows
+from .config import CleanConfig
+from .json_columns import get_json_loads, infer_schema_from_json_values
+from .utils import get_process_pool, get_unique_temp_table_name
 
 
 def transform_json_column_to_tables(
@@ -14,51 +20,133 @@ def transform_json_column_to_tables(
     source_index_columns,
     source_name_column,
     source_value_column,
+    config=None,
+    table_prefix=None,
 ):
-    # Get values for each column specified in `source_index_columns`.
-    json_object_keys_function = '''
-        CREATE TEMP FUNCTION JSON_OBJECT_KEYS(json_str STRING)
-        RETURNS ARRAY<STRING>
-        LANGUAGE js
-        AS r"""
-            const json_dict = JSON.parse(json_str);
-            return Array.isArray(json_dict) ? [] : Object.keys(json_dict);
+    """Yield a destination table spec for every array in the JSON column
+
+    If a state store is configured, the content of each file is fingerprinted
+    and only tables of changed files are built. Tables of unchanged files are
+    yielded with "action" "keep", and tables of removed files (or keys) with
+    "action" "drop". The fingerprints are stored by `record_file_fingerprints`
+    once the tables have been built.
+    """
+    config = config or CleanConfig()
+    source_table_ref = f"{project_id}.{source_dataset_id}.{source_table_name}"
+    loads = get_json_loads(config.json_decoder)
+
+    column_types = {
+        schema_field.name: schema_field.field_type
+        for schema_field in client.get_table(source_table_ref).schema
+    }
+    fingerprint_sql = (
+        f"FARM_FINGERPRINT(TO_JSON_STRING(`{source_value_column}`))"
+        if column_types[source_value_column] == "JSON"
+        else f"FARM_FINGERPRINT(`{source_value_column}`)"
+    )
+
+    use_fingerprints = config.state_store is not None and table_prefix is not None
+    state_key = (
+        f"m_files_fingerprints/{source_table_ref}"
+        f"/{destination_dataset_id}/{table_prefix}"
+    )
+    content_where = ""
+    query_parameters = []
+    changed_files = {}
+    if use_fingerprints:
+        previous_files = {} if config.force else config.state_store.get(state_key)
+        changed_files, changed_file_rows = yield from _yield_unchanged_tables(
+            client,
+            project_id,
+            source_table_ref,
+            destination_dataset_id,
+            table_prefix,
+            source_index_columns,
+            source_name_column,
+            source_value_column,
+            fingerprint_sql,
+            state_key,
+            previous_files or {},
+        )
+        if not changed_file_rows:
+            return
+        # Files are matched on their key and fingerprint, so that unchanged
+        # files with the same content as a changed file aren't rebuilt.
+        content_where = f"""
+            AND STRUCT(`{'`, `'.join(source_index_columns)}`, {fingerprint_sql})
+                IN UNNEST(@files)
         """
-    '''
-    index_query = f"""
-        {json_object_keys_function};
+        query_parameters = [
+            bigquery.ArrayQueryParameter(
+                "files",
+                "STRUCT",
+                [
+                    bigquery.StructQueryParameter(
+                        None,
+                        *(
+                            bigquery.ScalarQueryParameter(
+                                column, column_types[column], row[column]
+                            )
+                            for column in source_index_columns
+                        ),
+                        bigquery.ScalarQueryParameter(
+                            "_fingerprint", "INT64", row["_fingerprint"]
+                        ),
+                    )
+                    for row in changed_file_rows
+                ],
+            )
+        ]
+
+    # Stream the files with their content in one query, and infer the schema
+    # of every (file, key) locally, instead of querying each of them.
+    content_query = f"""
         SELECT
             `{'`, `'.join(source_index_columns)}`,
             `{source_name_column}`,
-            JSON_TYPE(PARSE_JSON(`{source_value_column}`, wide_number_mode=>'round')) AS `{source_value_column}_type`,
-            JSON_OBJECT_KEYS(`{source_value_column}`) AS `{source_value_column}_object_keys`
-        FROM `{project_id}.{source_dataset_id}.{source_table_name}`
-        WHERE `{source_value_column}` IS NOT NULL
+            `{source_value_column}`,
+            {fingerprint_sql if use_fingerprints else "NULL"} AS _fingerprint
+        FROM `{source_table_ref}`
+        WHERE `{source_value_column}` IS NOT NULL {content_where}
     """
+    _, content_rows = query_rows(
+        client,
+        content_query,
+        bigquery.QueryJobConfig(query_parameters=query_parameters),
+        config.transport,
+        stage="m_files_content",
+    )
 
-    for index in client.query(index_query):
-        json_type = index[f"{source_value_column}_type"]
-        json_object_keys = index[f"{source_value_column}_object_keys"]
+    built_table_names = set()
+    for index, content, array_schemas in _iter_analyzed_contents(
+        content_rows, source_value_column, loads, config.analysis_processes
+    ):
+        if config.m_files_materialization == "load" and content is None:
+            content = _decode_content(index[source_value_column], loads)
 
-        if json_type == "object":
+        if None in array_schemas:
+            # The `source_value_column` for this row should be an array of objects.
+            # The array is converted into one table, named only based on the file.
+            json_paths = ["$"]
+            destination_table_names = [index[source_name_column]]
+            json_arrays = [content]
+            schemas = [array_schemas[None]]
+        else:
             # The `source_value_column` for this row should be an object,
             # whose values are arrays of objects.
             # Each value (array) is converted to their own table,
             # named based on the file and the key associated with the array.
-            json_paths = [f'$."{key}"' for key in json_object_keys]
+            json_paths = [f'$."{key}"' for key in array_schemas]
             destination_table_names = [
-                f"{index[source_name_column]}__{key}" for key in json_object_keys
+                f"{index[source_name_column]}__{key}" for key in array_schemas
             ]
-        elif json_type == "array":
-            # The `source_value_column` for this row should be an array of objects.
-            # The array is converted into one table, named only based on the file.
-            json_paths = ["$"]
-            destination_table_names = [index[source_name_column]]
-        else:
-            raise ValueError(f"invalid json type: {json_type}")
+            json_arrays = [
+                content[key] if content is not None else None for key in array_schemas
+            ]
+            schemas = list(array_schemas.values())
 
-        for json_path, destination_table_name in zip(
-            json_paths, destination_table_names
+        for json_path, destination_table_name, json_array, schema in zip(
+            json_paths, destination_table_names, json_arrays, schemas
         ):
             # Get records from the column `source_value_column` for the row with the matching index.
             # The column specified by `source_value_column` should contain an array of records stored
@@ -66,7 +154,7 @@ def transform_json_column_to_tables(
             # by ordering the results by the row offset.
             value_query = f"""
                 SELECT PARSE_JSON(`{source_value_column}__unnested`, wide_number_mode=>'round') AS `array_item`
-                FROM `{project_id}.{source_dataset_id}.{source_table_name}`
+                FROM `{source_table_ref}`
                 CROSS JOIN UNNEST(JSON_QUERY_ARRAY(`{source_value_column}`, ?)) AS `{source_value_column}__unnested`
                 WITH OFFSET AS `{source_value_column}__offset`
                 WHERE {' AND '.join(f'`{c}` = ?' for c in source_index_columns)}
@@ -75,32 +163,12 @@ def transform_json_column_to_tables(
             query_parameters = [
                 bigquery.ScalarQueryParameter(None, "STRING", json_path)
             ]
-            column_types = {
-                schema_field.name: schema_field.field_type
-                for schema_field in client.get_table(
-                    f"{project_id}.{source_dataset_id}.{source_table_name}"
-                ).schema
-            }
             for index_column in source_index_columns:
                 query_parameters.append(
                     bigquery.ScalarQueryParameter(
                         None, column_types[index_column], index[index_column]
                     )
                 )
-            schema = infer_schema_from_json_values(
-                source_value_column,
-                (
-                    row["array_item"]
-                    for row in client.query(
-                        value_query,
-                        job_config=bigquery.QueryJobConfig(
-                            query_parameters=query_parameters
-                        ),
-                    )
-                ),
-                True,
-            )
-
             field_schemas = []
             field_selectors = []
 
@@ -123,13 +191,253 @@ def transform_json_column_to_tables(
                 field_selectors.append(field_selector)
 
             unique_destination_table_name = clean_name(
-                f"{destination_table_name}__{'_'.join(str(index[c]) for c in source_index_columns)}"
+                f"{destination_table_name}__{_get_file_key(index, source_index_columns)}"
             )
 
-            yield {
+            destination_table_spec = {
                 "name": unique_destination_table_name,
                 "schema_list": field_schemas,
                 "query_select_list": field_selectors,
                 "query_from": f"({value_query})",
                 "query_parameters": query_parameters,
             }
+            if use_fingerprints:
+                destination_table_spec["file_fingerprint"] = {
+                    "state_key": state_key,
+                    "file_key": _get_file_key(index, source_index_columns),
+                    "fingerprint": index["_fingerprint"],
+                    "file_name": index[source_name_column],
+                }
+            built_table_names.add(unique_destination_table_name)
+            if config.m_files_materialization == "load":
+                # The rows are already parsed for the inference, so they're
+                # loaded as such instead of being parsed again by a query.
+                destination_table_spec["rows"] = [
+                    {
+                        field_schema.name: _convert_like_lax(
+                            item.get(field_name), field_spec["data_type"]
+                        )
+                        for field_schema, (field_name, field_spec) in zip(
+                            field_schemas, schema.items()
+                        )
+                    }
+                    for item in (json_array if isinstance(json_array, list) else [])
+                    if isinstance(item, dict)
+                ]
+            yield destination_table_spec
+
+    # Keys removed from changed files.
+    for previous_file in changed_files.values():
+        for table_name in previous_file["tables"]:
+            if table_name not in built_table_names:
+                yield _get_drop_spec(table_name, state_key)
+
+
+def _iter_analyzed_contents(content_rows, source_value_column, loads, processes):
+    """Yield content rows with their decoded content and array schemas
+
+    The array schemas are a dict from the keys of an object content, or None
+    for an array content, to the schema of the array. With more than one
+    process, contents are analyzed in a process pool as they're downloaded,
+    and the decoded content is None as it stays in the worker.
+    """
+    if processes <= 1:
+        for index in content_rows:
+            content = _decode_content(index[source_value_column], loads)
+            yield index, content, _get_array_schemas(
+                content, source_value_column, loads
+            )
+        return
+
+    pool = get_process_pool(processes)
+    pending = collections.deque()
+    for index in content_rows:
+        pending.append(
+            (
+                index,
+                pool.submit(
+                    _get_array_schemas,
+                    index[source_value_column],
+                    source_value_column,
+                    loads,
+                ),
+            )
+        )
+        # Keep the workers busy without holding every file in memory.
+        while len(pending) > 2 * processes:
+            index, future = pending.popleft()
+            yield index, None, future.result()
+    for index, future in pending:
+        yield index, None, future.result()
+
+
+def _decode_content(content, loads):
+    if isinstance(content, (str, bytes)):
+        return loads(content)
+    return content
+
+
+def _get_array_schemas(content, source_value_column, loads):
+    content = _decode_content(content, loads)
+    if isinstance(content, dict):
+        arrays = content
+    elif isinstance(content, list):
+        arrays = {None: content}
+    else:
+        raise ValueError(f"invalid json type: {type(content).__name__}")
+
+    return {
+        key: infer_schema_from_json_values(
+            source_value_column,
+            json_array if isinstance(json_array, list) else [],
+            True,
+            loads,
+        )
+        for key, json_array in arrays.items()
+    }
+
+
+def _yield_unchanged_tables(
+    client,
+    project_id,
+    source_table_ref,
+    destination_dataset_id,
+    table_prefix,
+    source_index_columns,
+    source_name_column,
+    source_value_column,
+    fingerprint_sql,
+    state_key,
+    previous_files,
+):
+    """Yield specs keeping tables of unchanged files and dropping removed ones
+
+    Return the previous state of the changed files and their fingerprint rows.
+    A file is unchanged if its fingerprint and name, which its table names
+    are built from, are the same as on the previous run and all of its tables
+    still exist.
+    """
+    fingerprint_query = f"""
+        SELECT
+            `{'`, `'.join(source_index_columns)}`,
+            `{source_name_column}`,
+            {fingerprint_sql} AS _fingerprint
+        FROM `{source_table_ref}`
+        WHERE `{source_value_column}` IS NOT NULL
+    """
+    existing_table_names = set(
+        get_dataset_table_names(client, project_id, destination_dataset_id)
+    )
+
+    changed_files = {}
+    changed_file_rows = []
+    file_keys = set()
+    for row in start_query(client, fingerprint_query, stage="m_files_fingerprint"):
+        file_key = _get_file_key(row, source_index_columns)
+        file_keys.add(file_key)
+        previous_file = previous_files.get(file_key, {"tables": []})
+        if (
+            previous_file.get("fingerprint") == row["_fingerprint"]
+            and previous_file.get("file_name") == row[source_name_column]
+            and all(
+                f"{table_prefix}__{table_name}" in existing_table_names
+                for table_name in previous_file["tables"]
+            )
+        ):
+            for table_name in previous_file["tables"]:
+                yield {
+                    "name": table_name,
+                    "action": "keep",
+                    "file_fingerprint": {
+                        "state_key": state_key,
+                        "file_key": file_key,
+                        "fingerprint": row["_fingerprint"],
+                        "file_name": row[source_name_column],
+                    },
+                }
+        else:
+            changed_files[file_key] = previous_file
+            changed_file_rows.append(row)
+
+    for file_key, previous_file in previous_files.items():
+        if file_key not in file_keys:
+            for table_name in previous_file["tables"]:
+                yield _get_drop_spec(table_name, state_key)
+
+    return changed_files, changed_file_rows
+
+
+def _get_drop_spec(table_name, state_key):
+    # The state is stored even if all files were removed.
+    return {
+        "name": table_name,
+        "action": "drop",
+        "file_fingerprint": {"state_key": state_key, "file_key": None},
+    }
+
+
+def _get_file_key(row, source_index_columns):
+    return "_".join(str(row[column]) for column in source_index_columns)
+
+
+def record_file_fingerprints(state_store, destination_table_specs):
+    """Store the content fingerprints of the files whose tables were built or kept"""
+    files_by_state_key = {}
+    for destination_table_spec in destination_table_specs:
+        file_fingerprint = destination_table_spec.get("file_fingerprint")
+        if file_fingerprint is None:
+            continue
+        files = files_by_state_key.setdefault(file_fingerprint["state_key"], {})
+        if file_fingerprint["file_key"] is None:
+            continue
+        file = files.setdefault(
+            file_fingerprint["file_key"],
+            {
+                "fingerprint": file_fingerprint["fingerprint"],
+                "file_name": file_fingerprint["file_name"],
+                "tables": [],
+            },
+        )
+        file["tables"].append(destination_table_spec["name"])
+
+    for state_key, files in files_by_state_key.items():
+        state_store.set(state_key, files)
+
+
+def _convert_like_lax(value, data_type):
+    """Convert a decoded JSON value like the LAX_* SQL functions would"""
+    if data_type == "JSON" or value is None:
+        return value
+    if data_type == "STRING":
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (int, float, str)):
+            return str(value)
+        return None
+    if data_type == "BOOL":
+        if isinstance(value, str):
+            return {"true": True, "false": False}.get(value.lower())
+        if isinstance(value, (bool, int, float)):
+            return bool(value)
+        return None
+
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if data_type == "FLOAT64":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return float(value)
+    if data_type == "INT64":
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, int):
+            return value
+        if isinstance(value, float) and math.isfinite(value):
+            # Halfway cases are rounded away from zero.
+            return int(math.copysign(math.floor(abs(value) + 0.5), value))
+        return None
+
+    raise ValueError(f"Unknown data type: {data_type}")
@@ -0,0 +1,246 @@
+"""Mergeable summaries of JSON column values
+
+A sketch counts, for a set of JSON values, how often each object key occurs,
+how often it's null and the types of its values, and the element types and
+object keys of arrays. Sketches of different sets of values (chunks of a
+sample, partitions, runs) can be merged in any order and grouping, and the
+result converted to the schema format of `json_columns`.
+
+Sketches are plain dicts of counts, so they're JSON serializable, for example:
+{
+    "rows": 3,
+    "objects": 2,
+    "keys": {"a": {"count": 2, "null_count": 1, "types": {"INT64": 1}}},
+    "arrays": 1,
+    "array_element_types": {"INT64,STRING": 1},
+    "array_keys": {},
+}
+"""
+
+import collections
+import copy
+import functools
+
+from .json_columns import (
+    _get_string_array_schema,
+    get_better_type,
+    get_bigquery_type,
+    get_json_loads,
+)
+from .utils import get_process_pool
+
+
+def new_sketch():
+    return {
+        "rows": 0,
+        "objects": 0,
+        "keys": {},
+        "arrays": 0,
+        "array_element_types": {},
+        "array_keys": {},
+    }
+
+
+def sketch_json_values(json_column, values, should_unnest_objects, loads=None):
+    """Return the sketch of JSON values, which may be JSON text or decoded"""
+    loads = loads or get_json_loads()
+    sketch = new_sketch()
+    for value in values:
+        add_json_value(sketch, json_column, value, should_unnest_objects, loads)
+    return sketch
+
+
+def sketch_json_values_in_processes(
+    keyed_values, should_unnest_objects, processes, loads=None, chunk_size=1000
+):
+    """Return sketches of values grouped by column, computed in a process pool
+
+    `keyed_values` is an iterable of (column name, value) pairs, for example
+    sampled rows as they're downloaded. Values are handed to the workers in
+    chunks of `chunk_size` as soon as a chunk is full, so downloading
+    overlaps analysis.
+    """
+    loads = loads or get_json_loads()
+    pool = get_process_pool(processes)
+    chunks = collections.defaultdict(list)
+    futures = collections.defaultdict(list)
+    for json_column, value in keyed_values:
+        chunk = chunks[json_column]
+        chunk.append(value)
+        if len(chunk) >= chunk_size:
+            futures[json_column].append(
+                pool.submit(
+                    sketch_json_values, json_column, chunk, should_unnest_objects, loads
+                )
+            )
+            chunks[json_column] = []
+    for json_column, chunk in chunks.items():
+        if chunk:
+            futures[json_column].append(
+                pool.submit(
+                    sketch_json_values, json_column, chunk, should_unnest_objects, loads
+                )
+            )
+
+    return {
+        json_column: merge_sketches(*(future.result() for future in column_futures))
+        for json_column, column_futures in futures.items()
+    }
+
+
+def add_json_value(sketch, field_name, field_value, should_unnest_objects, loads):
+    """Count a value into the sketch, skipping it like `analyze_json_value` does"""
+    if field_value is None:
+        return
+    sketch["rows"] += 1
+
+    if isinstance(field_value, (str, bytes)):
+        obj = loads(field_value)
+    else:
+        obj = field_value
+
+    if isinstance(obj, dict):
+        if not should_unnest_objects:
+            return
+        sketch["objects"] += 1
+        for key, val in obj.items():
+            _add_key_value(sketch["keys"], key, val)
+    elif isinstance(obj, list):
+        types = sorted({get_bigquery_type(val) for val in obj if val is not None})
+        if types == ["JSON"] and any(isinstance(val, list) for val in obj):
+            # Arrays of arrays are skipped by `analyze_dict`.
+            return
+        sketch["arrays"] += 1
+        element_types = ",".join(types)
+        sketch["array_element_types"][element_types] = (
+            sketch["array_element_types"].get(element_types, 0) + 1
+        )
+        if types == ["JSON"]:
+            for val in obj:
+                if val is None:
+                    continue
+                for key, item_val in val.items():
+                    _add_key_value(sketch["array_keys"], key, item_val)
+    elif obj is not None and not isinstance(obj, str):
+        raise RuntimeError(f"Unexpected JSON value in {field_name}.")
+
+
+def _add_key_value(keys, key, value):
+    stats = keys.get(key)
+    if stats is None:
+        stats = keys[key] = {"count": 0, "null_count": 0, "types": {}}
+    stats["count"] += 1
+    if value is None:
+        stats["null_count"] += 1
+    else:
+        data_type = get_bigquery_type(value)
+        stats["types"][data_type] = stats["types"].get(data_type, 0) + 1
+
+
+def merge_sketches(*sketches):
+    """Return the sketch of all values of the given sketches
+
+    Merging adds up counts, so it's associative and commutative. Only the
+    order of keys depends on the order of the sketches: keys are ordered by
+    the first sketch they occur in.
+    """
+    merged = new_sketch()
+    for sketch in sketches:
+        _add_counts(merged, sketch)
+    return merged
+
+
+def _add_counts(counts, other_counts):
+    for key, value in other_counts.items():
+        if key not in counts:
+            counts[key] = copy.deepcopy(value)
+        elif isinstance(value, dict):
+            _add_counts(counts[key], value)
+        else:
+            counts[key] += value
+
+
+def sketch_to_schema(sketch):
+    """Convert a sketch to the schema format of `json_columns`
+
+    Object keys get the best type of their values according to
+    `get_better_type`, with null values counting as STRING. Arrays get the
+    schema `analyze_list` gives in every order of the rows: arrays of a
+    single type keep it, and string arrays with either INT64 or FLOAT64
+    arrays are CSV. Any other combination of element types is a conflict,
+    also where `analyze_list` conflicts only in some orders, for example
+    with BOOL arrays before string arrays, or INT64 arrays before FLOAT64
+    arrays before string arrays. Columns with both arrays and objects get
+    the array schema and the object keys.
+    """
+    schema = {}
+
+    element_types = set()
+    for types in sketch["array_element_types"]:
+        if "," in types:
+            raise RuntimeError("Unhandled type.")
+        if types:
+            element_types.add(types)
+    if element_types == {"JSON"}:
+        schema[None] = {
+            "data_type": "JSON",
+            "mode": "NULLABLE",
+            "special_data_type": None,
+            "create_subtable": True,
+            "subcolumns": _get_keys_schema(sketch["array_keys"]),
+        }
+    elif element_types in ({"STRING"}, {"STRING", "INT64"}, {"STRING", "FLOAT64"}):
+        schema = _get_string_array_schema()
+    elif len(element_types) == 1:
+        schema[None] = {
+            "data_type": element_types.pop(),
+            "mode": "NULLABLE",
+            "create_subtable": True,
+            "special_data_type": None,
+        }
+    elif element_types:
+        raise RuntimeError("Schema conflict")
+
+    schema.update(_get_keys_schema(sketch["keys"]))
+    return schema
+
+
+def sketch_from_schema(schema):
+    """Return a sketch that converts back to the schema, for merging into it
+
+    The counts are made up (one per key), so that a schema inferred earlier,
+    for example a cached one, can be used as the starting point of a merge.
+    """
+    sketch = new_sketch()
+    for key, metadata in schema.items():
+        if key is not None:
+            sketch["keys"][key] = {
+                "count": 1,
+                "null_count": 0,
+                "types": {metadata["data_type"]: 1},
+            }
+            continue
+
+        sketch["arrays"] += 1
+        sketch["array_element_types"][metadata["data_type"]] = 1
+        for subkey, submetadata in metadata.get("subcolumns", {}).items():
+            sketch["array_keys"][subkey] = {
+                "count": 1,
+                "null_count": 0,
+                "types": {submetadata["data_type"]: 1},
+            }
+    return sketch
+
+
+def _get_keys_schema(keys):
+    return {
+        key: {
+            "data_type": functools.reduce(
+                get_better_type,
+                [*stats["types"], *(["STRING"] if stats["null_count"] else [])],
+            ),
+            "mode": "NULLABLE",
+            "special_data_type": None,
+        }
+        for key, stats in keys.items()
+    }
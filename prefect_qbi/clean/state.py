@@ -0,0 +1,149 @@
+import json
+import threading
+from pathlib import Path
+from typing import Protocol
+
+from google.cloud import bigquery
+
+from ..telemetry import start_query
+
+
+class StateStore(Protocol):
+    """Key-value store for state that has to survive between runs
+
+    Values are JSON serializable objects. Stores may buffer writes until
+    `flush` is called.
+    """
+
+    def get(self, key: str):
+        ...
+
+    def set(self, key: str, value):
+        ...
+
+    def flush(self):
+        ...
+
+
+class LocalFileStateStore:
+    """State store backed by a single local JSON file"""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            return self._read().get(key)
+
+    def set(self, key: str, value):
+        with self._lock:
+            state = self._read()
+            state[key] = value
+            self.path.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+    def flush(self):
+        # Writes aren't buffered.
+        pass
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+
+class BigQueryStateStore:
+    """State store backed by a BigQuery table
+
+    The table is created on first use. All of its rows are read once and
+    cached, so that looking up state doesn't cost a query job per key.
+    Writes are buffered and written with one MERGE job by `flush`, so that
+    concurrently transformed tables don't wait for each other's writes.
+    """
+
+    def __init__(
+        self,
+        client: bigquery.Client,
+        project_id: str,
+        dataset_id: str,
+        table_name: str = "_quickbi_clean_state",
+    ):
+        self.client = client
+        self.table_ref = f"{project_id}.{dataset_id}.{table_name}"
+        self._lock = threading.Lock()
+        self._cache = None
+        self._pending = {}
+
+    def get(self, key: str):
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key: str, value):
+        value_json = json.dumps(value, sort_keys=True)
+        with self._lock:
+            self._load()[key] = json.loads(value_json)
+            self._pending[key] = value_json
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        query = f"""
+            MERGE `{self.table_ref}` AS target
+            USING (
+                SELECT entry.key, entry.value FROM UNNEST(@entries) AS entry
+            ) AS source
+            ON target.key = source.key
+            WHEN MATCHED THEN
+                UPDATE SET value = source.value, updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN
+                INSERT (key, value, updated_at)
+                VALUES (source.key, source.value, CURRENT_TIMESTAMP())
+        """
+        entries = [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("key", "STRING", key),
+                bigquery.ScalarQueryParameter("value", "STRING", value_json),
+            )
+            for key, value_json in pending.items()
+        ]
+        try:
+            start_query(
+                self.client,
+                query,
+                bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ArrayQueryParameter("entries", "STRUCT", entries)
+                    ]
+                ),
+                stage="state",
+            ).result()
+        except Exception:
+            # Keep the writes for the next flush, unless overwritten since.
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+            raise
+
+    def _load(self):
+        if self._cache is None:
+            table = bigquery.Table(
+                self.table_ref,
+                [
+                    bigquery.SchemaField("key", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("value", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+                ],
+            )
+            self.client.create_table(table, exists_ok=True)
+            self._cache = {
+                row["key"]: json.loads(row["value"])
+                for row in start_query(
+                    self.client,
+                    f"SELECT key, value FROM `{self.table_ref}`",
+                    stage="state",
+                )
+            }
+        return self._cache
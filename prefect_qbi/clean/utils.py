@@ -1,6 +1,12 @@
+import multiprocessing
 import random
 import re
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
 
 
 def convert_to_snake_case(text):
@@ -14,3 +20,19 @@ def get_unique_temp_table_name(base_name):
     timestamp = int(time.time())
     random_suffix = random.randint(1000, 9999)
     return f"{base_name}__temp_{timestamp}_{random_suffix}"
+
+
+def get_process_pool(processes):
+    """Return a process pool of the given size, shared by all callers
+
+    Workers are spawned rather than forked, since forking a process that runs
+    other threads can deadlock. Spawning imports the package in every worker,
+    so the pool is created once and reused.
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(processes)
+        if pool is None:
+            pool = _process_pools[processes] = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context("spawn")
+            )
+        return pool
@@ -0,0 +1,209 @@
+"""Labels and statistics of the BigQuery jobs issued by this package
+
+Every job gets labels describing what it was issued for (customer, dataset,
+source table and stage). Jobs started inside `record_jobs` are also collected,
+and once the block ends their statistics are emitted as structured log
+records, OpenTelemetry spans (when `opentelemetry` is installed) and a Prefect
+table artifact (when running inside a Prefect flow).
+"""
+
+import contextvars
+import json
+import logging
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+from google.cloud import bigquery
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+_job_labels = contextvars.ContextVar("job_labels", default={})
+_recorded_jobs = contextvars.ContextVar("recorded_jobs", default=None)
+
+
+def get_logger():
+    try:
+        from prefect import get_run_logger
+
+        return get_run_logger()
+    except Exception:
+        logger = logging.getLogger(__name__)
+        logger.setLevel(logging.INFO)
+        return logger
+
+
+@contextmanager
+def job_labels(**labels):
+    """Add labels to every BigQuery job started inside the block"""
+    token = _job_labels.set(
+        {
+            **_job_labels.get(),
+            **{
+                key: _clean_label_value(value)
+                for key, value in labels.items()
+                if value is not None
+            },
+        }
+    )
+    try:
+        yield
+    finally:
+        _job_labels.reset(token)
+
+
+def _clean_label_value(value):
+    # Label values may contain only lowercase letters, numbers, underscores and
+    # dashes, and be at most 63 characters long.
+    return re.sub(r"[^a-z0-9_-]", "_", str(value).lower())[:63]
+
+
+def get_customer_from_run_tags() -> str | None:
+    """Return the customer of the current Prefect run, from a `customer:<id>` tag"""
+    from prefect.runtime import flow_run, task_run
+
+    for tag in [*task_run.tags, *flow_run.tags]:
+        if tag.startswith("customer:"):
+            return tag.removeprefix("customer:")
+    return None
+
+
+def label_job_config(job_config, stage):
+    """Add the current labels and `stage` to a job config"""
+    job_config.labels = {
+        **(job_config.labels or {}),
+        **_job_labels.get(),
+        "stage": _clean_label_value(stage),
+    }
+    return job_config
+
+
+def start_query(
+    client: bigquery.Client,
+    query: str,
+    job_config: bigquery.QueryJobConfig | None = None,
+    stage: str = "query",
+) -> bigquery.QueryJob:
+    """Start a labeled query job and record it for statistics"""
+    job_config = label_job_config(job_config or bigquery.QueryJobConfig(), stage)
+    job = client.query(query, job_config=job_config)
+    if not job_config.dry_run:
+        track_job(job)
+    return job
+
+
+def track_job(job):
+    recorded_jobs = _recorded_jobs.get()
+    if recorded_jobs is not None:
+        recorded_jobs.append(job)
+
+
+@contextmanager
+def record_jobs(name: str):
+    """Collect jobs started inside the block and emit their statistics
+
+    Nested blocks add their jobs to the outermost block, which emits them.
+    """
+    if _recorded_jobs.get() is not None:
+        yield
+        return
+
+    recorded_jobs = []
+    token = _recorded_jobs.set(recorded_jobs)
+    try:
+        yield
+    finally:
+        _recorded_jobs.reset(token)
+        # Statistics are informational, so failing to collect or emit them
+        # mustn't fail the run.
+        try:
+            emit_job_statistics(
+                name, [get_job_statistics(job) for job in recorded_jobs]
+            )
+        except Exception as e:
+            get_logger().warning(f"Failed to emit BigQuery job statistics: {e}")
+
+
+def get_job_statistics(job) -> dict:
+    if job.state != "DONE":
+        job.reload()
+    wall_time_seconds = (
+        (job.ended - job.started).total_seconds() if job.started and job.ended else None
+    )
+    return {
+        "job_id": job.job_id,
+        "job_type": job.job_type,
+        **(job.labels or {}),
+        "started": job.started.isoformat() if job.started else None,
+        "ended": job.ended.isoformat() if job.ended else None,
+        "wall_time_seconds": wall_time_seconds,
+        "total_bytes_processed": getattr(job, "total_bytes_processed", None),
+        "total_bytes_billed": getattr(job, "total_bytes_billed", None),
+        "total_slot_ms": getattr(job, "slot_millis", None),
+        "cache_hit": getattr(job, "cache_hit", None),
+        "error": (job.error_result or {}).get("message"),
+    }
+
+
+def emit_job_statistics(name: str, job_statistics: list[dict]):
+    logger = get_logger()
+    for statistics in job_statistics:
+        logger.info("BigQuery job: %s", json.dumps(statistics))
+
+    totals = {
+        "name": name,
+        "job_count": len(job_statistics),
+        **{
+            key: sum(statistics[key] or 0 for statistics in job_statistics)
+            for key in ("total_bytes_processed", "total_bytes_billed", "total_slot_ms")
+        },
+    }
+    logger.info("BigQuery jobs summary: %s", json.dumps(totals))
+
+    _emit_spans(name, job_statistics)
+    _create_artifact(name, job_statistics)
+
+
+def _emit_spans(name, job_statistics):
+    if trace is None:
+        return
+
+    tracer = trace.get_tracer(__name__)
+    for statistics in job_statistics:
+        if statistics["started"] is None or statistics["ended"] is None:
+            continue
+        span = tracer.start_span(
+            f"bigquery {statistics.get('stage', 'job')}",
+            start_time=_to_nanoseconds(statistics["started"]),
+            attributes={
+                "prefect_qbi.run": name,
+                **{
+                    f"bigquery.{key}": value
+                    for key, value in statistics.items()
+                    if value is not None
+                },
+            },
+        )
+        span.end(end_time=_to_nanoseconds(statistics["ended"]))
+
+
+def _to_nanoseconds(isoformat):
+    return int(datetime.fromisoformat(isoformat).timestamp() * 1e9)
+
+
+def _create_artifact(name, job_statistics):
+    from prefect.context import FlowRunContext, TaskRunContext
+
+    if not (FlowRunContext.get() or TaskRunContext.get()) or not job_statistics:
+        return
+
+    from prefect.artifacts import create_table_artifact
+
+    create_table_artifact(
+        table=job_statistics,
+        key=f"bigquery-jobs-{re.sub(r'[^a-z0-9-]', '-', name.lower())}",
+        description=f"BigQuery jobs of {name}",
+    )
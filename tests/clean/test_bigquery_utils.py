@@ -0,0 +1,59 @@
+from unittest import mock
+
+import pytest
+from google.cloud import bigquery
+
+from prefect_qbi.clean.bigquery_utils import get_column_type_ddl, query_rows
+
+
+class TestQueryRows:
+    def test_rest_transport_iterates_job(self):
+        client = mock.Mock()
+
+        job, rows = query_rows(client, "SELECT 1")
+
+        assert job is rows is client.query.return_value
+
+    def test_storage_transport_streams_record_batches(self):
+        client = mock.Mock()
+        record_batches = [
+            mock.Mock(to_pylist=lambda: [{"a": 1}, {"a": 2}]),
+            mock.Mock(to_pylist=lambda: [{"a": 3}]),
+        ]
+        result = client.query.return_value.result.return_value
+        result.to_arrow_iterable.return_value = iter(record_batches)
+
+        _, rows = query_rows(client, "SELECT 1", transport="storage")
+
+        assert [row["a"] for row in rows] == [1, 2, 3]
+        result.to_arrow_iterable.assert_called_once_with(
+            bqstorage_client=client._ensure_bqstorage_client.return_value
+        )
+
+    def test_storage_transport_requires_optional_packages(self):
+        client = mock.Mock()
+        client._ensure_bqstorage_client.return_value = None
+
+        with pytest.raises(RuntimeError, match="google-cloud-bigquery-storage"):
+            query_rows(client, "SELECT 1", transport="storage")
+
+
+class TestGetColumnTypeDdl:
+    @pytest.mark.parametrize(
+        "field,expected",
+        [
+            (bigquery.SchemaField("a", "INTEGER"), "INT64"),
+            (bigquery.SchemaField("a", "STRING", mode="REQUIRED"), "STRING NOT NULL"),
+            (bigquery.SchemaField("a", "FLOAT", mode="REPEATED"), "ARRAY<FLOAT64>"),
+            (
+                bigquery.SchemaField(
+                    "a",
+                    "RECORD",
+                    fields=[bigquery.SchemaField("b", "BOOLEAN", mode="REQUIRED")],
+                ),
+                "STRUCT<`b` BOOL NOT NULL>",
+            ),
+        ],
+    )
+    def test_get_column_type_ddl(self, field, expected):
+        assert get_column_type_ddl(field) == expected
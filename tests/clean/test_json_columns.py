@@ -0,0 +1,260 @@
+import json
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+
+from prefect_qbi.clean import CleanConfig, LocalFileStateStore
+from prefect_qbi.clean.json_columns import (
+    analyze_json_value,
+    get_json_loads,
+    infer_columns_from_json_by_sampling,
+    infer_schema_for_column,
+    infer_schema_from_json_values,
+    schema_from_json,
+    schema_from_type_summary,
+    schema_to_json,
+)
+
+
+class _Job(list):
+    total_bytes_billed = 0
+
+
+def _make_rows(values, extracted_at=None, column_index=0):
+    return _Job(
+        {
+            "column_index": column_index,
+            "value": json.dumps(value),
+            "_sample_extracted_at": extracted_at,
+        }
+        for value in values
+    )
+
+
+class TestSchemaJson:
+    def test_round_trip(self):
+        schema = {
+            None: {
+                "data_type": "JSON",
+                "mode": "NULLABLE",
+                "special_data_type": None,
+                "create_subtable": True,
+                "subcolumns": {
+                    "a": {
+                        "data_type": "INT64",
+                        "mode": "NULLABLE",
+                        "special_data_type": None,
+                    }
+                },
+            }
+        }
+
+        schema_json = json.loads(json.dumps(schema_to_json(schema)))
+
+        assert schema_from_json(schema_json) == schema
+
+
+class TestSchemaCache:
+    def test_only_new_rows_are_sampled_and_merged(self, tmp_path):
+        config = CleanConfig(
+            state_store=LocalFileStateStore(tmp_path / "state.json"),
+            cache_json_schemas=True,
+        )
+        first_extracted_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        client = mock.Mock()
+        client.query.side_effect = [
+            _make_rows([{"a": 1}], first_extracted_at),
+            _make_rows([{"b": "x"}], datetime(2024, 1, 2, tzinfo=timezone.utc)),
+        ]
+
+        infer_schema_for_column(
+            client, "data", "p.d.t", True, config, "_airbyte_extracted_at"
+        )
+        schema = infer_schema_for_column(
+            client, "data", "p.d.t", True, config, "_airbyte_extracted_at"
+        )
+
+        assert schema["a"]["data_type"] == "INT64"
+        assert schema["b"]["data_type"] == "STRING"
+        job_config = client.query.call_args_list[1].kwargs["job_config"]
+        extracted_after = job_config.query_parameters[0].value
+        assert extracted_after == first_extracted_at
+
+
+class TestBatchSampling:
+    def test_all_columns_are_sampled_in_one_query(self):
+        client = mock.Mock()
+        client.query.return_value = _Job(
+            _make_rows([{"a": 1}], column_index=0)
+            + _make_rows([[1, 2]], column_index=1)
+        )
+
+        schemas = infer_columns_from_json_by_sampling(
+            client,
+            ["object_column", "array_column"],
+            "p.d.t",
+            True,
+            CleanConfig(batch_json_sampling=True),
+        )
+
+        client.query.assert_called_once()
+        assert schemas["object_column"]["a"]["data_type"] == "INT64"
+        assert schemas["array_column"][None]["data_type"] == "INT64"
+
+
+class TestAnalysisInProcesses:
+    def test_processes_give_sequential_schemas(self):
+        values = [{"a": i, "b": None if i % 3 else "x"} for i in range(2500)]
+        client = mock.Mock()
+        client.query.return_value = _Job(
+            _make_rows(values, column_index=0)
+            + _make_rows([[{"sku": i}] for i in range(10)], column_index=1)
+        )
+
+        sequential_schemas, parallel_schemas = [
+            infer_columns_from_json_by_sampling(
+                client,
+                ["object_column", "array_column"],
+                "p.d.t",
+                True,
+                CleanConfig(batch_json_sampling=True, analysis_processes=processes),
+            )
+            for processes in (1, 2)
+        ]
+
+        assert parallel_schemas == sequential_schemas
+        assert parallel_schemas["object_column"]["b"]["data_type"] == "STRING"
+
+
+class TestSchemaFromTypeSummary:
+    def _summary_row(self, kind, key, value_type):
+        return {"kind": kind, "key": key, "value_type": value_type, "row_count": 1}
+
+    def test_objects_match_sampled_schema(self):
+        values = [{"a": 1, "b": "x"}, {"a": 1.5, "b": None, "c": True}]
+        summary = [
+            self._summary_row("value", None, "object"),
+            self._summary_row("object_key", "a", "INT64"),
+            self._summary_row("object_key", "a", "FLOAT64"),
+            self._summary_row("object_key", "b", "STRING"),
+            self._summary_row("object_key", "b", "NULL"),
+            self._summary_row("object_key", "c", "BOOL"),
+        ]
+
+        expected = infer_schema_from_json_values(
+            "data", (json.dumps(value) for value in values), True
+        )
+
+        assert schema_from_type_summary("data", summary, True) == expected
+
+    def test_arrays_of_objects_match_sampled_schema(self):
+        values = [[{"a": 1}, {"b": [1]}], []]
+        summary = [
+            self._summary_row("value", None, "array"),
+            self._summary_row("array", None, "JSON"),
+            self._summary_row("array", None, ""),
+            self._summary_row("array_object_key", "a", "INT64"),
+            self._summary_row("array_object_key", "b", "JSON"),
+        ]
+
+        expected = infer_schema_from_json_values(
+            "data", (json.dumps(value) for value in values), True
+        )
+
+        assert schema_from_type_summary("data", summary, True) == expected
+
+    def test_string_and_number_arrays_become_csv(self):
+        summary = [
+            self._summary_row("value", None, "array"),
+            self._summary_row("array", None, "INT64"),
+            self._summary_row("array", None, "STRING"),
+        ]
+
+        schema = schema_from_type_summary("data", summary, True)
+
+        assert schema[None]["special_data_type"] == "csv"
+
+
+class TestSamplingStrategies:
+    @pytest.mark.parametrize(
+        "config,expected",
+        [
+            (CleanConfig(), "FROM `p.d.t`"),
+            (
+                CleanConfig(sampling_strategy="tablesample", sampling_percent=5),
+                "TABLESAMPLE SYSTEM (5 PERCENT)",
+            ),
+            (
+                CleanConfig(sampling_strategy="recent", sampling_window_days=3),
+                "INTERVAL 3 DAY",
+            ),
+            (
+                CleanConfig(
+                    sampling_strategy="byte_budget", sampling_byte_budget=10**9
+                ),
+                "TABLESAMPLE SYSTEM (10.000 PERCENT)",
+            ),
+        ],
+    )
+    def test_sample_query(self, config, expected):
+        client = mock.Mock()
+        client.get_table.return_value.num_bytes = 10**10
+        client.query.return_value = _make_rows([{"a": 1}])
+
+        infer_schema_for_column(
+            client, "data", "p.d.t", True, config, "_airbyte_extracted_at"
+        )
+
+        assert expected in client.query.call_args.args[0]
+
+
+class TestJsonDecoding:
+    @pytest.mark.parametrize("decoder", ["json", "orjson", "auto"])
+    def test_decoders_give_same_schema(self, decoder):
+        values = ['{"a": 1, "b": 1}', '{"a": 1.5, "b": NaN, "c": [1]}']
+
+        schema = infer_schema_from_json_values(
+            "data", values, True, get_json_loads(decoder)
+        )
+
+        assert schema == infer_schema_from_json_values("data", values, True)
+        assert schema["a"]["data_type"] == "FLOAT64"
+        assert schema["b"]["data_type"] == "FLOAT64"
+
+    def test_decoded_values_are_not_parsed_again(self):
+        loads = mock.Mock()
+
+        schema = analyze_json_value("data", {"a": True}, {}, True, loads)
+
+        loads.assert_not_called()
+        assert schema["a"]["data_type"] == "BOOL"
+
+
+class TestAdaptiveSampling:
+    def _infer(self, values):
+        rows = _make_rows(values)
+        client = mock.Mock()
+        client.query.return_value = rows
+        config = CleanConfig(
+            adaptive_sampling=True, sampling_page_size=10, sampling_stable_pages=2
+        )
+        with mock.patch("builtins.print") as print_:
+            schema = infer_schema_for_column(client, "data", "p.d.t", True, config)
+        return schema, client.query.call_args.args[0], print_
+
+    def test_stable_column_stops_early(self):
+        schema, query, print_ = self._infer([{"a": i} for i in range(1000)])
+
+        # Pages of 10, 20 and 40 rows, the last two adding nothing new.
+        print_.assert_any_call("  data: 70 row(s) needed.")
+        assert schema["a"]["data_type"] == "INT64"
+        assert "LIMIT 100000" in query
+
+    def test_changing_column_is_sampled_longer(self):
+        values = [{f"key{i // 25}": i} for i in range(1000)]
+
+        schema, _, print_ = self._infer(values)
+
+        print_.assert_any_call("  data: 1000 row(s) needed (did not converge).")
+        assert len(schema) == 40
@@ -0,0 +1,311 @@
+import json
+from unittest import mock
+
+import pytest
+from google.cloud import bigquery
+
+from prefect_qbi.clean import CleanConfig, LocalFileStateStore
+from prefect_qbi.clean.m_files_transform import (
+    _convert_like_lax,
+    record_file_fingerprints,
+    transform_json_column_to_tables,
+)
+
+
+def _make_client(rows):
+    client = mock.Mock()
+    client.get_table.return_value.schema = [
+        bigquery.SchemaField("ObjectID", "INT64"),
+        bigquery.SchemaField("FileID", "INT64"),
+        bigquery.SchemaField("FileName", "STRING"),
+        bigquery.SchemaField("ContentJson", "STRING"),
+    ]
+    client.query.return_value = rows
+    return client
+
+
+def _transform(client, config=None):
+    return list(
+        transform_json_column_to_tables(
+            client,
+            "project",
+            "m_files",
+            "destination",
+            "objects_files_contents",
+            ["ObjectID", "FileID"],
+            "FileName",
+            "ContentJson",
+            config,
+        )
+    )
+
+
+class TestTransformJsonColumnToTables:
+    def test_all_files_are_inferred_from_one_query(self):
+        client = _make_client(
+            [
+                {
+                    "ObjectID": 1,
+                    "FileID": 10,
+                    "FileName": "Budget",
+                    "ContentJson": json.dumps(
+                        {
+                            "Sheet1": [{"Amount": 1}, {"Amount": 2.5}],
+                            "Sheet2": [{"Name": "a"}],
+                        }
+                    ),
+                },
+                {
+                    "ObjectID": 2,
+                    "FileID": 20,
+                    "FileName": "Sales",
+                    "ContentJson": json.dumps([{"Count": 3, "Done": True}]),
+                },
+            ]
+        )
+
+        specs = _transform(client)
+
+        client.get_table.assert_called_once()
+        client.query.assert_called_once()
+        assert "LANGUAGE js" not in client.query.call_args.args[0]
+        assert [spec["name"] for spec in specs] == [
+            "budget__sheet1__1_10",
+            "budget__sheet2__1_10",
+            "sales__2_20",
+        ]
+        assert [
+            [(field.name, field.field_type) for field in spec["schema_list"]]
+            for spec in specs
+        ] == [
+            [("amount", "FLOAT64")],
+            [("name", "STRING")],
+            [("count", "INT64"), ("done", "BOOL")],
+        ]
+        assert [parameter.value for parameter in specs[1]["query_parameters"]] == [
+            '$."Sheet2"',
+            1,
+            10,
+        ]
+
+    def test_rows_are_parsed_for_load_jobs(self):
+        client = _make_client(
+            [
+                {
+                    "ObjectID": 1,
+                    "FileID": 10,
+                    "FileName": "Budget",
+                    "ContentJson": json.dumps(
+                        [{"Amount": 1, "Note": "a"}, {"Amount": 2.5}, {"Note": "c"}]
+                    ),
+                }
+            ]
+        )
+
+        (spec,) = _transform(client, CleanConfig(m_files_materialization="load"))
+
+        assert spec["rows"] == [
+            {"amount": 1.0, "note": "a"},
+            {"amount": 2.5, "note": None},
+            {"amount": None, "note": "c"},
+        ]
+
+    @pytest.mark.parametrize("materialization", ["query", "load"])
+    def test_files_analyzed_in_processes_give_same_tables(self, materialization):
+        rows = [
+            {
+                "ObjectID": i,
+                "FileID": i,
+                "FileName": f"File{i}",
+                "ContentJson": json.dumps(
+                    {"Sheet1": [{"Amount": i}, {"Amount": 0.5, "Note": "a"}]}
+                    if i % 2
+                    else [{"Count": i, "Done": True}]
+                ),
+            }
+            for i in range(10)
+        ]
+
+        sequential_specs, parallel_specs = [
+            _transform(
+                _make_client(rows),
+                CleanConfig(
+                    m_files_materialization=materialization,
+                    analysis_processes=processes,
+                ),
+            )
+            for processes in (1, 2)
+        ]
+
+        assert parallel_specs == sequential_specs
+
+
+@pytest.mark.parametrize(
+    "value, data_type, expected",
+    [
+        (2.5, "INT64", 3),
+        (-2.5, "INT64", -3),
+        ("12", "INT64", 12),
+        (True, "INT64", 1),
+        ("abc", "INT64", None),
+        (True, "FLOAT64", None),
+        ("1.5", "FLOAT64", 1.5),
+        ("TRUE", "BOOL", True),
+        (0, "BOOL", False),
+        (False, "STRING", "false"),
+        ({"a": 1}, "STRING", None),
+        ({"a": 1}, "JSON", {"a": 1}),
+    ],
+)
+def test_values_are_converted_like_lax_functions(value, data_type, expected):
+    assert _convert_like_lax(value, data_type) == expected
+
+
+class TestFileFingerprints:
+    FILES = [
+        {"ObjectID": 1, "FileID": 10, "FileName": "Budget", "_fingerprint": 111},
+        {"ObjectID": 2, "FileID": 20, "FileName": "Sales", "_fingerprint": 222},
+    ]
+
+    def _make_client(self, files, existing_table_names=()):
+        client = _make_client([])
+        client.list_tables.return_value = [
+            mock.Mock(table_id=table_name) for table_name in existing_table_names
+        ]
+
+        def query(query, job_config=None):
+            if "@files" not in query:
+                return [dict(file) for file in files]
+            return [
+                {**file, "ContentJson": json.dumps([{"Amount": 1}])}
+                for file in files
+                if self._get_file_values(file)
+                in self._get_queried_file_values(job_config)
+            ]
+
+        client.query.side_effect = query
+        return client
+
+    @staticmethod
+    def _get_file_values(file):
+        return (file["ObjectID"], file["FileID"], file["_fingerprint"])
+
+    @staticmethod
+    def _get_queried_file_values(job_config):
+        return [
+            tuple(struct_value.struct_values.values())
+            for struct_value in job_config.query_parameters[0].values
+        ]
+
+    def _transform(self, client, state_store):
+        return list(
+            transform_json_column_to_tables(
+                client,
+                "project",
+                "m_files",
+                "destination",
+                "objects_files_contents",
+                ["ObjectID", "FileID"],
+                "FileName",
+                "ContentJson",
+                CleanConfig(state_store=state_store),
+                "p",
+            )
+        )
+
+    def test_only_changed_files_are_rebuilt(self, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "state.json")
+        specs = self._transform(self._make_client(self.FILES), state_store)
+        assert [(spec["name"], spec.get("action")) for spec in specs] == [
+            ("budget__1_10", None),
+            ("sales__2_20", None),
+        ]
+        record_file_fingerprints(state_store, specs)
+
+        changed_files = [self.FILES[0], {**self.FILES[1], "_fingerprint": 333}]
+        client = self._make_client(changed_files, ["p__budget__1_10", "p__sales__2_20"])
+        specs = self._transform(client, state_store)
+
+        assert [(spec["name"], spec.get("action")) for spec in specs] == [
+            ("budget__1_10", "keep"),
+            ("sales__2_20", None),
+        ]
+        content_query = client.query.call_args_list[-1]
+        assert self._get_queried_file_values(content_query.kwargs["job_config"]) == [
+            (2, 20, 333)
+        ]
+
+    def test_unchanged_file_with_same_content_as_changed_file_is_kept(self, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "state.json")
+        record_file_fingerprints(
+            state_store, self._transform(self._make_client(self.FILES), state_store)
+        )
+
+        # The changed file now has the same content as the unchanged one.
+        changed_files = [self.FILES[0], {**self.FILES[1], "_fingerprint": 111}]
+        client = self._make_client(changed_files, ["p__budget__1_10", "p__sales__2_20"])
+        specs = self._transform(client, state_store)
+
+        assert [(spec["name"], spec.get("action")) for spec in specs] == [
+            ("budget__1_10", "keep"),
+            ("sales__2_20", None),
+        ]
+        record_file_fingerprints(state_store, specs)
+        assert state_store.get(specs[0]["file_fingerprint"]["state_key"]) == {
+            "1_10": {
+                "fingerprint": 111,
+                "file_name": "Budget",
+                "tables": ["budget__1_10"],
+            },
+            "2_20": {
+                "fingerprint": 111,
+                "file_name": "Sales",
+                "tables": ["sales__2_20"],
+            },
+        }
+
+    def test_renamed_file_is_rebuilt_under_its_new_name(self, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "state.json")
+        record_file_fingerprints(
+            state_store, self._transform(self._make_client(self.FILES), state_store)
+        )
+
+        # The content, and so the fingerprint, of the renamed file is the same.
+        renamed_files = [self.FILES[0], {**self.FILES[1], "FileName": "Revenue"}]
+        client = self._make_client(renamed_files, ["p__budget__1_10", "p__sales__2_20"])
+        specs = self._transform(client, state_store)
+
+        assert [(spec["name"], spec.get("action")) for spec in specs] == [
+            ("budget__1_10", "keep"),
+            ("revenue__2_20", None),
+            ("sales__2_20", "drop"),
+        ]
+        record_file_fingerprints(state_store, specs)
+        assert state_store.get(specs[0]["file_fingerprint"]["state_key"])["2_20"] == {
+            "fingerprint": 222,
+            "file_name": "Revenue",
+            "tables": ["revenue__2_20"],
+        }
+
+    def test_tables_of_removed_files_are_dropped(self, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "state.json")
+        record_file_fingerprints(
+            state_store, self._transform(self._make_client(self.FILES), state_store)
+        )
+
+        client = self._make_client(
+            self.FILES[:1], ["p__budget__1_10", "p__sales__2_20"]
+        )
+        specs = self._transform(client, state_store)
+
+        assert [(spec["name"], spec.get("action")) for spec in specs] == [
+            ("budget__1_10", "keep"),
+            ("sales__2_20", "drop"),
+        ]
+        # Nothing changed, so the content isn't queried.
+        assert client.query.call_count == 1
+
+        record_file_fingerprints(state_store, specs)
+        assert list(state_store.get(specs[0]["file_fingerprint"]["state_key"])) == [
+            "1_10"
+        ]
@@ -0,0 +1,146 @@
+import itertools
+import json
+
+import pytest
+
+from prefect_qbi.clean.json_columns import infer_schema_from_json_values
+from prefect_qbi.clean.schema_sketch import (
+    merge_sketches,
+    sketch_from_schema,
+    sketch_json_values,
+    sketch_to_schema,
+)
+
+VALUES = [
+    json.dumps(value)
+    for value in [
+        {"a": 1, "b": None},
+        {"a": 1.5, "c": "x"},
+        {"b": True, "d": {"e": 1}},
+        None,
+        "a JSON string",
+        {"a": 2, "b": 3, "c": None},
+    ]
+]
+
+ARRAY_VALUES = [
+    json.dumps(value)
+    for value in [
+        [{"sku": 1}, {"sku": "A1", "quantity": 2}],
+        [],
+        [None, {"price": 1.5}],
+    ]
+]
+
+
+def _sketch_chunks(values, chunk_size=2):
+    return [
+        sketch_json_values("data", values[i : i + chunk_size], True)
+        for i in range(0, len(values), chunk_size)
+    ]
+
+
+class TestSchemaSketch:
+    @pytest.mark.parametrize(
+        "values",
+        [
+            VALUES,
+            ARRAY_VALUES,
+            [json.dumps(value) for value in [[1, 2], ["a"], [3, None]]],
+            [json.dumps(value) for value in [["a"], ["b", None]]],
+        ],
+    )
+    def test_merged_sketches_give_sampled_schema(self, values):
+        sketch = merge_sketches(*_sketch_chunks(values))
+
+        assert sketch_to_schema(sketch) == infer_schema_from_json_values(
+            "data", values, True
+        )
+
+    def test_merge_is_associative_and_commutative(self):
+        sketches = _sketch_chunks(VALUES + ARRAY_VALUES)
+
+        merged = merge_sketches(*sketches)
+
+        for permutation in itertools.permutations(sketches):
+            assert merge_sketches(*permutation) == merged
+        assert merge_sketches(
+            merge_sketches(sketches[0], sketches[1]), *sketches[2:]
+        ) == merge_sketches(sketches[0], merge_sketches(*sketches[1:]))
+        assert sketches == _sketch_chunks(VALUES + ARRAY_VALUES)
+
+    def test_counts(self):
+        sketch = merge_sketches(*_sketch_chunks(VALUES))
+
+        assert sketch["rows"] == 6
+        assert sketch["objects"] == 4
+        assert sketch["keys"]["b"] == {
+            "count": 3,
+            "null_count": 1,
+            "types": {"BOOL": 1, "INT64": 1},
+        }
+        assert json.loads(json.dumps(sketch)) == sketch
+
+    def test_schema_round_trip(self):
+        schema = infer_schema_from_json_values("data", VALUES + ARRAY_VALUES, True)
+
+        assert sketch_to_schema(sketch_from_schema(schema)) == schema
+
+    def test_string_arrays_are_csv(self):
+        sketch = sketch_json_values("data", [json.dumps(["a", "b"]), '["c"]'], True)
+
+        assert sketch_to_schema(sketch) == {
+            None: {
+                "data_type": "STRING",
+                "mode": "NULLABLE",
+                "special_data_type": "csv",
+                "create_subtable": True,
+            }
+        }
+
+    @pytest.mark.parametrize(
+        "arrays",
+        [
+            [["a"], [1]],
+            [["a"], [0.5], [None]],
+            [[1], [0.5], ["a"]],
+            [[True], ["a"]],
+            [[True], [False]],
+            [[1], [{"a": 1}]],
+            [[1], [0.5]],
+        ],
+    )
+    def test_mixed_arrays_give_sequential_schema_of_every_order(self, arrays):
+        schemas = []
+        for permutation in itertools.permutations(arrays):
+            try:
+                schemas.append(
+                    infer_schema_from_json_values(
+                        "data", [json.dumps(array) for array in permutation], True
+                    )
+                )
+            except RuntimeError:
+                schemas.append(None)
+        sketch = sketch_json_values("data", [json.dumps(a) for a in arrays], True)
+
+        if all(schema == schemas[0] for schema in schemas) and schemas[0]:
+            assert sketch_to_schema(sketch) == schemas[0]
+        else:
+            with pytest.raises(RuntimeError, match="Schema conflict"):
+                sketch_to_schema(sketch)
+
+    @pytest.mark.parametrize(
+        "arrays, error",
+        [
+            ([[1], [0.5]], "Schema conflict"),
+            ([[1], [0.5], ["a"]], "Schema conflict"),
+            ([[True], ["a"]], "Schema conflict"),
+            ([[1], [{"a": 1}]], "Schema conflict"),
+            ([[1, "a"]], "Unhandled type"),
+        ],
+    )
+    def test_array_conflicts(self, arrays, error):
+        sketch = sketch_json_values("data", arrays, True)
+
+        with pytest.raises(RuntimeError, match=error):
+            sketch_to_schema(sketch)
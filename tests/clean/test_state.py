@@ -0,0 +1,44 @@
+from unittest import mock
+
+import pytest
+
+from prefect_qbi.clean import BigQueryStateStore
+
+
+class TestBigQueryStateStore:
+    def test_writes_are_flushed_with_one_merge(self):
+        client = mock.Mock()
+        client.query.side_effect = [[], mock.Mock()]
+        state_store = BigQueryStateStore(client, "project", "dataset")
+
+        state_store.set("a", {"value": 1})
+        state_store.set("b", [1, 2])
+        state_store.set("a", {"value": 2})
+
+        assert state_store.get("a") == {"value": 2}
+        # Only the query reading the table.
+        assert client.query.call_count == 1
+
+        state_store.flush()
+        state_store.flush()
+
+        assert client.query.call_count == 2
+        merge_query = client.query.call_args.args[0]
+        assert "MERGE `project.dataset._quickbi_clean_state`" in merge_query
+        (entries,) = client.query.call_args.kwargs["job_config"].query_parameters
+        assert [
+            (entry.struct_values["key"], entry.struct_values["value"])
+            for entry in entries.values
+        ] == [("a", '{"value": 2}'), ("b", "[1, 2]")]
+
+    def test_failed_flush_keeps_writes(self):
+        client = mock.Mock()
+        client.query.side_effect = [[], RuntimeError("boom"), mock.Mock()]
+        state_store = BigQueryStateStore(client, "project", "dataset")
+        state_store.set("a", 1)
+
+        with pytest.raises(RuntimeError):
+            state_store.flush()
+        state_store.flush()
+
+        assert client.query.call_count == 3
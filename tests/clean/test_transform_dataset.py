@@ -0,0 +1,75 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from prefect_qbi import clean
+from prefect_qbi.clean import CleanConfig, transform_dataset
+
+
+def _make_table(table_id, num_bytes):
+    return mock.Mock(table_id=table_id, num_bytes=num_bytes)
+
+
+class TestTransformDataset:
+    @pytest.fixture
+    def client(self):
+        client = mock.Mock()
+        client.get_dataset.return_value.location = "EU"
+        tables = [
+            _make_table("small", 10),
+            _make_table("large", 1000),
+            _make_table("medium", 100),
+        ]
+        client.list_tables.return_value = tables
+        client.get_table.side_effect = lambda table: table
+        return client
+
+    def test_tables_are_started_largest_first(self, client):
+        with mock.patch.object(clean, "transform_table") as transform_table:
+            transform_dataset(client, "project", "source", "destination", "prefix")
+
+        started = [call.args[4] for call in transform_table.call_args_list]
+        assert started == ["large", "medium", "small"]
+
+    def test_table_metadata_is_fetched_concurrently(self, client):
+        # Fails unless all three tables are fetched at the same time.
+        barrier = threading.Barrier(3, timeout=5)
+
+        def get_table(table):
+            barrier.wait()
+            return table
+
+        client.get_table.side_effect = get_table
+
+        with mock.patch.object(clean, "transform_table") as transform_table:
+            transform_dataset(
+                client,
+                "project",
+                "source",
+                "destination",
+                "prefix",
+                CleanConfig(max_concurrent_tables=3),
+            )
+
+        assert transform_table.call_count == 3
+
+    def test_failing_table_does_not_stop_others(self, client):
+        def fail_medium(*args, **kwargs):
+            if args[4] == "medium":
+                raise ValueError("boom")
+
+        with mock.patch.object(
+            clean, "transform_table", side_effect=fail_medium
+        ) as transform_table:
+            with pytest.raises(RuntimeError, match="1 table\\(s\\): medium"):
+                transform_dataset(
+                    client,
+                    "project",
+                    "source",
+                    "destination",
+                    "prefix",
+                    CleanConfig(max_concurrent_tables=2),
+                )
+
+        assert transform_table.call_count == 3
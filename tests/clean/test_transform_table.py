@@ -0,0 +1,557 @@
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+from google.cloud import bigquery
+
+from prefect_qbi import clean
+from prefect_qbi.clean import (
+    BytesBudget,
+    BytesBudgetExceeded,
+    CleanConfig,
+    LocalFileStateStore,
+    plan_table,
+    transform_table,
+)
+
+SCHEMA = [
+    bigquery.SchemaField("id", "INT64"),
+    bigquery.SchemaField("_row_extracted_at", "TIMESTAMP", mode="REQUIRED"),
+]
+
+
+def _make_spec(name, array_column=None):
+    return {
+        "name": name,
+        "schema_list": SCHEMA,
+        "query_select_list": ["`id`", "`_airbyte_extracted_at`"],
+        "query_from": "`project.source.table`",
+        "source_table_ref": "project.source.table",
+        "array_column": array_column,
+        "incremental_column": "_airbyte_extracted_at",
+        "merge_key": None,
+    }
+
+
+def _make_client():
+    client = mock.Mock()
+    client.list_tables.return_value = []
+    return client
+
+
+@pytest.fixture
+def specs():
+    return [_make_spec("table"), _make_spec("table__items", "items")]
+
+
+@pytest.fixture
+def iter_specs(specs):
+    """Make transform_table produce `specs`, which tests can override or change"""
+    with mock.patch.object(
+        clean,
+        "_iter_destination_table_specs",
+        side_effect=lambda *args, **kwargs: iter(specs),
+    ) as iter_specs:
+        yield iter_specs
+
+
+@pytest.mark.usefixtures("iter_specs")
+class TestTransformTable:
+    def test_insert_jobs_are_submitted_before_waiting(self, specs):
+        client = _make_client()
+        events = []
+        client.query.side_effect = lambda query, job_config=None: mock.Mock(
+            result=lambda: events.append("result")
+        )
+        client.create_table.side_effect = lambda table: events.append("create")
+
+        transform_table(client, "project", "source", "destination", "table", "p")
+
+        # Two creates and inserts, then two waits, then the two renames.
+        assert events[:4] == ["create", "create", "result", "result"]
+
+    def test_tables_are_swapped_with_one_script(self, specs):
+        client = _make_client()
+
+        transform_table(client, "project", "source", "destination", "table", "p")
+
+        swap_script = client.query.call_args_list[-1].args[0]
+        assert swap_script.count("DROP TABLE IF EXISTS") == 2
+        assert swap_script.count("RENAME TO") == 2
+        assert swap_script.rindex("DROP") < swap_script.index("RENAME")
+        client.delete_table.assert_not_called()
+
+    def test_replace_materialization_uses_one_job_per_table(self, specs):
+        client = _make_client()
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(materialization="replace"),
+        )
+
+        queries = [call.args[0] for call in client.query.call_args_list]
+        assert len(queries) == 2
+        assert all("CREATE OR REPLACE TABLE" in query for query in queries)
+        assert "`_row_extracted_at` TIMESTAMP NOT NULL" in queries[0]
+        client.create_table.assert_not_called()
+        client.delete_table.assert_not_called()
+
+    def test_stale_shards_are_dropped(self):
+        client = _make_client()
+        client.list_tables.return_value = [
+            mock.Mock(table_id=table_name)
+            for table_name in [
+                "p__table",
+                "p__table__part_2",
+                "p__table__items__part_2",
+                "p__other__part_2",
+            ]
+        ]
+
+        transform_table(
+            client, "project", "source", "destination", "table", "p", CleanConfig()
+        )
+
+        assert [call.args for call in client.delete_table.call_args_list] == [
+            ("project.destination.p__table__part_2",),
+            ("project.destination.p__table__items__part_2",),
+        ]
+
+    def test_replace_materialization_swaps_tables_whose_layout_changes(self, specs):
+        specs[0]["partition_field"] = "_row_extracted_at"
+        client = _make_client()
+        client.list_tables.return_value = [
+            mock.Mock(
+                table_id=f"p__{name}", time_partitioning=None, clustering_fields=None
+            )
+            for name in ("table", "table__items")
+        ]
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(materialization="replace"),
+        )
+
+        queries = [call.args[0] for call in client.query.call_args_list]
+        # The unpartitioned table can't be replaced by a partitioned one.
+        assert sum("CREATE OR REPLACE TABLE" in query for query in queries) == 1
+        (created_table,) = [call.args[0] for call in client.create_table.call_args_list]
+        assert created_table.table_id.startswith("p__table__temp_")
+        assert created_table.time_partitioning.field == "_row_extracted_at"
+        assert "RENAME TO `p__table`" in queries[-1]
+
+    def test_parsed_rows_are_loaded(self, specs):
+        specs[1]["rows"] = [{"id": 1, "_row_extracted_at": None}]
+        client = _make_client()
+
+        transform_table(client, "project", "source", "destination", "table", "p")
+
+        client.load_table_from_json.assert_called_once()
+        rows, table_ref = client.load_table_from_json.call_args.args
+        assert rows == specs[1]["rows"]
+        assert table_ref.startswith("project.destination.p__table__items__temp_")
+        # One insert and the swap script.
+        assert client.query.call_count == 2
+        assert client.query.call_args.args[0].count("RENAME TO") == 2
+
+    def test_kept_tables_are_skipped_and_dropped_tables_deleted(self, specs):
+        specs += [
+            {"name": "kept", "action": "keep"},
+            {"name": "removed", "action": "drop"},
+        ]
+        client = _make_client()
+
+        transform_table(client, "project", "source", "destination", "table", "p")
+
+        assert client.create_table.call_count == 2
+        client.delete_table.assert_called_once_with(
+            "project.destination.p__removed", not_found_ok=True
+        )
+
+    def test_temp_tables_are_removed_when_a_job_fails(self, specs):
+        client = _make_client()
+        failing_job = mock.Mock()
+        failing_job.result.side_effect = ValueError("boom")
+        client.query.side_effect = [mock.Mock(), failing_job]
+
+        with pytest.raises(ValueError):
+            transform_table(client, "project", "source", "destination", "table", "p")
+
+        deleted = [call.args[0] for call in client.delete_table.call_args_list]
+        assert len(deleted) == 2
+        assert all("__temp_" in table_ref for table_ref in deleted)
+
+
+@pytest.mark.usefixtures("iter_specs")
+class TestIncrementalTransformTable:
+    @pytest.fixture
+    def watermark_rows(self):
+        return [
+            {"table_index": 0, "max_value": datetime(2024, 1, 1, tzinfo=timezone.utc)},
+            {"table_index": 1, "max_value": datetime(2024, 1, 2, tzinfo=timezone.utc)},
+        ]
+
+    @pytest.fixture
+    def client(self, watermark_rows):
+        client = _make_client()
+        client.get_table.return_value.time_partitioning = None
+        client.get_table.return_value.clustering_fields = None
+        client.get_table.return_value.num_rows = 5
+        client.get_table.return_value.schema = [
+            bigquery.SchemaField("id", "INTEGER"),
+            bigquery.SchemaField("_row_extracted_at", "TIMESTAMP", mode="REQUIRED"),
+        ]
+        client.query.side_effect = lambda query, job_config=None: (
+            watermark_rows
+            if "MAX(" in query
+            else [{"row_count": 5}]
+            if "COUNTIF(" in query
+            else mock.Mock()
+        )
+        return client
+
+    def test_new_rows_are_merged(self, client):
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        client.create_table.assert_not_called()
+        merges = [
+            call for call in client.query.call_args_list if "MERGE" in call.args[0]
+        ]
+        assert len(merges) == 2
+        watermark = merges[1].kwargs["job_config"].query_parameters[0]
+        assert watermark.value == datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    def test_reordered_columns_are_merged_by_name(self, client):
+        # The keys of JSON objects are sampled in a different order than on
+        # the previous run.
+        client.get_table.return_value.schema = SCHEMA[::-1]
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        client.create_table.assert_not_called()
+        merges = [
+            call.args[0]
+            for call in client.query.call_args_list
+            if "MERGE" in call.args[0]
+        ]
+        assert len(merges) == 2
+        assert (
+            "INSERT (`id`, `_row_extracted_at`) VALUES (`id`, `_row_extracted_at`)"
+            in merges[0]
+        )
+
+    def test_empty_subtable_gets_main_table_watermark(self, client, watermark_rows):
+        watermark_rows[1]["max_value"] = None
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        client.create_table.assert_not_called()
+        merges = [
+            call for call in client.query.call_args_list if "MERGE" in call.args[0]
+        ]
+        assert len(merges) == 2
+        watermark = merges[1].kwargs["job_config"].query_parameters[0]
+        assert watermark.value == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def test_empty_main_table_rebuilds_tables(self, client, watermark_rows):
+        watermark_rows[0]["max_value"] = None
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        assert client.create_table.call_count == 2
+
+    def test_replaced_source_rows_rebuild_tables(self, client):
+        # Airbyte overwrote or deduplicated the source since the previous run,
+        # so the source has fewer rows up to the watermark than the main table.
+        client.get_table.return_value.num_rows = 7
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        assert client.create_table.call_count == 2
+        assert not any("MERGE" in call.args[0] for call in client.query.call_args_list)
+
+    def test_merge_drops_and_records_m_files_tables(self, client, specs, tmp_path):
+        file_fingerprint = {
+            "state_key": "files",
+            "file_key": "1",
+            "fingerprint": 9,
+            "file_name": "File",
+        }
+        specs += [
+            {"name": "kept", "action": "keep", "file_fingerprint": file_fingerprint},
+            {"name": "removed", "action": "drop"},
+        ]
+        state_store = LocalFileStateStore(tmp_path / "state.json")
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True, state_store=state_store),
+        )
+
+        assert any("MERGE" in call.args[0] for call in client.query.call_args_list)
+        client.delete_table.assert_called_once_with(
+            "project.destination.p__removed", not_found_ok=True
+        )
+        assert state_store.get("files") == {
+            "1": {"fingerprint": 9, "file_name": "File", "tables": ["kept"]}
+        }
+
+    def test_changed_schema_rebuilds_tables(self, client):
+        client.get_table.return_value.schema = [bigquery.SchemaField("id", "STRING")]
+
+        transform_table(
+            client,
+            "project",
+            "source",
+            "destination",
+            "table",
+            "p",
+            CleanConfig(incremental=True),
+        )
+
+        assert client.create_table.call_count == 2
+        assert not any("MERGE" in call.args[0] for call in client.query.call_args_list)
+
+
+class TestSkipUnchangedTable:
+    @pytest.fixture
+    def client(self):
+        client = _make_client()
+        client.get_table.return_value = mock.Mock(
+            table_type="TABLE",
+            streaming_buffer=None,
+            modified=datetime(2024, 1, 1, tzinfo=timezone.utc),
+            num_rows=10,
+            num_bytes=100,
+        )
+        client.list_tables.return_value = [mock.Mock(table_id="p__table")]
+        return client
+
+    @pytest.fixture
+    def specs(self):
+        return [_make_spec("table")]
+
+    @pytest.fixture
+    def transform(self, client, iter_specs):
+        def transform(config):
+            """Return whether the table was transformed instead of skipped"""
+            call_count = iter_specs.call_count
+            transform_table(
+                client, "project", "source", "destination", "table", "p", config
+            )
+            return iter_specs.call_count > call_count
+
+        return transform
+
+    def test_unchanged_table_is_skipped(self, transform, tmp_path):
+        config = CleanConfig(state_store=LocalFileStateStore(tmp_path / "s.json"))
+
+        assert transform(config)
+        assert not transform(config)
+
+    def test_changed_table_is_transformed(self, client, transform, tmp_path):
+        config = CleanConfig(state_store=LocalFileStateStore(tmp_path / "s.json"))
+
+        assert transform(config)
+        client.get_table.return_value.num_rows = 11
+        assert transform(config)
+
+    def test_deleted_destination_table_is_transformed(
+        self, client, transform, tmp_path
+    ):
+        config = CleanConfig(state_store=LocalFileStateStore(tmp_path / "s.json"))
+
+        assert transform(config)
+        client.list_tables.return_value = []
+        assert transform(config)
+
+    @pytest.mark.parametrize(
+        "options",
+        [
+            {"max_columns_per_table": 100},
+            {"partition_min_bytes": 1},
+            {"table_layouts": {"table": {"cluster_fields": ["id"]}}},
+            {"materialization": "replace"},
+        ],
+    )
+    def test_changed_output_options_transform_unchanged_table(
+        self, transform, tmp_path, options
+    ):
+        state_store = LocalFileStateStore(tmp_path / "s.json")
+
+        assert transform(CleanConfig(state_store=state_store))
+        assert transform(CleanConfig(state_store=state_store, **options))
+        assert not transform(CleanConfig(state_store=state_store, **options))
+
+    def test_other_options_keep_skipping_unchanged_table(self, transform, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "s.json")
+
+        assert transform(CleanConfig(state_store=state_store))
+        assert not transform(
+            CleanConfig(state_store=state_store, max_concurrent_tables=4)
+        )
+
+    def test_upgrade_changing_output_transforms_unchanged_table(
+        self, transform, tmp_path
+    ):
+        config = CleanConfig(state_store=LocalFileStateStore(tmp_path / "s.json"))
+
+        assert transform(config)
+        with mock.patch.object(clean, "OUTPUT_VERSION", clean.OUTPUT_VERSION + 1):
+            assert transform(config)
+
+    def test_force_transforms_unchanged_table(self, transform, tmp_path):
+        state_store = LocalFileStateStore(tmp_path / "s.json")
+
+        assert transform(CleanConfig(state_store=state_store))
+        assert transform(CleanConfig(state_store=state_store, force=True))
+
+
+class TestDestinationTableLayout:
+    def test_tables_are_not_partitioned_by_default(self):
+        layout = clean._get_destination_table_layout(
+            "table", SCHEMA, [], 20 * 1024**3, CleanConfig()
+        )
+
+        assert layout == {"partition_field": None, "cluster_fields": []}
+
+    def test_large_tables_are_partitioned(self):
+        layout = clean._get_destination_table_layout(
+            "table",
+            SCHEMA,
+            [],
+            20 * 1024**3,
+            CleanConfig(partition_min_bytes=1024**3),
+        )
+
+        assert layout == {"partition_field": "_row_extracted_at", "cluster_fields": []}
+
+    def test_small_tables_are_not_partitioned(self):
+        layout = clean._get_destination_table_layout(
+            "table__items",
+            SCHEMA,
+            ["_quickbi_table_join_key"],
+            1024,
+            CleanConfig(partition_min_bytes=1024**3),
+        )
+
+        assert layout == {
+            "partition_field": None,
+            "cluster_fields": ["_quickbi_table_join_key"],
+        }
+
+    def test_overrides(self):
+        config = CleanConfig(table_layouts={"table": {"cluster_fields": ["id"]}})
+
+        layout = clean._get_destination_table_layout(
+            "table", SCHEMA, [], 20 * 1024**3, config
+        )
+
+        assert layout == {"partition_field": None, "cluster_fields": ["id"]}
+
+
+@pytest.mark.usefixtures("iter_specs")
+class TestBytesBudget:
+    @pytest.fixture
+    def client(self):
+        client = _make_client()
+        client.query.return_value.total_bytes_processed = 100
+        return client
+
+    def test_plan_estimates_bytes_with_dry_runs(self, client):
+        plan = plan_table(client, "project", "source", "destination", "table", "p")
+
+        assert plan["bytes_processed"] == 200
+        assert plan["destination_tables"][1] == {
+            "name": "p__table__items",
+            "column_count": 2,
+            "bytes_processed": 100,
+        }
+        assert all(
+            call.kwargs["job_config"].dry_run for call in client.query.call_args_list
+        )
+
+    def test_table_over_budget_is_not_transformed(self, client):
+        with pytest.raises(BytesBudgetExceeded):
+            transform_table(
+                client,
+                "project",
+                "source",
+                "destination",
+                "table",
+                "p",
+                CleanConfig(maximum_bytes_billed_per_table=150),
+            )
+
+        client.create_table.assert_not_called()
+
+    def test_dataset_budget_is_shared(self, client):
+        dataset_budget = BytesBudget(300)
+        dataset_budget.reserve(150, "Table 'other'")
+
+        with pytest.raises(BytesBudgetExceeded, match="150 bytes already used"):
+            transform_table(
+                client,
+                "project",
+                "source",
+                "destination",
+                "table",
+                "p",
+                CleanConfig(),
+                dataset_budget,
+            )
@@ -0,0 +1,470 @@
+"""In-process stand-ins for the BigQuery, Dataform and GCS clients
+
+The fakes implement the subset of the client APIs that this package uses, so
+that `clean.transform_dataset`, `backup.dataset` and `dataform.run` can be run
+end to end without network. They count API calls and jobs, and every call
+sleeps its configured latency, so that the effect of changes on the number of
+calls and on wall-clock time can be measured.
+
+Latencies are given in simulated seconds and slept scaled down by
+`SimulatedClock.time_scale`. Python overhead is included in the simulated
+time, so keep the scale large enough for latencies to dominate.
+
+The BigQuery fake doesn't evaluate SQL. It recognizes the statements that the
+package issues (sampling queries, DDL scripts, dry runs) and keeps a catalog
+of table metadata up to date. Other queries succeed without returning rows.
+"""
+
+import copy
+import csv
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import BadRequest, Conflict, NotFound
+from google.cloud import bigquery, dataform_v1beta1
+
+from prefect_qbi.clean.json_columns import SAMPLE_SIZE
+
+# Captured before tests patch `time.sleep`, e.g. to skip Dataform's polling.
+_sleep = time.sleep
+
+
+class SimulatedClock:
+    def __init__(self, time_scale=0.01):
+        self.time_scale = time_scale
+        self.reset()
+
+    def reset(self):
+        self._started = time.perf_counter()
+
+    def sleep(self, seconds):
+        _sleep(seconds * self.time_scale)
+
+    def elapsed(self):
+        """Return simulated seconds since the clock was (re)set"""
+        return (time.perf_counter() - self._started) / self.time_scale
+
+
+class _ApiCallCounter:
+    def __init__(self, clock, latencies, default_latency):
+        self.clock = clock or SimulatedClock()
+        self.latencies = latencies or {}
+        self.default_latency = default_latency
+        self.api_calls = Counter()
+        self.api_calls_per_table = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method, table_ref=None):
+        with self._lock:
+            self.api_calls[method] += 1
+            if table_ref is not None:
+                self.api_calls_per_table[table_ref.split(".")[-1]] += 1
+        self.clock.sleep(self.latencies.get(method, self.default_latency))
+
+
+class FakeJob:
+    def __init__(self, client, job_type, job_config, seconds, rows=(), error=None):
+        self._client = client
+        self.job_id = f"job_{uuid.uuid4().hex}"
+        self.job_type = job_type
+        self.labels = dict(getattr(job_config, "labels", None) or {})
+        self.rows = list(rows)
+        self.error = error
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = int(seconds * 1000)
+        self.cache_hit = False
+        self.started = datetime.now(timezone.utc)
+        self.ended = None
+        self._done_at = time.perf_counter() + seconds * client.clock.time_scale
+
+    @property
+    def state(self):
+        return "DONE" if time.perf_counter() >= self._done_at else "RUNNING"
+
+    @property
+    def error_result(self):
+        return {"message": self.error} if self.error else None
+
+    def done(self):
+        return self.state == "DONE"
+
+    def reload(self):
+        self._client._call("get_job")
+
+    def result(self):
+        self._client._call("get_query_results")
+        remaining = self._done_at - time.perf_counter()
+        if remaining > 0:
+            _sleep(remaining)
+        self.ended = self.ended or datetime.now(timezone.utc)
+        if self.error:
+            raise BadRequest(self.error)
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.result())
+
+
+class FakeStorage:
+    """GCS buckets that extract jobs write CSV files to"""
+
+    def __init__(self):
+        self.blobs = {}
+
+
+class FakeBigQueryClient(_ApiCallCounter):
+    """BigQuery client backed by an in-memory catalog
+
+    `job_seconds` is the simulated duration of every job, or a function from
+    the query (or "extract") to the duration. Queries matching any regex in
+    `failing_queries` fail when their result is awaited.
+    """
+
+    def __init__(
+        self,
+        project="project",
+        clock=None,
+        latencies=None,
+        default_latency=0.1,
+        job_seconds=2.0,
+        failing_queries=(),
+        storage=None,
+    ):
+        super().__init__(clock, latencies, default_latency)
+        self.project = project
+        self.job_seconds = job_seconds
+        self.failing_queries = list(failing_queries)
+        self.storage = storage or FakeStorage()
+        self.datasets = {}
+        self.tables = {}
+        self.rows = {}
+        self.jobs = []
+
+    def add_dataset(self, dataset_id, location="EU"):
+        self.datasets[f"{self.project}.{dataset_id}"] = location
+
+    def add_table(self, dataset_id, table_id, schema, rows):
+        """Add a table whose JSON columns hold JSON text, like the API returns"""
+        table_ref = f"{self.project}.{dataset_id}.{table_id}"
+        table = bigquery.Table(table_ref, schema)
+        table._properties.update(
+            {
+                "type": "TABLE",
+                "numRows": str(len(rows)),
+                "numBytes": str(len(json.dumps(rows, default=str))),
+                "lastModifiedTime": str(int(time.time() * 1000)),
+            }
+        )
+        self.tables[table_ref] = table
+        self.rows[table_ref] = rows
+
+    def get_jobs_per_table(self):
+        """Return number of jobs by the `source_table` label of the jobs"""
+        return Counter(job.labels.get("source_table") for job in self.jobs)
+
+    def _get_ref(self, table):
+        if isinstance(table, str):
+            return table if table.count(".") == 2 else f"{self.project}.{table}"
+        return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    def _get_dataset_ref(self, dataset):
+        if isinstance(dataset, str):
+            return dataset if "." in dataset else f"{self.project}.{dataset}"
+        return f"{dataset.project}.{dataset.dataset_id}"
+
+    def get_dataset(self, dataset_ref):
+        dataset_ref = self._get_dataset_ref(dataset_ref)
+        self._call("get_dataset")
+        if dataset_ref not in self.datasets:
+            raise NotFound(f"Dataset {dataset_ref} not found")
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.location = self.datasets[dataset_ref]
+        return dataset
+
+    def create_dataset(self, dataset, exists_ok=False):
+        dataset_ref = self._get_dataset_ref(dataset)
+        self._call("create_dataset")
+        if dataset_ref in self.datasets and not exists_ok:
+            raise Conflict(f"Dataset {dataset_ref} already exists")
+        self.datasets.setdefault(dataset_ref, dataset.location)
+
+    def list_tables(self, dataset_ref):
+        dataset_ref = self._get_dataset_ref(dataset_ref)
+        self._call("list_tables")
+        return [
+            bigquery.Table.from_api_repr(
+                copy.deepcopy(self.tables[table_ref].to_api_repr())
+            )
+            for table_ref in sorted(self.tables)
+            if table_ref.rsplit(".", 1)[0] == dataset_ref
+        ]
+
+    def get_table(self, table):
+        table_ref = self._get_ref(table)
+        self._call("get_table", table_ref)
+        if table_ref not in self.tables:
+            raise NotFound(f"Table {table_ref} not found")
+        return bigquery.Table.from_api_repr(
+            copy.deepcopy(self.tables[table_ref].to_api_repr())
+        )
+
+    def create_table(self, table, exists_ok=False):
+        table_ref = self._get_ref(table)
+        self._call("create_table", table_ref)
+        if table_ref in self.tables:
+            if exists_ok:
+                return self.get_table(table_ref)
+            raise Conflict(f"Table {table_ref} already exists")
+        self._create_table(table_ref, table)
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        table_ref = self._get_ref(table)
+        self._call("delete_table", table_ref)
+        if table_ref not in self.tables and not not_found_ok:
+            raise NotFound(f"Table {table_ref} not found")
+        self._drop_table(table_ref)
+
+    def _create_table(self, table_ref, table=None):
+        table = bigquery.Table.from_api_repr(
+            copy.deepcopy((table or bigquery.Table(table_ref)).to_api_repr())
+        )
+        table._properties.update(
+            {"type": "TABLE", "numRows": "0", "numBytes": "0"},
+        )
+        self.tables[table_ref] = table
+        self.rows[table_ref] = []
+
+    def _drop_table(self, table_ref):
+        self.tables.pop(table_ref, None)
+        self.rows.pop(table_ref, None)
+
+    def _ensure_bqstorage_client(self):
+        return None
+
+    def query(self, query, job_config=None, **kwargs):
+        self._call("query")
+        if job_config is not None and job_config.dry_run:
+            job = FakeJob(self, "query", job_config, 0)
+            job.total_bytes_processed = self._get_bytes_referenced(query)
+            return job
+
+        rows = self._run_query(query)
+        job = FakeJob(
+            self,
+            "query",
+            job_config,
+            self._get_job_seconds(query),
+            rows,
+            error=next(
+                (
+                    f"Query failed: {pattern}"
+                    for pattern in self.failing_queries
+                    if re.search(pattern, query)
+                ),
+                None,
+            ),
+        )
+        job.query = query
+        job.total_bytes_processed = job.total_bytes_billed = self._get_bytes_referenced(
+            query
+        )
+        self.jobs.append(job)
+        return job
+
+    def extract_table(self, source, destination_uri, location=None, job_config=None):
+        table_ref = self._get_ref(source)
+        self._call("extract_table", table_ref)
+        if table_ref not in self.tables:
+            raise NotFound(f"Table {table_ref} not found")
+
+        csv_file = io.StringIO()
+        fieldnames = [field.name for field in self.tables[table_ref].schema]
+        writer = csv.DictWriter(csv_file, fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(self.rows[table_ref])
+        self.storage.blobs[destination_uri] = csv_file.getvalue()
+
+        job = FakeJob(self, "extract", job_config, self._get_job_seconds("extract"))
+        self.jobs.append(job)
+        return job
+
+    def _get_job_seconds(self, query):
+        if callable(self.job_seconds):
+            return self.job_seconds(query)
+        return self.job_seconds
+
+    def _get_bytes_referenced(self, query):
+        # Like BigQuery, every statement of a script is billed for the tables
+        # it reads, including temp tables created earlier in the script, which
+        # are billed as the bytes of the query that created them.
+        temp_table_bytes = {}
+        total_bytes = 0
+        for statement in query.split(";"):
+            statement_bytes = sum(
+                self.tables[table_ref].num_bytes or 0
+                for table_ref in set(re.findall(r"`([^`]+\.[^`]+\.[^`]+)`", statement))
+                if table_ref in self.tables
+            ) + sum(
+                table_bytes
+                for table_name, table_bytes in temp_table_bytes.items()
+                if re.search(rf"(?<![\w.`]){table_name}(?![\w.`])", statement)
+            )
+            temp_table = re.match(r"\s*CREATE TEMP(?:ORARY)? TABLE (\w+)", statement)
+            if temp_table:
+                temp_table_bytes[temp_table.group(1)] = statement_bytes
+            total_bytes += statement_bytes
+        return total_bytes
+
+    def _run_query(self, query):
+        if "AS column_index, value" in query:
+            return self._sample(query)
+
+        # Scripts of DDL statements, e.g. `replace_tables`.
+        for statement in re.finditer(
+            r"(DROP TABLE IF EXISTS `([^`]+)`)"
+            r"|(ALTER TABLE `([^`]+)`\s+RENAME TO `([^`]+)`)"
+            r"|(CREATE OR REPLACE TABLE `([^`]+)`)",
+            query,
+        ):
+            if statement[1]:
+                self._drop_table(statement[2])
+            elif statement[3]:
+                old_table_ref = statement[4]
+                new_table_ref = f"{old_table_ref.rsplit('.', 1)[0]}.{statement[5]}"
+                table = self.tables.pop(old_table_ref)
+                table._properties["tableReference"]["tableId"] = statement[5]
+                self.tables[new_table_ref] = table
+                self.rows[new_table_ref] = self.rows.pop(old_table_ref)
+            else:
+                self._create_or_replace_table(statement[7], query[statement.end() :])
+        return []
+
+    def _create_or_replace_table(self, table_ref, ddl_rest):
+        partition_by = re.match(
+            r"[^;]*?PARTITION BY (?:\w+\()?`([^`]+)`", ddl_rest.split(" AS ", 1)[0]
+        )
+        partition_field = partition_by[1] if partition_by else None
+        existing_table = self.tables.get(table_ref)
+        if existing_table is not None and partition_field != (
+            existing_table.time_partitioning.field
+            if existing_table.time_partitioning
+            else None
+        ):
+            raise BadRequest(
+                "Cannot replace a table with a different partitioning spec. "
+                "Instead, DROP the table, and then recreate it."
+            )
+        table = bigquery.Table(table_ref)
+        if partition_field:
+            table.time_partitioning = bigquery.TimePartitioning(field=partition_field)
+        self._create_table(table_ref, table)
+
+    def _sample(self, query):
+        rows = []
+        for column_index, column, table_ref in re.findall(
+            r"SELECT (\d+) AS column_index, value\s+FROM \(\s+"
+            r"SELECT `([^`]+)` AS value\s+FROM `([^`]+)`",
+            query,
+        ):
+            values = [
+                row[column]
+                for row in self.rows.get(table_ref, [])
+                if row.get(column) is not None
+            ]
+            rows.extend(
+                {"column_index": int(column_index), "value": value}
+                for value in values[:SAMPLE_SIZE]
+            )
+        return rows
+
+
+class FakeDataformClient(_ApiCallCounter):
+    """Dataform client whose compilations have `actions`
+
+    Workflow invocations stay running for `running_polls` polls and then
+    succeed, unless `failed_actions` has targets whose actions fail.
+    """
+
+    def __init__(
+        self,
+        clock=None,
+        latencies=None,
+        default_latency=0.5,
+        actions=("reporting.orders",),
+        compilation_errors=(),
+        running_polls=0,
+        failed_actions=(),
+    ):
+        super().__init__(clock, latencies, default_latency)
+        self.actions = list(actions)
+        self.compilation_errors = list(compilation_errors)
+        self.running_polls = running_polls
+        self.failed_actions = list(failed_actions)
+        self._remaining_polls = {}
+
+    def create_compilation_result(self, parent, compilation_result, retry=None):
+        self._call("create_compilation_result")
+        return dataform_v1beta1.CompilationResult(
+            name=f"{parent}/compilationResults/{uuid.uuid4().hex}",
+            compilation_errors=[
+                dataform_v1beta1.CompilationResult.CompilationError(message=message)
+                for message in self.compilation_errors
+            ],
+        )
+
+    def query_compilation_result_actions(self, request):
+        self._call("query_compilation_result_actions")
+        return [
+            dataform_v1beta1.CompilationResultAction(
+                target=_get_dataform_target(action)
+            )
+            for action in self.actions
+        ]
+
+    def create_workflow_invocation(self, parent, workflow_invocation):
+        self._call("create_workflow_invocation")
+        name = f"{parent}/workflowInvocations/{uuid.uuid4().hex}"
+        self._remaining_polls[name] = self.running_polls
+        return self._get_workflow_invocation(name)
+
+    def get_workflow_invocation(self, name):
+        self._call("get_workflow_invocation")
+        self._remaining_polls[name] -= 1
+        return self._get_workflow_invocation(name)
+
+    def _get_workflow_invocation(self, name):
+        State = dataform_v1beta1.WorkflowInvocation.State
+        if self._remaining_polls[name] > 0:
+            state = State.RUNNING
+        elif self.failed_actions:
+            state = State.FAILED
+        else:
+            state = State.SUCCEEDED
+        return dataform_v1beta1.WorkflowInvocation(name=name, state=state)
+
+    def query_workflow_invocation_actions(self, request):
+        self._call("query_workflow_invocation_actions")
+        State = dataform_v1beta1.WorkflowInvocationAction.State
+        return [
+            dataform_v1beta1.WorkflowInvocationAction(
+                canonical_target=_get_dataform_target(action),
+                state=State.FAILED
+                if action in self.failed_actions
+                else State.SUCCEEDED,
+                failure_reason="Failed" if action in self.failed_actions else "",
+            )
+            for action in self.actions
+        ]
+
+
+def _get_dataform_target(action):
+    schema, name = action.split(".")
+    return dataform_v1beta1.Target(schema=schema, name=name)
@@ -0,0 +1,22 @@
+from benchmarks import schema_inference
+
+
+class TestSchemaInferenceBenchmarks:
+    def test_every_case_runs(self):
+        results = schema_inference.run_benchmarks(
+            list(schema_inference.CASES), [10, 20], min_time=0
+        )
+
+        for case_results in results.values():
+            assert set(case_results) == {"10", "20"}
+            assert all(result["throughput"] > 0 for result in case_results.values())
+            assert len(schema_inference.get_scaling_exponents(case_results)) == 1
+
+    def test_regressions_are_reported(self):
+        results = {"clean_name": {"10": {"throughput": 70}}}
+        baseline = {"clean_name": {"10": {"throughput": 100}, "20": {}}}
+
+        assert schema_inference.compare_with_baseline(results, baseline, 0.2) == [
+            "clean_name at width 10: 70% of baseline throughput"
+        ]
+        assert schema_inference.compare_with_baseline(results, baseline, 0.5) == []
@@ -0,0 +1,273 @@
+import json
+from unittest import mock
+
+import pytest
+from google.cloud import bigquery
+
+from prefect_qbi import backup, dataform
+from prefect_qbi.clean import CleanConfig, transform_dataset
+
+from .fakes import FakeBigQueryClient, FakeDataformClient, SimulatedClock
+
+SCHEMA = [
+    bigquery.SchemaField("id", "INT64"),
+    bigquery.SchemaField("data", "JSON"),
+    bigquery.SchemaField("lines", "JSON"),
+    bigquery.SchemaField("_airbyte_extracted_at", "TIMESTAMP"),
+]
+
+
+def _make_rows(count):
+    return [
+        {
+            "id": i,
+            "data": json.dumps({"name": f"row {i}", "amount": i * 1.5}),
+            "lines": json.dumps([{"sku": i, "quantity": 2}]),
+            "_airbyte_extracted_at": "2023-01-01T00:00:00Z",
+        }
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def client():
+    client = FakeBigQueryClient(clock=SimulatedClock(time_scale=0.01))
+    client.add_dataset("source")
+    for table_id in ("orders", "invoices", "customers"):
+        client.add_table("source", table_id, SCHEMA, _make_rows(10))
+    return client
+
+
+class TestTransformDatasetEndToEnd:
+    def test_destination_tables_are_created(self, client):
+        transform_dataset(client, "project", "source", "destination", "prefix")
+
+        assert sorted(
+            table.table_id for table in client.list_tables("project.destination")
+        ) == [
+            f"prefix__{table_id}{suffix}"
+            for table_id in ("customers", "invoices", "orders")
+            for suffix in ("", "__lines")
+        ]
+        main_table = client.get_table("project.destination.prefix__orders")
+        assert [field.name for field in main_table.schema] == [
+            "_quickbi_orders_join_key",
+            "id",
+            "data__name",
+            "data__amount",
+            "_row_extracted_at",
+            "data",
+        ]
+
+    def test_jobs_and_api_calls_are_counted_per_table(self, client):
+        transform_dataset(client, "project", "source", "destination", "prefix")
+
+        # A sampling job per JSON column, a job per destination table and
+        # one swap script.
+        assert client.get_jobs_per_table() == {
+            "orders": 5,
+            "invoices": 5,
+            "customers": 5,
+        }
+        assert client.api_calls["query"] == 15
+        assert client.api_calls_per_table["orders"] == 2
+
+    def test_concurrent_tables_take_less_time(self, client):
+        client.clock.reset()
+        transform_dataset(client, "project", "source", "destination", "prefix")
+        serial_seconds = client.clock.elapsed()
+
+        client.clock.reset()
+        transform_dataset(
+            client,
+            "project",
+            "source",
+            "destination",
+            "prefix",
+            CleanConfig(max_concurrent_tables=3),
+        )
+        concurrent_seconds = client.clock.elapsed()
+
+        assert concurrent_seconds < serial_seconds * 0.75
+
+    def test_replace_mode_changes_partitioning(self, client):
+        transform_dataset(
+            client,
+            "project",
+            "source",
+            "destination",
+            "prefix",
+            CleanConfig(materialization="replace"),
+        )
+        transform_dataset(
+            client,
+            "project",
+            "source",
+            "destination",
+            "prefix",
+            CleanConfig(materialization="replace", partition_min_bytes=1),
+        )
+
+        main_table = client.get_table("project.destination.prefix__orders")
+        assert main_table.time_partitioning.field == "_row_extracted_at"
+        assert not any(
+            "temp" in table.table_id
+            for table in client.list_tables("project.destination")
+        )
+
+    def test_wide_tables_are_sharded(self):
+        client = FakeBigQueryClient(clock=SimulatedClock(time_scale=0.001))
+        client.add_dataset("source")
+        client.add_table(
+            "source",
+            "deals",
+            [
+                bigquery.SchemaField("_airbyte_raw_id", "STRING"),
+                bigquery.SchemaField("data", "JSON"),
+                bigquery.SchemaField("_airbyte_extracted_at", "TIMESTAMP"),
+            ],
+            [
+                {
+                    "_airbyte_raw_id": "a",
+                    "data": json.dumps({f"property{i}": i for i in range(20)}),
+                    "_airbyte_extracted_at": "2023-01-01T00:00:00Z",
+                }
+            ],
+        )
+
+        transform_dataset(
+            client,
+            "project",
+            "source",
+            "destination",
+            "prefix",
+            CleanConfig(max_columns_per_table=10),
+        )
+
+        shards = [
+            client.get_table(f"project.destination.{table_name}")
+            for table_name in [
+                "prefix__deals",
+                "prefix__deals__part_2",
+                "prefix__deals__part_3",
+            ]
+        ]
+        # 20 keys and the JSON column itself, plus the key columns in each shard.
+        assert [len(shard.schema) for shard in shards] == [10, 10, 7]
+        assert all(
+            [field.name for field in shard.schema][:2]
+            == ["_quickbi_deals_join_key", "_row_extracted_at"]
+            for shard in shards
+        )
+        materialize_query = next(
+            job.query for job in client.jobs if job.labels["stage"] == "materialize"
+        )
+        assert "LAX_INT64(`data`['property0'])" in materialize_query
+
+    def test_wide_subtables_are_sharded_and_stale_shards_dropped(self):
+        client = FakeBigQueryClient(clock=SimulatedClock(time_scale=0.001))
+        client.add_dataset("source")
+        client.add_table(
+            "source",
+            "deals",
+            [
+                bigquery.SchemaField("_airbyte_raw_id", "STRING"),
+                bigquery.SchemaField("lines", "JSON"),
+                bigquery.SchemaField("_airbyte_extracted_at", "TIMESTAMP"),
+            ],
+            [
+                {
+                    "_airbyte_raw_id": "a",
+                    "lines": json.dumps([{f"property{i}": i for i in range(20)}]),
+                    "_airbyte_extracted_at": "2023-01-01T00:00:00Z",
+                }
+            ],
+        )
+
+        transform_dataset(
+            client,
+            "project",
+            "source",
+            "destination",
+            "prefix",
+            CleanConfig(max_columns_per_table=10),
+        )
+
+        shards = [
+            client.get_table(f"project.destination.{table_name}")
+            for table_name in [
+                "prefix__deals__lines",
+                "prefix__deals__lines__part_2",
+                "prefix__deals__lines__part_3",
+            ]
+        ]
+        assert all(
+            [field.name for field in shard.schema][:3]
+            == [
+                "_quickbi_deals_join_key",
+                "_quickbi_array_offset",
+                "_row_extracted_at",
+            ]
+            for shard in shards
+        )
+        assert sum(len(shard.schema) - 3 for shard in shards) == 20
+
+        transform_dataset(client, "project", "source", "destination", "prefix")
+
+        assert sorted(
+            table.table_id for table in client.list_tables("project.destination")
+        ) == ["prefix__deals", "prefix__deals__lines"]
+
+    def test_failing_job_leaves_no_temp_tables(self, client):
+        # The query of the orders subtable.
+        client.failing_queries = [r"(?s)`project\.source\.orders`.*UNNEST"]
+
+        with pytest.raises(RuntimeError, match="orders"):
+            transform_dataset(client, "project", "source", "destination", "prefix")
+
+        assert not any(
+            "temp" in table.table_id
+            for table in client.list_tables("project.destination")
+        )
+
+
+class TestBackupEndToEnd:
+    def test_every_table_is_extracted(self, client):
+        backup.dataset(client, "project", "source", "EU", "bucket")
+
+        assert sorted(client.storage.blobs) == [
+            f"gs://bucket/source__{table_id}__backup.csv"
+            for table_id in ("customers", "invoices", "orders")
+        ]
+        assert client.storage.blobs[
+            "gs://bucket/source__orders__backup.csv"
+        ].startswith("id,data,lines,_airbyte_extracted_at\r\n0,")
+        assert client.get_jobs_per_table() == {
+            "orders": 1,
+            "invoices": 1,
+            "customers": 1,
+        }
+
+
+class TestDataformEndToEnd:
+    def test_workflow_is_polled_until_finished(self):
+        client = FakeDataformClient(running_polls=2)
+
+        with mock.patch.object(dataform.time, "sleep") as sleep:
+            dataform.run(client, "project", "EU", "repository")
+
+        assert sleep.call_count == 2
+        assert client.api_calls == {
+            "create_compilation_result": 1,
+            "query_compilation_result_actions": 1,
+            "create_workflow_invocation": 1,
+            "get_workflow_invocation": 2,
+        }
+
+    def test_failed_actions_are_reported(self):
+        client = FakeDataformClient(failed_actions=["reporting.orders"])
+
+        with pytest.raises(Exception, match="unsuccefully"):
+            dataform.run(client, "project", "EU", "repository")
+
+        assert client.api_calls["query_workflow_invocation_actions"] == 1
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from prefect_qbi import telemetry
+
+
+def _make_job(job_id, labels):
+    started = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    return mock.Mock(
+        job_id=job_id,
+        job_type="query",
+        labels=labels,
+        state="DONE",
+        started=started,
+        ended=started + timedelta(seconds=2),
+        total_bytes_processed=100,
+        total_bytes_billed=10485760,
+        slot_millis=500,
+        cache_hit=False,
+        error_result=None,
+    )
+
+
+class TestTelemetry:
+    def test_jobs_are_labeled(self):
+        client = mock.Mock()
+
+        with telemetry.job_labels(customer="Acme Oy", dataset="src"):
+            with telemetry.job_labels(source_table="Orders"):
+                telemetry.start_query(client, "SELECT 1", stage="sample")
+
+        job_config = client.query.call_args.kwargs["job_config"]
+        assert job_config.labels == {
+            "customer": "acme_oy",
+            "dataset": "src",
+            "source_table": "orders",
+            "stage": "sample",
+        }
+
+    def test_recorded_job_statistics_are_emitted(self):
+        client = mock.Mock()
+        client.query.side_effect = lambda query, job_config: _make_job(
+            query, job_config.labels
+        )
+
+        with mock.patch.object(telemetry, "emit_job_statistics") as emit:
+            with telemetry.record_jobs("clean src"):
+                telemetry.start_query(client, "job1", stage="sample")
+                with telemetry.record_jobs("clean src.orders"):
+                    telemetry.start_query(client, "job2", stage="materialize")
+
+        # Only the outermost block emits, with the jobs of nested blocks.
+        emit.assert_called_once()
+        name, job_statistics = emit.call_args.args
+        assert name == "clean src"
+        assert [statistics["job_id"] for statistics in job_statistics] == [
+            "job1",
+            "job2",
+        ]
+        assert job_statistics[1]["stage"] == "materialize"
+        assert job_statistics[1]["wall_time_seconds"] == 2
+        assert job_statistics[1]["total_slot_ms"] == 500
+
+    def test_dry_runs_are_not_recorded(self):
+        client = mock.Mock()
+
+        with mock.patch.object(telemetry, "emit_job_statistics") as emit:
+            with telemetry.record_jobs("plan"):
+                telemetry.start_query(
+                    client,
+                    "SELECT 1",
+                    telemetry.bigquery.QueryJobConfig(dry_run=True),
+                )
+
+        assert emit.call_args.args[1] == []